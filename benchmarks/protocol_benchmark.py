@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""Offline microbenchmarks for the protocol layer
+
+Times encode / decode of the request and response types, the legacy
+KafkaProtocol helpers and each available codec against synthetic payloads
+(no broker needed), and reports ops/s and bytes/s per case. Results can be
+saved as a JSON baseline and later runs compared against it:
+
+    python benchmarks/protocol_benchmark.py --save baseline.json
+    # ... change the protocol code ...
+    python benchmarks/protocol_benchmark.py --compare baseline.json
+
+Use --filter to run a subset of cases (substring match on the case name).
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kafka.codec import get_codec, has_codec # pylint: disable=wrong-import-position
+from kafka.common import ( # pylint: disable=wrong-import-position
+    FetchRequestPayload, ProduceRequestPayload
+)
+from kafka.protocol.admin import ( # pylint: disable=wrong-import-position
+    ApiVersionResponse, DescribeGroupsResponse, ListGroupsResponse
+)
+from kafka.protocol.api import ( # pylint: disable=wrong-import-position
+    RequestHeader, encode_request, encode_request_buffers
+)
+from kafka.protocol.buffer import MemoryViewReader # pylint: disable=wrong-import-position
+from kafka.protocol.commit import ( # pylint: disable=wrong-import-position
+    GroupCoordinatorResponse, OffsetCommitRequest_v2, OffsetCommitResponse,
+    OffsetFetchRequest_v1, OffsetFetchResponse
+)
+from kafka.protocol.fetch import ( # pylint: disable=wrong-import-position
+    FetchRequest, FetchResponse, FetchResponseBatches
+)
+from kafka.protocol.group import ( # pylint: disable=wrong-import-position
+    HeartbeatRequest, JoinGroupRequest, JoinGroupResponse, MemberAssignment,
+    ProtocolMetadata, SyncGroupRequest, SyncGroupResponse
+)
+from kafka.protocol.legacy import ( # pylint: disable=wrong-import-position
+    KafkaProtocol, create_message
+)
+from kafka.protocol.message import Message, MessageSet # pylint: disable=wrong-import-position
+from kafka.protocol.metadata import ( # pylint: disable=wrong-import-position
+    MetadataRequest, MetadataResponse
+)
+from kafka.protocol.offset import ( # pylint: disable=wrong-import-position
+    OffsetRequest, OffsetResponse
+)
+from kafka.protocol.produce import ( # pylint: disable=wrong-import-position
+    ProduceRequest, ProduceResponse
+)
+from kafka.protocol.types import Int32 # pylint: disable=wrong-import-position
+
+
+SIZES = {'small': 100, 'large': 100 * 1024}
+WORDS = [b'kafka', b'topic', b'partition', b'offset', b'message', b'broker',
+         b'consumer', b'producer', b'0123456789', b'{"id": ', b'}, ']
+
+
+def synthetic_payload(size, rng):
+    """Semi-compressible bytes: random words with some random noise"""
+    chunks = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.2:
+            chunk = bytes(bytearray([rng.randint(0, 255) for _ in range(8)]))
+        else:
+            chunk = rng.choice(WORDS)
+        chunks.append(chunk)
+        length += len(chunk)
+    return b''.join(chunks)[:size]
+
+
+def message_set_items(count, size, rng, offset=0):
+    return [(offset + i, 0, Message(synthetic_payload(size, rng),
+                                    key=('key-%d' % i).encode()))
+            for i in range(count)]
+
+
+def join_request(header, request):
+    """How requests were framed before encode_request: each part encoded
+    to bytes and joined"""
+    message = b''.join([header.encode(), request.encode()])
+    return Int32.encode(len(message)) + message
+
+
+class Case(object):
+    """A benchmarked callable and the number of bytes it processes per call"""
+    def __init__(self, name, func, nbytes):
+        self.name = name
+        self.func = func
+        self.nbytes = nbytes
+
+
+def build_cases(rng):
+    cases = []
+
+    def add(name, func, nbytes):
+        cases.append(Case(name, func, nbytes))
+
+    # Struct requests / responses
+    for partitions in (1, 1000):
+        topics = [('topic-%d' % (i // 100), [(i % 100, i * 10, 1048576)])
+                  for i in range(partitions)]
+        request = FetchRequest(-1, 500, 1, topics)
+        encoded = request.encode()
+        add('FetchRequest.encode[%d partitions]' % partitions,
+            request.encode, len(encoded))
+
+        header = RequestHeader(request, correlation_id=1, client_id='bench')
+        add('encode_request[FetchRequest, %d partitions]' % partitions,
+            lambda header=header, request=request: encode_request(header, request),
+            len(encoded))
+
+        response = MetadataResponse(
+            [(i, 'broker-%d' % i, 9092) for i in range(10)],
+            [(0, 'topic-%d' % i, [(0, p, p % 10, [0, 1, 2], [0, 1, 2])
+                                  for p in range(max(1, partitions // 10))])
+             for i in range(10)])
+        encoded = response.encode()
+        add('MetadataResponse.decode[%d partitions]' % partitions,
+            lambda encoded=encoded: MetadataResponse.decode(io.BytesIO(encoded)),
+            len(encoded))
+
+        response = ProduceResponse([
+            ('topic', [(p, 0, p * 100) for p in range(partitions)])])
+        encoded = response.encode()
+        add('ProduceResponse.decode[%d partitions]' % partitions,
+            lambda encoded=encoded: ProduceResponse.decode(io.BytesIO(encoded)),
+            len(encoded))
+
+    request = MetadataRequest(['topic-%d' % i for i in range(100)])
+    add('MetadataRequest.encode', request.encode, len(request.encode()))
+
+    # Offset, group coordination and admin requests / responses
+    def add_encode(name, struct):
+        add('%s.encode%s' % (type(struct).__name__, name), struct.encode,
+            len(struct.encode()))
+
+    def add_decode(name, struct):
+        encoded = struct.encode()
+        add('%s.decode%s' % (type(struct).__name__, name),
+            lambda cls=type(struct), encoded=encoded: cls.decode(
+                io.BytesIO(encoded)),
+            len(encoded))
+
+    def by_topic(partitions, partition_fields):
+        return [('topic-%d' % t, [partition_fields(p) for p in range(
+            t * 100, min(partitions, (t + 1) * 100))])
+                for t in range((partitions + 99) // 100)]
+
+    label = '[1000 partitions]'
+    add_encode(label, OffsetRequest(-1, by_topic(1000, lambda p: (p, -1, 1))))
+    add_decode(label, OffsetResponse(by_topic(1000, lambda p: (p, 0, [p]))))
+    add_encode(label, OffsetCommitRequest_v2('group', 1, 'member-0', -1,
+        by_topic(1000, lambda p: (p, p * 100, ''))))
+    add_decode(label, OffsetCommitResponse(by_topic(1000, lambda p: (p, 0))))
+    add_encode(label, OffsetFetchRequest_v1('group', [
+        (topic, [p for p, in partitions])
+        for topic, partitions in by_topic(1000, lambda p: (p,))]))
+    add_decode(label, OffsetFetchResponse(
+        by_topic(1000, lambda p: (p, p * 100, '', 0))))
+    add_decode('', GroupCoordinatorResponse(0, 1, 'broker-1', 9092))
+
+    topics = ['topic-%d' % i for i in range(10)]
+    metadata = ProtocolMetadata(0, topics, b'').encode()
+    assignment = MemberAssignment(0, [(topic, list(range(10)))
+                                      for topic in topics], b'').encode()
+    label = '[100 members]'
+    add_encode('', JoinGroupRequest('group', 30000, 'member-0', 'consumer',
+                                    [('range', metadata)]))
+    add_decode(label, JoinGroupResponse(0, 1, 'range', 'member-0', 'member-0',
+        [('member-%d' % i, metadata) for i in range(100)]))
+    add_encode(label, SyncGroupRequest('group', 1, 'member-0',
+        [('member-%d' % i, assignment) for i in range(100)]))
+    add_decode('', SyncGroupResponse(0, assignment))
+    add_decode('', MemberAssignment.decode(assignment))
+    add_encode('', HeartbeatRequest('group', 1, 'member-0'))
+
+    add_decode('[100 groups]', ListGroupsResponse(
+        0, [('group-%d' % i, 'consumer') for i in range(100)]))
+    add_decode(label, DescribeGroupsResponse([
+        (0, 'group', 'Stable', 'consumer', 'range', [
+            ('member-%d' % i, 'client', '/10.0.0.1', metadata, assignment)
+            for i in range(100)])]))
+    add_decode('', ApiVersionResponse(0, [(i, 0, 2) for i in range(20)]))
+
+    # Message sets and fetch / produce payloads
+    for label, size in sorted(SIZES.items()):
+        count = max(10, 1048576 // (size * 10))
+        items = message_set_items(count, size, rng)
+        encoded = MessageSet.encode(items, size=False)
+
+        add('MessageSet.encode[%d x %s]' % (count, label),
+            lambda items=items: MessageSet.encode(items, size=False),
+            len(encoded))
+        add('MessageSet.decode[%d x %s]' % (count, label),
+            lambda encoded=encoded: [msg.value for _, _, msg in MessageSet.decode(
+                encoded, bytes_to_read=len(encoded))],
+            len(encoded))
+
+        request = ProduceRequest(1, 1000, [('topic', [(0, items)])])
+        add('ProduceRequest.encode[%d x %s]' % (count, label),
+            request.encode, len(encoded))
+
+        # the buffer list only pays off when values are large enough to be
+        # referenced rather than copied (see BrokerConnection.MIN_REF_SIZE)
+        header = RequestHeader(request, correlation_id=1, client_id='bench')
+        add('encode_request[ProduceRequest, %d x %s]' % (count, label),
+            lambda header=header, request=request: encode_request(
+                header, request),
+            len(encoded))
+        add('encode_request_buffers[ProduceRequest, %d x %s]' % (count, label),
+            lambda header=header, request=request: encode_request_buffers(
+                header, request),
+            len(encoded))
+
+        response = FetchResponse([('topic', [(0, 0, count, items)])]).encode()
+        add('FetchResponse.decode[%d x %s]' % (count, label),
+            lambda response=response: FetchResponse.decode(
+                MemoryViewReader(response)),
+            len(response))
+        add('FetchResponseBatches.decode+records[%d x %s]' % (count, label),
+            lambda response=response: [
+                list(batch.records()) for batch in FetchResponseBatches.decode(
+                    MemoryViewReader(response)).batches],
+            len(response))
+
+        payloads = [ProduceRequestPayload('topic', p, [
+            create_message(msg.value, msg.key) for _, _, msg in items])
+                    for p in range(4)]
+        add('KafkaProtocol.encode_produce_request[4 x %d x %s]' % (count, label),
+            lambda payloads=payloads: KafkaProtocol.encode_produce_request(
+                payloads).encode(),
+            4 * len(encoded))
+
+        add('KafkaProtocol.decode_fetch_response[%d x %s]' % (count, label),
+            lambda response=response: KafkaProtocol.decode_fetch_response(
+                FetchResponse.decode(MemoryViewReader(response))),
+            len(response))
+
+    # small produce requests, framed by joining vs encoding into one buffer
+    for size in (100, 1024):
+        items = message_set_items(10, size, rng)
+        request = ProduceRequest(1, 1000, [('topic', [(0, items)])])
+        header = RequestHeader(request, correlation_id=1, client_id='bench')
+        nbytes = len(encode_request(header, request))
+        add('join_request[ProduceRequest, 10 x %dB]' % size,
+            lambda header=header, request=request: join_request(
+                header, request),
+            nbytes)
+        add('encode_request[ProduceRequest, 10 x %dB]' % size,
+            lambda header=header, request=request: encode_request(
+                header, request),
+            nbytes)
+
+    # full iteration of a decoded set, as the Fetcher does for every fetch
+    items = message_set_items(2000, 100, rng)
+    encoded = MessageSet.encode(items, size=False)
+    add('MessageSet.decode+iterate[2000 x 100B]',
+        lambda encoded=encoded: [(msg.key, msg.value) for _, _, msg in
+                                 MessageSet.decode(encoded,
+                                                   bytes_to_read=len(encoded))],
+        len(encoded))
+
+    request = KafkaProtocol.encode_fetch_request(
+        [FetchRequestPayload('topic-%d' % (i // 100), i % 100, 0, 1048576)
+         for i in range(1000)])
+    add('KafkaProtocol.encode_fetch_request[1000 partitions]',
+        request.encode, len(request.encode()))
+
+    # Codecs
+    for codec_id in range(1, 8):
+        if not has_codec(codec_id): # registered and available
+            continue
+        codec = get_codec(codec_id)
+        for label, size in sorted(SIZES.items()):
+            payload = MessageSet.encode(
+                message_set_items(max(1, 65536 // size), size, rng),
+                size=False)
+            compressed = codec.encode(payload)
+            add('%s.encode[%s]' % (codec.name, label),
+                lambda codec=codec, payload=payload: codec.encode(payload),
+                len(payload))
+            add('%s.decode[%s]' % (codec.name, label),
+                lambda codec=codec, compressed=compressed: codec.decode(compressed),
+                len(payload))
+
+    return cases
+
+
+def run_case(case, min_time, repeat):
+    """Return the best (lowest) seconds per call over repeat runs"""
+    timer = timeit.Timer(case.func)
+    number = 1
+    while True: # calibrate so that one run takes at least min_time
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed) + 1)
+    best = min([elapsed] + timer.repeat(repeat - 1, number)) if repeat > 1 else elapsed
+    return best / number
+
+
+def run(cases, min_time, repeat, out=sys.stdout):
+    results = {}
+    width = max([len(case.name) for case in cases] + [10])
+    for case in cases:
+        seconds = run_case(case, min_time, repeat)
+        results[case.name] = {
+            'ops_per_sec': 1.0 / seconds,
+            'bytes_per_sec': case.nbytes / seconds,
+            'bytes': case.nbytes,
+        }
+        print('%-*s %12.1f ops/s %10.2f MB/s' % (
+            width, case.name, 1.0 / seconds, case.nbytes / seconds / 1e6),
+              file=out)
+    return results
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """Print the change in ops/s against baseline; return the regressions"""
+    regressions = []
+    width = max([len(name) for name in results] + [10])
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['ops_per_sec'] / baseline[name]['ops_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-*s %+7.1f%%%s' % (width, name, (ratio - 1) * 100, flag),
+              file=out)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per timing run (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timing runs per case, best is kept (default 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic payloads (default 0)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='write the results to FILE as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare against a JSON baseline from --save')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fractional slowdown reported as a regression'
+                             ' (default 0.1)')
+    args = parser.parse_args(argv)
+
+    cases = [case for case in build_cases(random.Random(args.seed))
+             if args.filter in case.name]
+    results = run(cases, args.min_time, args.repeat)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_implementation() + ' ' +
+                          platform.python_version(),
+                'seed': args.seed,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\nChange in ops/s vs %s (%s):' % (args.compare, baseline['python']))
+        if compare(results, baseline['results'], args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,7 +7,8 @@ __copyright__ = 'Copyright 2016 Dana Powers, David Arthur, and Contributors'
 from kafka.consumer import KafkaConsumer
 from kafka.conn import BrokerConnection
 from kafka.protocol import (
-    create_message, create_gzip_message, create_snappy_message)
+    create_message, create_gzip_message, create_snappy_message,
+    create_lz4_message)
 from kafka.partitioner import RoundRobinPartitioner, HashedPartitioner, Murmur2Partitioner
 
 # To be deprecated when KafkaProducer interface is released
@@ -32,5 +33,6 @@ __all__ = [
     'SimpleClient', 'SimpleProducer', 'KeyedProducer',
     'RoundRobinPartitioner', 'HashedPartitioner',
     'create_message', 'create_gzip_message', 'create_snappy_message',
+    'create_lz4_message',
     'SimpleConsumer', 'MultiProcessConsumer',
 ]
@@ -245,12 +245,6 @@ class SimpleClient(object):
                 failed_payloads(broker_payloads)
                 continue
 
-            if not expect_response:
-                for payload in broker_payloads:
-                    topic_partition = (str(payload.topic), payload.partition)
-                    responses[topic_partition] = None
-                continue
-
             connections_by_future[future] = (conn, broker)
 
         conn = None
@@ -259,6 +253,7 @@ class SimpleClient(object):
             for future in futures:
 
                 if not future.is_done:
+                    # recv() also writes what is left of the request
                     conn, _ = connections_by_future[future]
                     conn.recv()
                     continue
@@ -268,6 +263,12 @@ class SimpleClient(object):
                     refresh_metadata = True
                     failed_payloads(payloads_by_broker[broker])
 
+                elif decoder_fn is None:
+                    # no response expected: the request has been written
+                    for payload in payloads_by_broker[broker]:
+                        topic_partition = (str(payload.topic), payload.partition)
+                        responses[topic_partition] = None
+
                 else:
                     for payload_response in decoder_fn(future.value):
                         topic_partition = (str(payload_response.topic),
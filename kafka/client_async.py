@@ -1,26 +1,37 @@
+import collections
 import copy
+import errno
+import functools
 import heapq
 import itertools
+import json
 import logging
+import os
 import random
 import select
+import socket
+import threading
 import time
 
-import six
+try:
+    import selectors # pylint: disable=import-error
+except ImportError:
+    try:
+        import selectors34 as selectors # pylint: disable=import-error
+    except ImportError:
+        from . import selectors_compat as selectors
 
 import kafka.common as Errors # TODO: make Errors a separate class
 
 from .cluster import ClusterMetadata
 from .conn import BrokerConnection, ConnectionStates, collect_hosts
 from .future import Future
+from .protocol.admin import ApiVersionRequest, ListGroupsRequest
+from .protocol.commit import OffsetFetchRequest_v0, GroupCoordinatorRequest
 from .protocol.metadata import MetadataRequest
 from .protocol.produce import ProduceRequest
 from .version import __version__
 
-if six.PY2:
-    ConnectionError = None
-
-
 log = logging.getLogger(__name__)
 
 
@@ -30,7 +41,8 @@ class KafkaClient(object):
     This is an internal class used to implement the
     user-facing producer and consumer clients.
 
-    This class is not thread-safe!
+    This class is not thread-safe! See ThreadedKafkaClient for a variant
+    that can be shared by threads.
     """
     DEFAULT_CONFIG = {
         'bootstrap_servers': 'localhost',
@@ -42,6 +54,10 @@ class KafkaClient(object):
         'send_buffer_bytes': 131072,
         'retry_backoff_ms': 100,
         'metadata_max_age_ms': 300000,
+        'bootstrap_connect_stagger_ms': 250,
+        'connections_max_idle_ms': 9 * 60 * 1000,
+        'api_version_cache_ttl_ms': 24 * 60 * 60 * 1000,
+        'api_version_cache_file': None,
     }
 
     def __init__(self, **configs):
@@ -77,6 +93,19 @@ class KafkaClient(object):
                 brokers or partitions. Default: 300000
             retry_backoff_ms (int): Milliseconds to backoff when retrying on
                 errors. Default: 100.
+            bootstrap_connect_stagger_ms (int): Bootstrap connects to the
+                bootstrap_servers concurrently, starting a new connection
+                attempt this many milliseconds after the previous one until
+                one of them succeeds. Default: 250.
+            connections_max_idle_ms (int): Close connections that have not
+                sent or received anything for this many milliseconds. They
+                are reopened when next needed. None disables. Default: 540000
+            api_version_cache_ttl_ms (int): How long a broker version found
+                by check_version() is reused for the same bootstrap_servers,
+                by any KafkaClient in the process (and any process sharing
+                api_version_cache_file). Default: 86400000 (1 day)
+            api_version_cache_file (str): Path of a JSON file that persists
+                detected broker versions across processes. Default: None
         """
         self.config = copy.copy(self.DEFAULT_CONFIG)
         for key in self.config:
@@ -88,7 +117,9 @@ class KafkaClient(object):
         self._metadata_refresh_in_progress = False
         self._conns = {}
         self._connecting = set()
+        self._selector = selectors.DefaultSelector()
         self._delayed_tasks = DelayedTaskQueue()
+        self._idle_reap_at = None # when _reap_idle_connections is scheduled
         self._last_bootstrap = 0
         self._bootstrap_fails = 0
         self._bootstrap(collect_hosts(self.config['bootstrap_servers']))
@@ -103,36 +134,79 @@ class KafkaClient(object):
             time.sleep(next_at - now)
         self._last_bootstrap = time.time()
 
+        # Happy-eyeballs style: connects to the bootstrap hosts are started
+        # bootstrap_connect_stagger_ms apart (or as soon as every earlier
+        # attempt has failed) and run concurrently. The first to connect is
+        # sent the MetadataRequest, and the rest are abandoned once one
+        # answers, so a black-holed host does not hold up startup.
         metadata_request = MetadataRequest([])
-        for host, port in hosts:
-            log.debug("Attempting to bootstrap via node at %s:%s", host, port)
-            bootstrap = BrokerConnection(host, port, **self.config)
-            bootstrap.connect()
-            while bootstrap.state is ConnectionStates.CONNECTING:
-                bootstrap.connect()
-            if bootstrap.state is not ConnectionStates.CONNECTED:
-                bootstrap.close()
-                continue
-            future = bootstrap.send(metadata_request)
-            while not future.is_done:
-                bootstrap.recv()
-            if future.failed():
-                bootstrap.close()
-                continue
-            self.cluster.update_metadata(future.value)
+        pending = list(hosts)
+        stagger = self.config['bootstrap_connect_stagger_ms'] / 1000.0
+        attempts = [] # started connections that have not failed yet
+        next_start_at = 0
+        bootstrap = None
+        while bootstrap is None and (pending or attempts):
+            if pending and (not attempts or time.time() >= next_start_at):
+                host, port = pending.pop(0)
+                log.debug("Attempting to bootstrap via node at %s:%s", host, port)
+                attempts.append(BrokerConnection(host, port, **self.config))
+                attempts[-1].connect()
+                next_start_at = time.time() + stagger
+
+            for conn in list(attempts):
+                if conn.state is ConnectionStates.CONNECTING:
+                    conn.connect()
+                if conn.state is ConnectionStates.CONNECTED:
+                    attempts.remove(conn)
+                    if self._bootstrap_metadata(conn, metadata_request):
+                        bootstrap = conn
+                        break
+                elif conn.state is ConnectionStates.DISCONNECTED:
+                    attempts.remove(conn)
+                    conn.close()
+            else:
+                # wait for a connect to complete, or the next one to start
+                if pending:
+                    timeout = max(0, next_start_at - time.time())
+                else:
+                    timeout = self.config['request_timeout_ms'] / 1000.0
+                socks = [conn._sock for conn in attempts]
+                if socks:
+                    select.select([], socks, socks, timeout)
+
+        for conn in attempts:
+            log.debug("Abandoning bootstrap connection to %s", conn)
+            conn.close()
 
+        if bootstrap is not None:
             # A cluster with no topics can return no broker metadata
             # in that case, we should keep the bootstrap connection
             if not len(self.cluster.brokers()):
                 self._conns['bootstrap'] = bootstrap
+                bootstrap.config['state_change_callback'] = functools.partial(
+                    self._conn_state_change, 'bootstrap')
+                self._conn_state_change('bootstrap', bootstrap)
+                self._schedule_idle_reaper()
             self._bootstrap_fails = 0
-            break
         # No bootstrap found...
         else:
             log.error('Unable to bootstrap from %s', hosts)
             # Max exponential backoff is 2^12, x4000 (50ms -> 200s)
             self._bootstrap_fails = min(self._bootstrap_fails + 1, 12)
 
+    def _bootstrap_metadata(self, conn, metadata_request):
+        """Send metadata_request on a connected bootstrap connection and
+        wait for the response. Returns True if cluster metadata was
+        updated, else closes the connection and returns False."""
+        future = conn.send(metadata_request)
+        while not future.is_done:
+            conn.recv(self.config['request_timeout_ms'] / 1000.0)
+        if future.failed():
+            conn.close()
+            return False
+        self.cluster.update_metadata(future.value)
+        return True
+
     def _can_connect(self, node_id):
         if node_id not in self._conns:
             if self.cluster.broker_metadata(node_id):
@@ -149,10 +223,43 @@ class KafkaClient(object):
 
             log.debug("Initiating connection to node %s at %s:%s",
                       node_id, broker.host, broker.port)
+            cb = functools.partial(self._conn_state_change, node_id)
             self._conns[node_id] = BrokerConnection(broker.host, broker.port,
+                                                    state_change_callback=cb,
                                                     **self.config)
+            self._schedule_idle_reaper()
         return self._finish_connect(node_id)
 
+    def _conn_state_change(self, node_id, conn):
+        """Keep the selector registration of a connection's socket in step
+        with its state: writable interest while connecting (to learn when the
+        connect completes), readable interest once connected, plus writable
+        interest while it has buffered request bytes to send"""
+        if conn.state is ConnectionStates.CONNECTING:
+            events = selectors.EVENT_WRITE
+        elif conn.state is ConnectionStates.CONNECTED:
+            events = selectors.EVENT_READ
+            if conn.has_pending_sends():
+                events |= selectors.EVENT_WRITE
+        else:
+            if self._selector is not None:
+                try:
+                    self._selector.unregister(conn._sock)
+                except (KeyError, ValueError):
+                    pass
+            return
+        selector = self._get_selector()
+        try:
+            selector.modify(conn._sock, events, (node_id, conn))
+        except KeyError:
+            selector.register(conn._sock, events, (node_id, conn))
+
+    def _get_selector(self):
+        """Return the selector, creating a new one if close() closed it"""
+        if self._selector is None:
+            self._selector = selectors.DefaultSelector()
+        return self._selector
+
     def _finish_connect(self, node_id):
         assert node_id in self._conns, '%s is not in current conns' % node_id
         state = self._conns[node_id].connect()
@@ -192,6 +299,9 @@ class KafkaClient(object):
 
     def close(self, node_id=None):
         """Closes the connection to a particular node (if there is one).
+        With no node_id, closes all connections and the selector. The client
+        can still be used afterwards: connections are re-opened on demand,
+        and a new selector is created for them.
 
         Arguments:
             node_id (int): the id of the node to close
@@ -199,12 +309,61 @@ class KafkaClient(object):
         if node_id is None:
             for conn in self._conns.values():
                 conn.close()
+            if self._selector is not None:
+                self._selector.close()
+                self._selector = None
         elif node_id in self._conns:
             self._conns[node_id].close()
         else:
             log.warning("Node %s not found in current connection list; skipping", node_id)
             return
 
+    def _schedule_idle_reaper(self, at=None):
+        """Schedule _reap_idle_connections, unless it is already scheduled.
+        A new connection is the most recently used, so it never expires
+        before an already scheduled run."""
+        if self.config['connections_max_idle_ms'] is None:
+            return
+        if self._idle_reap_at is None:
+            if at is None:
+                at = time.time() + self.config['connections_max_idle_ms'] / 1000.0
+            self._idle_reap_at = at
+            self.schedule(self._reap_idle_connections, at)
+
+    def _reap_idle_connections(self):
+        """Close and forget connections idle for connections_max_idle_ms
+
+        Connections are checked least recently used first, stopping at the
+        first that has not expired. Connections with in-flight requests,
+        unsent bytes or a connect in progress are left alone. A reaped node
+        is reconnected lazily, by ready(), from the cluster metadata. The
+        task reschedules itself for when the next connection would expire.
+        """
+        self._idle_reap_at = None
+        max_idle = self.config['connections_max_idle_ms'] / 1000.0
+        now = time.time()
+        next_at = None
+        lru = sorted(self._conns.items(), key=lambda item: item[1].last_activity)
+        for node_id, conn in lru:
+            expire_at = conn.last_activity + max_idle
+            if (conn.in_flight_requests or conn.has_pending_sends() or
+                    conn.state is ConnectionStates.CONNECTING):
+                continue
+            if expire_at > now:
+                next_at = expire_at
+                break
+            log.debug('Closing connection to node %s, idle for %0.1f seconds',
+                      node_id, now - conn.last_activity)
+            conn.close()
+            del self._conns[node_id]
+            self._connecting.discard(node_id)
+        else:
+            if self._conns:
+                # only busy connections left: check again in max_idle
+                next_at = now + max_idle
+        if next_at is not None:
+            self._schedule_idle_reaper(next_at)
+
     def is_disconnected(self, node_id):
         """Check whether the node connection has been disconnected failed.
 
@@ -271,7 +430,12 @@ class KafkaClient(object):
         if isinstance(request, ProduceRequest) and request.required_acks == 0:
             expect_response = False
 
-        return self._conns[node_id].send(request, expect_response=expect_response)
+        conn = self._conns[node_id]
+        future = conn.send(request, expect_response=expect_response)
+        if conn.has_pending_sends():
+            # the rest is written from _poll once the socket is writable
+            self._conn_state_change(node_id, conn)
+        return future
 
     def poll(self, timeout_ms=None, future=None):
         """Try to read and write to sockets.
@@ -335,31 +499,40 @@ class KafkaClient(object):
         return responses
 
     def _poll(self, timeout):
-        # select on reads across all connected sockets, blocking up to timeout
-        sockets = dict([(conn._sock, conn)
-                        for conn in six.itervalues(self._conns)
-                        if conn.state is ConnectionStates.CONNECTED
-                        and conn.in_flight_requests])
-        if not sockets:
-            # if sockets are connecting, we can wake when they are writeable
-            if self._connecting:
-                sockets = [self._conns[node]._sock for node in self._connecting]
-                select.select([], sockets, [], timeout)
-            elif timeout:
-                log.warning('_poll called with a timeout, but nothing to do'
-                            ' -- this can cause high CPU usage during idle')
-            return []
-
-        ready, _, _ = select.select(list(sockets.keys()), [], [], timeout)
+        # sockets stay registered with the selector across polls (see
+        # _conn_state_change), so there is no per-poll setup cost
+        ready = self._get_selector().select(timeout)
 
         responses = []
-        for sock in ready:
-            conn = sockets[sock]
-            while conn.in_flight_requests:
-                response = conn.recv() # Note: conn.recv runs callbacks / errbacks
-                if not response:
-                    break
-                responses.append(response)
+        for key, events in ready:
+            if key.data is None: # wakeup socket, see ThreadedKafkaClient
+                continue
+            node_id, conn = key.data
+            if conn.state is ConnectionStates.CONNECTING:
+                self._finish_connect(node_id)
+                continue
+
+            if events & selectors.EVENT_WRITE and conn.connected():
+                conn.send_pending_requests()
+                self._conn_state_change(node_id, conn)
+            if not events & selectors.EVENT_READ or not conn.connected():
+                continue
+
+            if not conn.in_flight_requests:
+                # Readable without an in-flight request: either the broker
+                # closed the connection or the protocol is out of sync.
+                # Either way the connection can no longer be used.
+                try:
+                    if key.fileobj.recv(1):
+                        log.warning('Protocol out of sync on %r, closing', conn)
+                except socket.error:
+                    pass
+                conn.close(Errors.ConnectionError(
+                    'Socket EVENT_READ without in-flight-requests'))
+                continue
+
+            # one recv drains every complete response the socket has ready
+            responses.extend(conn.recv()) # Note: conn.recv runs callbacks / errbacks
         return responses
 
     def in_flight_request_count(self, node_id=None):
@@ -507,8 +680,26 @@ class KafkaClient(object):
         self._delayed_tasks.remove(task)
 
     def check_version(self, node_id=None):
-        """Attempt to guess the broker version"""
+        """Attempt to guess the broker version
+
+        Probing takes up to a few seconds, so when no node_id is given the
+        result is cached for the bootstrap_servers cluster for
+        api_version_cache_ttl_ms (see ApiVersionCache). A cached version is
+        returned straight away and revalidated in the background by the next
+        poll(), with a single request that only that broker version or newer
+        understands.
+        """
+        cache_key = None
         if node_id is None:
+            cache_key = ApiVersionCache.key(self.config['bootstrap_servers'])
+            version = _api_version_cache.get(
+                cache_key, self.config['api_version_cache_ttl_ms'] / 1000.0,
+                self.config['api_version_cache_file'])
+            if version is not None:
+                log.info('Broker version identified as %s (cached)', version)
+                self.schedule(functools.partial(
+                    self._revalidate_version, cache_key, version), time.time())
+                return version
             node_id = self.least_loaded_node()
 
         def connect():
@@ -523,22 +714,8 @@ class KafkaClient(object):
         # kafka kills the connection when it doesnt recognize an API request
         # so we can send a test request and then follow immediately with a
         # vanilla MetadataRequest. If the server did not recognize the first
-        # request, both will be failed with a ConnectionError that wraps
-        # socket.error (32 or 54)
-        import socket
-        from .protocol.admin import ListGroupsRequest
-        from .protocol.commit import (
-            OffsetFetchRequest_v0, GroupCoordinatorRequest)
-        from .protocol.metadata import MetadataRequest
-
-        test_cases = [
-            ('0.9', ListGroupsRequest()),
-            ('0.8.2', GroupCoordinatorRequest('kafka-python-default-group')),
-            ('0.8.1', OffsetFetchRequest_v0('kafka-python-default-group', [])),
-            ('0.8.0', MetadataRequest([])),
-        ]
-
-        for version, request in test_cases:
+        # request, both will be failed with a ConnectionError
+        def probe(version, request):
             connect()
             f = self.send(node_id, request)
             time.sleep(0.5)
@@ -548,17 +725,381 @@ class KafkaClient(object):
             assert f.is_done
 
             if f.succeeded():
-                log.info('Broker version identifed as %s', version)
-                return version
+                return True
 
-            if six.PY2:
-                assert isinstance(f.exception.args[0], socket.error)
-                assert f.exception.args[0].errno in (32, 54)
-            else:
-                assert isinstance(f.exception.args[0], ConnectionError)
+            # the broker closing the connection (reset, broken pipe or EOF,
+            # depending on timing) means it did not recognize the request
+            if not isinstance(f.exception, Errors.ConnectionError):
+                raise f.exception
             log.info("Broker is not v%s -- it did not recognize %s",
                      version, request.__class__.__name__)
-            continue
+            return False
+
+        # every failed probe costs a reconnect, so brokers older than 0.9 are
+        # not sent the 0.10 ApiVersionRequest: it is only tried once the
+        # broker has accepted the 0.9 probe
+        probes = _version_probes()
+        (newest, newest_request), probes = probes[0], probes[1:]
+        for version, request in probes:
+            if probe(version, request):
+                if version == '0.9' and probe(newest, newest_request):
+                    version = newest
+                break
+        else:
+            return None
+
+        log.info('Broker version identifed as %s', version)
+        if cache_key is not None:
+            _api_version_cache.put(cache_key, version,
+                                   self.config['api_version_cache_file'])
+        return version
+
+    def _revalidate_version(self, cache_key, version, conn=None, future=None):
+        """Send the probe request for a cached broker version, refreshing the
+        cache entry if the broker accepts it and dropping it if not.
+
+        The probe is sent on a dedicated connection, so that a broker hanging
+        up on it does not fail requests in flight on the shared ones. Runs as
+        a scheduled task that never blocks: it reschedules itself until the
+        connection is up and the probe has been answered."""
+        retry_at = time.time() + self.config['retry_backoff_ms'] / 1000.0
+        if conn is None:
+            node_id = self.least_loaded_node()
+            if node_id in self._conns:
+                broker = self._conns[node_id] # has host and port too
+            else:
+                broker = self.cluster.broker_metadata(node_id)
+            if broker is None:
+                self.schedule(functools.partial(
+                    self._revalidate_version, cache_key, version), retry_at)
+                return
+            conn = BrokerConnection(broker.host, broker.port, **self.config)
+
+        if future is None:
+            conn.connect()
+            if conn.state is ConnectionStates.DISCONNECTED:
+                # could not connect at all: no verdict on the version yet
+                conn.close()
+                self.schedule(functools.partial(
+                    self._revalidate_version, cache_key, version), retry_at)
+                return
+            elif conn.state is ConnectionStates.CONNECTING:
+                self.schedule(functools.partial(
+                    self._revalidate_version, cache_key, version, conn),
+                    retry_at)
+                return
+            cache_file = self.config['api_version_cache_file']
+
+            def revalidated(response):
+                conn.close()
+                _api_version_cache.put(cache_key, version, cache_file)
+
+            def failed(error):
+                conn.close()
+                log.warning('Cached broker version %s for %s could not be'
+                            ' revalidated (%s); dropping it', version,
+                            cache_key, error)
+                _api_version_cache.remove(cache_key, cache_file)
+
+            future = conn.send(dict(_version_probes())[version])
+            future.add_callback(revalidated)
+            future.add_errback(failed)
+
+        if not future.is_done:
+            conn.recv()
+        if not future.is_done:
+            self.schedule(functools.partial(
+                self._revalidate_version, cache_key, version, conn, future),
+                retry_at)
+
+
+class ThreadedKafkaClient(KafkaClient):
+    """A KafkaClient that can be shared by threads
+
+    A background network thread owns the selector and the connections and
+    drives poll(). send() may be called from any thread: it queues the
+    request, wakes the network thread through a self-pipe (a socketpair
+    registered with the selector) and returns a Future, which is completed
+    on the network thread once the node is connected and has responded.
+
+    Called from other threads, poll() does no network i/o: it waits up to
+    timeout_ms for the given future, or for the network thread to finish a
+    round of i/o, and always returns an empty list (responses are delivered through futures).
+    schedule() and close() are thread-safe too; close() with no node_id
+    stops the network thread and is final: unlike KafkaClient, the client
+    cannot be used afterwards. Other methods that touch connection state
+    (ready(), least_loaded_node(), check_version(), ...) are only safe on
+    the network thread, e.g. from future callbacks or scheduled tasks.
+
+    Keyword Arguments:
+        see KafkaClient
+    """
+    def __init__(self, **configs):
+        super(ThreadedKafkaClient, self).__init__(**configs)
+        self._requests = collections.deque() # queued by send(), any thread
+        self._calls = collections.deque() # (function, future) for the thread
+        self._waiting = [] # requests whose node is not ready yet
+        self._io_done = threading.Condition()
+        self._closed = False
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._io_thread = threading.Thread(target=self._run,
+                                           name='kafka-python-network-thread')
+        self._io_thread.daemon = True
+        self._io_thread.start()
+
+    def _on_io_thread(self):
+        # until the thread starts (i.e. during bootstrap), the constructing
+        # thread owns the connections
+        io_thread = getattr(self, '_io_thread', None)
+        return io_thread is None or threading.current_thread() is io_thread
+
+    def wakeup(self):
+        """Interrupt a network thread blocked in select"""
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass # the socketpair is full, so a wakeup is pending anyway
+
+    def send(self, node_id, request):
+        """Queue a request for a node, connecting to it if needed
+
+        Unlike KafkaClient.send, this does not raise if the node is not
+        ready: the returned future fails with NodeNotReadyError if the node
+        cannot be sent to within request_timeout_ms.
+
+        Returns:
+            Future: resolves to Response struct, on the network thread
+        """
+        if self._on_io_thread():
+            return super(ThreadedKafkaClient, self).send(node_id, request)
+        return self._queue(self._requests, node_id, request, time.time())
+
+    def poll(self, timeout_ms=None, future=None):
+        if self._on_io_thread():
+            return super(ThreadedKafkaClient, self).poll(timeout_ms, future)
+        if timeout_ms is None:
+            timeout_ms = self.config['request_timeout_ms']
+        with self._io_done:
+            if future is None:
+                self._io_done.wait(timeout_ms / 1000.0)
+            else:
+                # every round of i/o wakes us: wait out what is left of
+                # timeout_ms, not a fresh timeout_ms each time
+                deadline = time.time() + timeout_ms / 1000.0
+                while not future.is_done and self._io_thread.is_alive():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._io_done.wait(remaining)
+        return []
+
+    def close(self, node_id=None):
+        """Close the connection to a node, or, with no node_id, stop the
+        network thread and close all connections"""
+        if node_id is not None:
+            if self._on_io_thread():
+                super(ThreadedKafkaClient, self).close(node_id)
+            else:
+                self.schedule(functools.partial(
+                    KafkaClient.close, self, node_id), 0)
+            return
+        self._closed = True
+        if self._on_io_thread():
+            return # _run cleans up when the current poll returns
+        self.wakeup()
+        self._io_thread.join()
+
+    def schedule(self, task, at):
+        if self._on_io_thread():
+            return super(ThreadedKafkaClient, self).schedule(task, at)
+        # DelayedTaskQueue is not thread-safe: have the thread add the task
+        return self._queue(self._calls, functools.partial(
+            KafkaClient.schedule, self, task, at))
+
+    def _queue(self, queue, *item):
+        """Append item + (future,) to queue for the network thread and
+        return the future"""
+        future = Future()
+        # under the lock, so that _shutdown cannot miss the item
+        with self._io_done:
+            if self._closed:
+                return future.failure(
+                    Errors.IllegalStateError('Client is closed'))
+            queue.append(item + (future,))
+        self.wakeup()
+        return future
+
+    def _run(self):
+        try:
+            while not self._closed:
+                try:
+                    self._send_queued()
+                    # with requests waiting for a node, recheck it regularly
+                    timeout_ms = None
+                    if self._waiting:
+                        timeout_ms = self.config['retry_backoff_ms']
+                    super(ThreadedKafkaClient, self).poll(timeout_ms)
+                    self._clear_wakeups()
+                except Exception:
+                    log.exception('Error in network thread')
+                with self._io_done:
+                    self._io_done.notify_all()
+        finally:
+            self._shutdown()
+
+    def _send_queued(self):
+        while self._calls:
+            function, future = self._calls.popleft()
+            try:
+                function().chain(future)
+            except Exception as e:
+                future.failure(e)
+        while self._requests:
+            self._waiting.append(self._requests.popleft())
+
+        timeout = self.config['request_timeout_ms'] / 1000.0
+        waiting, self._waiting = self._waiting, []
+        for node_id, request, queued_at, future in waiting:
+            if self.ready(node_id):
+                try:
+                    KafkaClient.send(self, node_id, request).chain(future)
+                except Exception as e:
+                    future.failure(e)
+            elif time.time() >= queued_at + timeout:
+                future.failure(Errors.NodeNotReadyError(node_id))
+            else:
+                self._waiting.append((node_id, request, queued_at, future))
+
+    def _clear_wakeups(self):
+        try:
+            while self._wake_r.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def _shutdown(self):
+        with self._io_done:
+            self._closed = True
+            queued = list(itertools.chain(
+                self._waiting, self._requests, self._calls))
+            self._waiting = []
+            self._requests.clear()
+            self._calls.clear()
+        for item in queued:
+            item[-1].failure(Errors.Cancelled('Client is closed'))
+        self._selector.unregister(self._wake_r)
+        KafkaClient.close(self)
+        self._wake_r.close()
+        self._wake_w.close()
+        with self._io_done:
+            self._io_done.notify_all()
+
+
+def _version_probes():
+    """(version, request) pairs, newest first: each request is understood
+    by brokers of that version and newer"""
+    return [
+        ('0.10', ApiVersionRequest()),
+        ('0.9', ListGroupsRequest()),
+        ('0.8.2', GroupCoordinatorRequest('kafka-python-default-group')),
+        ('0.8.1', OffsetFetchRequest_v0('kafka-python-default-group', [])),
+        ('0.8.0', MetadataRequest([])),
+    ]
+
+
+class ApiVersionCache(object):
+    """Broker versions detected by KafkaClient.check_version, per cluster
+
+    Entries are kept in memory for the life of the process and, when a
+    cache file is given, also in that JSON file, so that short-lived
+    processes can skip version probing. Clusters are keyed by their sorted
+    bootstrap servers. The file is rewritten atomically; errors reading or
+    writing it are logged and otherwise ignored.
+    """
+    def __init__(self):
+        self._versions = {} # cluster key -> (version, detected_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(bootstrap_servers):
+        hosts = collect_hosts(bootstrap_servers, randomize=False)
+        return ','.join(sorted(['%s:%d' % (host, port) for host, port in hosts]))
+
+    def get(self, key, ttl, path=None):
+        """Return the cached version for key, or None if unknown or older
+        than ttl seconds"""
+        with self._lock:
+            entry = self._versions.get(key)
+            if (entry is None or entry[1] + ttl < time.time()) and path:
+                entry = self._read(path).get(key)
+                if entry is not None:
+                    self._versions[key] = entry
+        if entry is None or entry[1] + ttl < time.time():
+            return None
+        return entry[0]
+
+    def put(self, key, version, path=None):
+        with self._lock:
+            self._versions[key] = (version, time.time())
+            if path:
+                self._write(path, key, self._versions[key])
+
+    def remove(self, key, path=None):
+        with self._lock:
+            self._versions.pop(key, None)
+            if path:
+                self._write(path, key, None)
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+            if not isinstance(entries, dict):
+                raise ValueError('expected a JSON object')
+        except (IOError, OSError, ValueError) as e:
+            if not isinstance(e, (IOError, OSError)) or e.errno != errno.ENOENT:
+                log.warning('Ignoring api version cache file %s: %s', path, e)
+            return {}
+
+        # entries for versions we cannot probe (written by another release,
+        # or edited by hand) are treated as cache misses
+        known = [version for version, _ in _version_probes()]
+        versions = {}
+        for key, entry in entries.items():
+            try:
+                version, detected_at = entry
+                detected_at = float(detected_at)
+            except (TypeError, ValueError):
+                version = None
+            if version not in known:
+                log.warning('Ignoring api version cache entry for %s: %r',
+                            key, entry)
+                continue
+            versions[key] = (version, detected_at)
+        return versions
+
+    def _write(self, path, key, entry):
+        versions = self._read(path)
+        if entry is None:
+            versions.pop(key, None)
+        else:
+            versions[key] = entry
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(versions, f)
+            if os.name == 'nt' and os.path.exists(path):
+                os.remove(path) # rename does not replace on windows
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning('Unable to write api version cache file %s: %s',
+                        path, e)
+
+
+_api_version_cache = ApiVersionCache()
 
 
 class DelayedTaskQueue(object):
@@ -1,11 +1,21 @@
-import gzip
+import collections
 from io import BytesIO
 import struct
+import zlib
 
+import six
 from six.moves import xrange
 
+from kafka.common import UnsupportedCodecError
+
 _XERIAL_V1_HEADER = (-126, b'S', b'N', b'A', b'P', b'P', b'Y', 0, 1, 1)
 _XERIAL_V1_FORMAT = 'bccccccBii'
+_XERIAL_V1_HEADER_SIZE = 16
+_XERIAL_BLOCK_SIZE = struct.Struct('!i')
+_XERIAL_DEFAULT_BLOCK_SIZE = 32 * 1024
+
+_GZIP_WBITS = 16 + zlib.MAX_WBITS # gzip header and trailer
+_GZIP_DEFAULT_COMPRESSLEVEL = 6
 
 try:
     import snappy
@@ -13,6 +23,16 @@ try:
 except ImportError:
     _HAS_SNAPPY = False
 
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 
 def has_gzip():
     return True
@@ -22,47 +42,55 @@ def has_snappy():
     return _HAS_SNAPPY
 
 
-def gzip_encode(payload, compresslevel=None):
-    if not compresslevel:
-        compresslevel = 9
+def has_lz4():
+    # xxhash is needed to produce / accept the frame header checksum
+    # that 0.8 and 0.9 brokers expect (see lz4_encode_old_kafka)
+    return lz4 is not None and xxhash is not None
 
-    with BytesIO() as buf:
 
-        # Gzip context manager introduced in python 2.6
-        # so old-fashioned way until we decide to not support 2.6
-        gzipper = gzip.GzipFile(fileobj=buf, mode="w", compresslevel=compresslevel)
-        try:
-            gzipper.write(payload)
-        finally:
-            gzipper.close()
+def gzip_encode(payload, compresslevel=None):
+    """Compress payload into a single gzip member.
 
-        result = buf.getvalue()
+    The default compresslevel (6) is the zlib / Kafka JVM client default;
+    level 9 costs far more CPU for a marginally better ratio.
+    """
+    if not compresslevel:
+        compresslevel = _GZIP_DEFAULT_COMPRESSLEVEL
 
-    return result
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(payload) + compressor.flush()
 
 
 def gzip_decode(payload):
-    with BytesIO(payload) as buf:
-
-        # Gzip context manager introduced in python 2.6
-        # so old-fashioned way until we decide to not support 2.6
-        gzipper = gzip.GzipFile(fileobj=buf, mode='r')
-        try:
-            result = gzipper.read()
-        finally:
-            gzipper.close()
+    """Decompress all gzip members in payload into a single bytes object.
 
-    return result
+    Concatenated gzip members are decoded in order; trailing NUL padding is
+    ignored.
 
-
-def snappy_encode(payload, xerial_compatible=False, xerial_blocksize=32*1024):
+    Raises:
+        IOError: if the payload is truncated
+    """
+    chunks = []
+    while payload:
+        decompressor = zlib.decompressobj(_GZIP_WBITS)
+        chunks.append(decompressor.decompress(payload))
+        chunks.append(decompressor.flush())
+        # decompressobj.eof is python 3.3+
+        if not getattr(decompressor, 'eof', True):
+            raise IOError('Truncated gzip payload')
+        payload = decompressor.unused_data.lstrip(b'\x00')
+    return b''.join(chunks)
+
+
+def snappy_encode(payload, xerial_compatible=False, xerial_blocksize=None):
     """Encodes the given data with snappy compression.
 
     If xerial_compatible is set then the stream is encoded in a fashion
     compatible with the xerial snappy library.
 
     The block size (xerial_blocksize) controls how frequent the blocking occurs
-    32k is the default in the xerial library.
+    and defaults to the buffer_size of the registered snappy codec; 32k is the
+    default in the xerial library.
 
     The format winds up being:
 
@@ -85,6 +113,10 @@ def snappy_encode(payload, xerial_compatible=False, xerial_blocksize=32*1024):
         raise NotImplementedError("Snappy codec is not available")
 
     if xerial_compatible:
+        if not xerial_blocksize:
+            xerial_blocksize = (_CODECS[0x02].buffer_size
+                                or _XERIAL_DEFAULT_BLOCK_SIZE)
+
         def _chunker():
             for i in xrange(0, len(payload), xerial_blocksize):
                 yield payload[i:i+xerial_blocksize]
@@ -130,32 +162,179 @@ def _detect_xerial_stream(payload):
         1.
     """
 
-    if len(payload) > 16:
-        header = struct.unpack('!' + _XERIAL_V1_FORMAT, bytes(payload)[:16])
+    if len(payload) > _XERIAL_V1_HEADER_SIZE:
+        header = struct.unpack_from('!' + _XERIAL_V1_FORMAT, payload)
         return header == _XERIAL_V1_HEADER
     return False
 
 
+def _xerial_blocks(view):
+    """Yield (start, end) offsets of each xerial block in view"""
+    length = len(view)
+    cursor = _XERIAL_V1_HEADER_SIZE
+    while cursor < length:
+        block_size, = _XERIAL_BLOCK_SIZE.unpack_from(view, cursor)
+        cursor += _XERIAL_BLOCK_SIZE.size
+        end = min(cursor + block_size, length)
+        yield cursor, end
+        cursor = end
+
+
+def _xerial_decode(payload):
+    """Decode a xerial block stream into a single bytes object
+
+    The framing is walked in place with unpack_from offsets over a memoryview
+    of payload, so compressed blocks are not sliced out of the payload. Each
+    decompressed block is a separate bytes object; they are copied once into
+    the result by b''.join.
+    """
+    view = memoryview(payload)
+    blocks = []
+    for start, end in _xerial_blocks(view):
+        block = view[start:end]
+        if six.PY2: # python-snappy on py2 cannot read memoryviews
+            block = block.tobytes()
+        blocks.append(snappy.decompress(block))
+    return b''.join(blocks)
+
+
 def snappy_decode(payload):
     if not has_snappy():
         raise NotImplementedError("Snappy codec is not available")
 
     if _detect_xerial_stream(payload):
-        # TODO ? Should become a fileobj ?
-        out = BytesIO()
-        byt = payload[16:]
-        length = len(byt)
-        cursor = 0
-
-        while cursor < length:
-            block_size = struct.unpack_from('!i', byt[cursor:])[0]
-            # Skip the block size
-            cursor += 4
-            end = cursor + block_size
-            out.write(snappy.decompress(byt[cursor:end]))
-            cursor = end
-
-        out.seek(0)
-        return out.read()
+        return _xerial_decode(payload)
     else:
         return snappy.decompress(payload)
+
+
+def lz4_encode(payload, compresslevel=None):
+    """Encode payload as a single LZ4 frame.
+
+    Kafka only supports independent 64KB blocks and no content size.
+    compresslevel is passed to lz4 as compression_level (0, the default, is
+    the fast mode; 3 and above use LZ4-HC).
+    """
+    if lz4 is None:
+        raise NotImplementedError("LZ4 codec is not available")
+    return lz4.compress(payload, compression_level=compresslevel or 0,
+                        block_size=lz4.BLOCKSIZE_MAX64KB,
+                        block_linked=False, store_size=False)
+
+
+def lz4_decode(payload):
+    if lz4 is None:
+        raise NotImplementedError("LZ4 codec is not available")
+    return lz4.decompress(payload)
+
+
+def _lz4_header_size(payload):
+    # magic (4) + FLG + BD + HC, plus 8 bytes if the content size flag is set
+    flg = bytearray(payload[4:5])[0]
+    if flg & 0x08:
+        return 15
+    return 7
+
+
+def _lz4_header_checksum(descriptor):
+    """Second byte of xxh32(descriptor), as defined by the LZ4 frame format"""
+    return xxhash.xxh32(descriptor).digest()[2:3]
+
+
+def lz4_encode_old_kafka(payload, compresslevel=None):
+    """Encode payload as an LZ4 frame for 0.8 / 0.9 brokers.
+
+    Brokers before KIP-57 compute the frame header checksum over the magic
+    number as well as the frame descriptor, and reject correct frames.
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+    data = lz4_encode(payload, compresslevel=compresslevel)
+    header_size = _lz4_header_size(data)
+    return b''.join([
+        data[:header_size - 1],
+        _lz4_header_checksum(data[:header_size - 1]),
+        data[header_size:]
+    ])
+
+
+def lz4_decode_old_kafka(payload):
+    """Decode an LZ4 frame written by (or for) 0.8 / 0.9 brokers.
+
+    The header checksum is recomputed the standard way before decoding.
+    """
+    if not has_lz4():
+        raise NotImplementedError("LZ4 codec is not available")
+    header_size = _lz4_header_size(payload)
+    return lz4_decode(b''.join([
+        payload[:header_size - 1],
+        _lz4_header_checksum(payload[4:header_size - 1]),
+        payload[header_size:]
+    ]))
+
+
+Codec = collections.namedtuple('Codec',
+    ['codec_id', 'name', 'encode', 'decode', 'available', 'buffer_size'])
+
+_CODECS = {} # {codec_id: Codec}
+
+
+def register_codec(codec_id, name, encode, decode, available=None,
+                   buffer_size=None):
+    """Register the implementation used for a message codec id.
+
+    Replaces any codec already registered for codec_id, so that alternate
+    implementations (a native binding, a tuned compression level) can be
+    swapped in per deployment. Message.decompress and the legacy
+    create_*_message / create_message_set helpers all dispatch through
+    this registry, except for magic 1 LZ4 messages, which always use
+    lz4_encode / lz4_decode (the registered lz4 codec implements the
+    non-standard framing of magic 0 messages).
+
+    Arguments:
+        codec_id (int): codec bits of the message attributes, e.g. 0x01
+        name (str): short codec name, used in logging and errors
+        encode (callable): encode(payload, compresslevel=None) -> bytes
+        decode (callable): decode(payload) -> bytes
+        available (callable, optional): returns True if the codec can be
+            used in this environment. Default: always available.
+        buffer_size (int, optional): preferred block size in bytes for
+            codecs that split their output into blocks, e.g. the xerial
+            snappy block size. Default: None (unblocked).
+
+    Returns:
+        Codec: the registered codec
+    """
+    if available is None:
+        available = lambda: True
+    codec = Codec(codec_id, name, encode, decode, available, buffer_size)
+    _CODECS[codec_id] = codec
+    return codec
+
+
+def get_codec(codec_id):
+    """Return the Codec registered for codec_id.
+
+    Raises:
+        UnsupportedCodecError: if no codec is registered for codec_id
+    """
+    try:
+        return _CODECS[codec_id]
+    except KeyError:
+        raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec_id)
+
+
+def has_codec(codec_id):
+    """Return True if codec_id is registered and available."""
+    return codec_id in _CODECS and _CODECS[codec_id].available()
+
+
+def _snappy_encode(payload, compresslevel=None):
+    return snappy_encode(payload)
+
+
+register_codec(0x01, 'gzip', gzip_encode, gzip_decode, has_gzip)
+register_codec(0x02, 'snappy', _snappy_encode, snappy_decode, has_snappy,
+               _XERIAL_DEFAULT_BLOCK_SIZE)
+register_codec(0x03, 'lz4', lz4_encode_old_kafka, lz4_decode_old_kafka,
+               has_lz4)
@@ -70,7 +70,8 @@ OffsetAndMessage = namedtuple("OffsetAndMessage",
     ["offset", "message"])
 
 Message = namedtuple("Message",
-    ["magic", "attributes", "key", "value"])
+    ["magic", "attributes", "key", "value", "timestamp"])
+Message.__new__.__defaults__ = (None,) # timestamp is only set for magic 1
 
 TopicPartition = namedtuple("TopicPartition",
     ["topic", "partition"])
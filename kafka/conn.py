@@ -1,8 +1,8 @@
 import collections
 import copy
 import errno
+import itertools
 import logging
-import io
 from random import shuffle
 from select import select
 import socket
@@ -15,8 +15,15 @@ import six
 
 import kafka.common as Errors
 from kafka.future import Future
-from kafka.protocol.api import RequestHeader
+from kafka.protocol.api import (
+    RequestHeader, encode_request, encode_request_buffers
+)
+from kafka.protocol.buffer import (
+    HAS_MEMORYVIEW, MemoryViewReader, as_memoryview, is_exported, release
+)
 from kafka.protocol.commit import GroupCoordinatorResponse
+from kafka.protocol.message import Message
+from kafka.protocol.produce import ProduceRequest
 from kafka.protocol.types import Int32
 from kafka.version import __version__
 
@@ -30,6 +37,9 @@ log = logging.getLogger(__name__)
 DEFAULT_SOCKET_TIMEOUT_SECONDS = 120
 DEFAULT_KAFKA_PORT = 9092
 
+# socket.sendmsg (scatter/gather writes) is python 3.3+ on unix
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
 
 class ConnectionStates(object):
     DISCONNECTED = '<disconnected>'
@@ -42,6 +52,9 @@ InFlightRequest = collections.namedtuple('InFlightRequest',
 
 
 class BrokerConnection(object):
+    MAX_RECV_BYTES = 1048576 # per recv() call, so one socket cannot starve others
+    MAX_SEND_BUFFERS = 512 # per sendmsg() call, below the usual IOV_MAX of 1024
+    MIN_REF_SIZE = 4096 # bytes values at least this large are sent by reference
     DEFAULT_CONFIG = {
         'client_id': 'kafka-python-' + __version__,
         'request_timeout_ms': 40000,
@@ -50,6 +63,7 @@ class BrokerConnection(object):
         'receive_buffer_bytes': 32768,
         'send_buffer_bytes': 131072,
         'api_version': (0, 8, 2),  # default to most restrictive
+        'state_change_callback': lambda conn: True, # called on state changes
     }
 
     def __init__(self, host, port, **configs):
@@ -64,36 +78,57 @@ class BrokerConnection(object):
 
         self.state = ConnectionStates.DISCONNECTED
         self._sock = None
-        self._rbuffer = io.BytesIO()
-        self._receiving = False
-        self._next_payload_bytes = 0
+        self._send_buffer = collections.deque() # encoded buffers not yet written
+        # futures of requests without a response (acks=0 produce), which
+        # succeed once the request is written: (end offset, future, time)
+        self._unflushed = collections.deque()
+        self._bytes_queued = 0 # total request bytes added to _send_buffer
+        self._bytes_sent = 0 # total request bytes written
+        # received bytes: frames are parsed from _rbuffer[_rbuffer_start:_rbuffer_end]
+        self._rbuffer = bytearray()
+        self._rbuffer_start = 0
+        self._rbuffer_end = 0
         self.last_attempt = 0
         self.last_failure = 0
+        self.last_activity = 0 # last connect attempt, send or receive
         self._processing = False
         self._correlation_id = 0
+        self._sockaddr = None # resolved address of the current attempt
+        self._address_index = 0
 
     def connect(self):
         """Attempt to connect and return ConnectionState"""
         if self.state is ConnectionStates.DISCONNECTED:
             self.close()
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.last_attempt = self.last_activity = time.time()
+            try:
+                addresses = dns_cache.resolve(self.host, self.port)
+            except socket.gaierror as e:
+                log.error('Unable to resolve %s: %s', self, e)
+                self.last_failure = time.time()
+                return self.state
+            # move on to the next address after each failed attempt
+            family, self._sockaddr = addresses[self._address_index % len(addresses)]
+            self._sock = socket.socket(family, socket.SOCK_STREAM)
             self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
                                   self.config['receive_buffer_bytes'])
             self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
                                   self.config['send_buffer_bytes'])
             self._sock.setblocking(False)
-            ret = self._sock.connect_ex((self.host, self.port))
-            self.last_attempt = time.time()
+            ret = self._sock.connect_ex(self._sockaddr)
 
             if not ret or ret is errno.EISCONN:
                 self.state = ConnectionStates.CONNECTED
+                self.config['state_change_callback'](self)
             elif ret in (errno.EINPROGRESS, errno.EALREADY):
                 self.state = ConnectionStates.CONNECTING
+                self.config['state_change_callback'](self)
             else:
                 log.error('Connect attempt to %s returned error %s.'
                           ' Disconnecting.', self, ret)
                 self.close()
                 self.last_failure = time.time()
+                self._address_index += 1
 
         if self.state is ConnectionStates.CONNECTING:
             # in non-blocking mode, use repeated calls to socket.connect_ex
@@ -103,16 +138,19 @@ class BrokerConnection(object):
                 log.error('Connection attempt to %s timed out', self)
                 self.close() # error=TimeoutError ?
                 self.last_failure = time.time()
+                self._address_index += 1
 
             else:
-                ret = self._sock.connect_ex((self.host, self.port))
+                ret = self._sock.connect_ex(self._sockaddr)
                 if not ret or ret is errno.EISCONN:
                     self.state = ConnectionStates.CONNECTED
+                    self.config['state_change_callback'](self)
                 elif ret is not errno.EALREADY:
                     log.error('Connect attempt to %s returned error %s.'
                               ' Disconnecting.', self, ret)
                     self.close()
                     self.last_failure = time.time()
+                    self._address_index += 1
         return self.state
 
     def blacked_out(self):
@@ -139,52 +177,60 @@ class BrokerConnection(object):
                 Default: kafka.common.ConnectionError.
         """
         if self._sock:
+            # the callback runs while the socket is still open, so that it
+            # can be unregistered from a selector
+            self.state = ConnectionStates.DISCONNECTED
+            self.config['state_change_callback'](self)
             self._sock.close()
             self._sock = None
         self.state = ConnectionStates.DISCONNECTED
-        self._receiving = False
-        self._next_payload_bytes = 0
-        self._rbuffer.seek(0)
-        self._rbuffer.truncate()
+        self._send_buffer.clear()
+        self._bytes_sent = self._bytes_queued
+        self._rbuffer_start = self._rbuffer_end = 0
         if error is None:
             error = Errors.ConnectionError()
         while self.in_flight_requests:
             ifr = self.in_flight_requests.popleft()
             ifr.future.failure(error)
+        while self._unflushed:
+            _, future, _ = self._unflushed.popleft()
+            future.failure(error)
 
     def send(self, request, expect_response=True):
         """send request, return Future()
 
-        Can block on network if request is larger than send_buffer_bytes
+        Never blocks: the encoded request is appended to the send buffer and
+        written as far as the socket accepts. Whatever remains is written by
+        later send_pending_requests() (or recv()) calls, which KafkaClient
+        makes when the socket is writable. With expect_response=False, the
+        future succeeds once the whole request has been written.
+
+        Where socket.sendmsg is available, a ProduceRequest with message
+        keys or values of at least MIN_REF_SIZE bytes (such as compressed
+        message sets) is encoded as a list of buffers that references those
+        values instead of copying them, and the buffers are written with one
+        scatter/gather call. Other requests are cheaper to encode into a
+        single buffer.
         """
         future = Future()
         if not self.connected():
             return future.failure(Errors.ConnectionError())
         if not self.can_send_more():
             return future.failure(Errors.TooManyInFlightRequests())
+        self.last_activity = time.time()
         correlation_id = self._next_correlation_id()
         header = RequestHeader(request,
                                correlation_id=correlation_id,
                                client_id=self.config['client_id'])
-        message = b''.join([header.encode(), request.encode()])
-        size = Int32.encode(len(message))
-        try:
-            # In the future we might manage an internal write buffer
-            # and send bytes asynchronously. For now, just block
-            # sending each request payload
-            self._sock.setblocking(True)
-            sent_bytes = self._sock.send(size)
-            assert sent_bytes == len(size)
-            sent_bytes = self._sock.send(message)
-            assert sent_bytes == len(message)
-            self._sock.setblocking(False)
-        except (AssertionError, ConnectionError) as e:
-            log.exception("Error sending %s to %s", request, self)
-            error = Errors.ConnectionError(e)
-            self.close(error=error)
-            return future.failure(error)
+        if HAS_SENDMSG and _has_large_values(request, self.MIN_REF_SIZE):
+            buffers = encode_request_buffers(header, request,
+                                             self.MIN_REF_SIZE)
+        else:
+            buffers = [encode_request(header, request)]
         log.debug('%s Request %d: %s', self, correlation_id, request)
 
+        # track the request before writing, so that a write error (which
+        # closes the connection) fails its future
         if expect_response:
             ifr = InFlightRequest(request=request,
                                   correlation_id=correlation_id,
@@ -193,10 +239,54 @@ class BrokerConnection(object):
                                   timestamp=time.time())
             self.in_flight_requests.append(ifr)
         else:
-            future.success(None)
-
+            self._unflushed.append((self._bytes_queued + sum(map(len, buffers)),
+                                    future, time.time()))
+        self._send_buffer.extend(buffers)
+        self._bytes_queued += sum(map(len, buffers))
+        self.send_pending_requests()
         return future
 
+    def has_pending_sends(self):
+        """Return True if buffered request bytes are waiting to be written"""
+        return bool(self._send_buffer)
+
+    def send_pending_requests(self):
+        """Write buffered request bytes until the buffer is empty or the
+        socket would block. Closes the connection on socket errors.
+
+        Returns:
+            bool: True if nothing is left to write
+        """
+        while self._send_buffer:
+            if HAS_SENDMSG:
+                data = list(itertools.islice(self._send_buffer,
+                                             self.MAX_SEND_BUFFERS))
+            else:
+                data = [self._send_buffer[0]]
+            try:
+                if HAS_SENDMSG:
+                    sent_bytes = self._sock.sendmsg(data)
+                else:
+                    sent_bytes = self._sock.send(data[0])
+            except socket.error as e:
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return False
+                log.exception("Error sending request to %s", self)
+                self.close(error=Errors.ConnectionError(e))
+                return True
+            self._bytes_sent += sent_bytes
+            while self._unflushed and self._unflushed[0][0] <= self._bytes_sent:
+                _, future, _ = self._unflushed.popleft()
+                future.success(None)
+            for buf in data:
+                if sent_bytes < len(buf):
+                    # partial write: keep a view of the rest, rather than a copy
+                    self._send_buffer[0] = as_memoryview(buf)[sent_bytes:]
+                    return False
+                sent_bytes -= len(buf)
+                self._send_buffer.popleft()
+        return True
+
     def can_send_more(self):
         """Return True unless there are max_in_flight_requests."""
         max_ifrs = self.config['max_in_flight_requests_per_connection']
@@ -205,7 +295,13 @@ class BrokerConnection(object):
     def recv(self, timeout=0):
         """Non-blocking network receive.
 
-        Return response if available
+        Reads whatever the socket has available, up to MAX_RECV_BYTES, and
+        processes every complete response frame in it. With a non-zero
+        timeout (None blocks), first waits for the socket to be readable;
+        callers that have already selected the socket use the default 0.
+
+        Returns:
+            list: responses received (can be empty)
         """
         assert not self._processing, 'Recursion not supported'
         if not self.connected():
@@ -214,85 +310,135 @@ class BrokerConnection(object):
             # fail all the pending request futures
             if self.in_flight_requests:
                 self.close()
-            return None
+            return []
 
-        elif not self.in_flight_requests:
-            log.warning('%s: No in-flight-requests to recv', self)
-            return None
+        # write buffered requests first, including those that get no
+        # response (and so may be the only thing left to do)
+        if self._send_buffer:
+            self.send_pending_requests()
+            if not self.connected():
+                return []
 
-        elif self._requests_timed_out():
+        if self._requests_timed_out():
             log.warning('%s timed out after %s ms. Closing connection.',
                         self, self.config['request_timeout_ms'])
             self.close(error=Errors.RequestTimedOutError(
                 'Request timed out after %s ms' %
                 self.config['request_timeout_ms']))
-            return None
+            return []
 
-        readable, _, _ = select([self._sock], [], [], timeout)
-        if not readable:
-            return None
+        if not self.in_flight_requests:
+            if not self._unflushed:
+                log.warning('%s: No in-flight-requests to recv', self)
+            return []
 
-        # Not receiving is the state of reading the payload header
-        if not self._receiving:
-            try:
-                # An extremely small, but non-zero, probability that there are
-                # more than 0 but not yet 4 bytes available to read
-                self._rbuffer.write(self._sock.recv(4 - self._rbuffer.tell()))
-            except ConnectionError as e:
-                if six.PY2 and e.errno == errno.EWOULDBLOCK:
-                    # This shouldn't happen after selecting above
-                    # but just in case
-                    return None
-                log.exception('%s: Error receiving 4-byte payload header -'
-                              ' closing socket', self)
-                self.close(error=Errors.ConnectionError(e))
-                return None
-            except BlockingIOError:
-                if six.PY3:
-                    return None
-                raise
-
-            if self._rbuffer.tell() == 4:
-                self._rbuffer.seek(0)
-                self._next_payload_bytes = Int32.decode(self._rbuffer)
-                # reset buffer and switch state to receiving payload bytes
-                self._rbuffer.seek(0)
-                self._rbuffer.truncate()
-                self._receiving = True
-            elif self._rbuffer.tell() > 4:
-                raise Errors.KafkaError('this should not happen - are you threading?')
-
-        if self._receiving:
-            staged_bytes = self._rbuffer.tell()
-            try:
-                self._rbuffer.write(self._sock.recv(self._next_payload_bytes - staged_bytes))
-            except ConnectionError as e:
-                # Extremely small chance that we have exactly 4 bytes for a
-                # header, but nothing to read in the body yet
-                if six.PY2 and e.errno == errno.EWOULDBLOCK:
-                    return None
-                log.exception('%s: Error in recv', self)
-                self.close(error=Errors.ConnectionError(e))
-                return None
-            except BlockingIOError:
-                if six.PY3:
-                    return None
-                raise
+        if timeout != 0:
+            readable, _, _ = select([self._sock], [], [], timeout)
+            if not readable:
+                return []
 
-            staged_bytes = self._rbuffer.tell()
-            if staged_bytes > self._next_payload_bytes:
-                self.close(error=Errors.KafkaError('Receive buffer has more bytes than expected?'))
+        responses = []
+        received_bytes = 0
+        while (self.in_flight_requests and self.connected() and
+               received_bytes < self.MAX_RECV_BYTES):
+            received = self._read_into_buffer()
+            if received is None:
+                break
+            received_bytes += received
+            responses.extend(self._process_frames())
+        return responses
+
+    def _read_into_buffer(self):
+        """recv_into the free space at the end of the receive buffer
+
+        First makes room for at least receive_buffer_bytes, or the rest of a
+        larger frame whose size prefix has arrived, so that big responses
+        are received in place. Buffered bytes are moved to the front of the
+        buffer when no decoded response holds views into it, else copied to
+        a new buffer.
 
-            if staged_bytes != self._next_payload_bytes:
-                return None
+        Returns:
+            int: bytes read, or None if nothing could be read
+        """
+        buf = self._rbuffer
+        start, end = self._rbuffer_start, self._rbuffer_end
+        pending = end - start
+        wanted = self.config['receive_buffer_bytes']
+        if pending >= 4:
+            frame_size = 4 + Int32._struct.unpack_from(buf, start)[0]
+            wanted = max(wanted, frame_size - pending)
+        if len(buf) - end < wanted:
+            size = pending + wanted
+            if (len(buf) < size or len(buf) > max(4 * size, 1048576) or
+                    is_exported(buf)):
+                new_buf = bytearray(size)
+                new_buf[:pending] = buf[start:end]
+                self._rbuffer = buf = new_buf
+            else:
+                buf[:pending] = buf[start:end]
+            self._rbuffer_start, self._rbuffer_end = start, end = 0, pending
 
-            self._receiving = False
-            self._next_payload_bytes = 0
-            self._rbuffer.seek(0)
-            response = self._process_response(self._rbuffer)
-            self._rbuffer.seek(0)
-            self._rbuffer.truncate()
-            return response
+        received = self._recv_into(buf, end, len(buf))
+        if received is not None:
+            self._rbuffer_end += received
+            self.last_activity = time.time()
+        return received
+
+    def _process_frames(self):
+        """Decode every complete response frame in the receive buffer"""
+        responses = []
+        buf = self._rbuffer
+        view = None
+        while self.connected() and self._rbuffer_end - self._rbuffer_start >= 4:
+            start = self._rbuffer_start + 4
+            size, = Int32._struct.unpack_from(buf, self._rbuffer_start)
+            if start + size > self._rbuffer_end:
+                break
+            if view is None:
+                view = as_memoryview(buf)
+            self._rbuffer_start = start + size
+            # Decode over a memoryview of the frame so that message keys
+            # and values are sliced rather than copied out of the buffer
+            response = self._process_response(
+                MemoryViewReader(view[start:start + size]))
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def _recv_into(self, buf, start, end):
+        """Read up to end - start bytes from the socket into buf[start:end]
+
+        Returns:
+            int: number of bytes read, or None if nothing could be read (the
+                connection is closed if the socket failed or hit EOF)
+        """
+        try:
+            if HAS_MEMORYVIEW:
+                view = memoryview(buf)[start:end]
+                try:
+                    received = self._sock.recv_into(view, end - start)
+                finally:
+                    release(view)
+            else: # python 2.6 buffers are read-only
+                data = self._sock.recv(end - start)
+                buf[start:start + len(data)] = data
+                received = len(data)
+        except ConnectionError as e:
+            if six.PY2 and e.errno == errno.EWOULDBLOCK:
+                return None # nothing (more) to read yet
+            log.exception('%s: Error in recv', self)
+            self.close(error=Errors.ConnectionError(e))
+            return None
+        except BlockingIOError:
+            if six.PY3:
+                return None
+            raise
+        if not received:
+            log.error('%s: socket disconnected', self)
+            self.close(error=Errors.ConnectionError(socket.error(
+                errno.ECONNRESET, 'socket disconnected')))
+            return None
+        return received
 
     def _process_response(self, read_buffer):
         assert not self._processing, 'Recursion not supported'
@@ -328,11 +474,14 @@ class BrokerConnection(object):
         return response
 
     def _requests_timed_out(self):
+        timeout = self.config['request_timeout_ms'] / 1000.0
         if self.in_flight_requests:
             oldest_at = self.in_flight_requests[0].timestamp
-            timeout = self.config['request_timeout_ms'] / 1000.0
             if time.time() >= oldest_at + timeout:
                 return True
+        if self._unflushed:
+            if time.time() >= self._unflushed[0][2] + timeout:
+                return True
         return False
 
     def _next_correlation_id(self):
@@ -343,6 +492,85 @@ class BrokerConnection(object):
         return "<BrokerConnection host=%s port=%d>" % (self.host, self.port)
 
 
+class DnsCache(object):
+    """Cache of getaddrinfo() results for broker host names
+
+    Shared by BrokerConnection and KafkaConnection through the module-level
+    dns_cache, so that reconnects (e.g. during a broker rolling restart) do
+    not resolve the host name on every attempt. Addresses are cached for
+    ttl seconds and resolution failures for negative_ttl seconds. Both IPv4
+    and IPv6 addresses are returned, in getaddrinfo's order, which puts the
+    family preferred by the system first.
+    """
+    def __init__(self, ttl=60, negative_ttl=5):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {} # (host, port) -> (expires_at, addresses or gaierror)
+
+    def resolve(self, host, port):
+        """Resolve host and port for a TCP connection
+
+        Returns:
+            list: (family, sockaddr) tuples, in order of preference
+
+        Raises:
+            socket.gaierror: if the host name could not be resolved
+        """
+        now = time.time()
+        entry = self._entries.get((host, port))
+        if entry is None or entry[0] <= now:
+            try:
+                infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM)
+                entry = (now + self.ttl,
+                         [(info[0], info[4]) for info in infos])
+            except socket.gaierror as e:
+                entry = (now + self.negative_ttl, e)
+            self._entries[(host, port)] = entry
+        if isinstance(entry[1], socket.gaierror):
+            raise entry[1]
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+
+dns_cache = DnsCache()
+
+
+def _has_large_values(request, min_size):
+    """Return True if request is a ProduceRequest with a message key or
+    value of at least min_size bytes, i.e. one that encode_request_buffers
+    would reference rather than copy"""
+    if not isinstance(request, ProduceRequest):
+        return False
+    for _, partitions in request.topics:
+        for _, messages in partitions:
+            for _, _, message in messages:
+                if isinstance(message, Message):
+                    values = (message.key, message.value)
+                else:
+                    values = message[-2:] # (.., key, value) schema tuple
+                for value in values:
+                    if value is not None and len(value) >= min_size:
+                        return True
+    return False
+
+
+def _split_host_port(host_port):
+    """Split 'host[:port]', where host may be a bracketed ('[::1]:9092') or
+    bare ('::1') IPv6 address"""
+    host_port = host_port.strip()
+    if host_port.startswith('['):
+        host, _, port = host_port[1:].partition(']')
+        port = port[1:]
+    elif host_port.count(':') == 1:
+        host, port = host_port.split(':')
+    else: # no port, or a bare IPv6 address
+        host, port = host_port, None
+    return host.strip(), int(port) if port else DEFAULT_KAFKA_PORT
+
+
 def collect_hosts(hosts, randomize=True):
     """
     Collects a comma-separated set of hosts (host:port) and optionally
@@ -352,13 +580,7 @@ def collect_hosts(hosts, randomize=True):
     if isinstance(hosts, six.string_types):
         hosts = hosts.strip().split(',')
 
-    result = []
-    for host_port in hosts:
-
-        res = host_port.split(':')
-        host = res[0]
-        port = int(res[1]) if len(res) > 1 else DEFAULT_KAFKA_PORT
-        result.append((host.strip(), port))
+    result = [_split_host_port(host_port) for host_port in hosts]
 
     if randomize:
         shuffle(result)
@@ -540,7 +762,21 @@ class KafkaConnection(local):
             self.close()
 
         try:
-            self._sock = socket.create_connection((self.host, self.port), self.timeout)
+            error = None
+            # connect to the cached sockaddr itself: create_connection would
+            # resolve the host again, and takes no IPv6 flowinfo / scope id
+            for family, sockaddr in dns_cache.resolve(self.host, self.port):
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                try:
+                    sock.settimeout(self.timeout)
+                    sock.connect(sockaddr)
+                    self._sock = sock
+                    break
+                except socket.error as e:
+                    sock.close()
+                    error = e
+            else:
+                raise error
         except socket.error:
             log.exception('Unable to connect to kafka broker at %s:%d' % (self.host, self.port))
             self._raise_connection_error()
@@ -9,15 +9,20 @@ import six
 import kafka.common as Errors
 from kafka.common import TopicPartition
 from kafka.future import Future
-from kafka.protocol.fetch import FetchRequest
-from kafka.protocol.message import PartialMessage
+from kafka.protocol.fetch import (
+    FetchBatchRequest, FetchBatchRequest_v1, FetchBatchRequest_v2,
+    FetchPartitionBatch, FetchRequest, FetchRequest_v1, FetchRequest_v2,
+    FetchResponseBatches
+)
+from kafka.protocol.message import LazyMessageSet, MessageSet, PartialMessage
 from kafka.protocol.offset import OffsetRequest, OffsetResetStrategy
 
 log = logging.getLogger(__name__)
 
 
 ConsumerRecord = collections.namedtuple("ConsumerRecord",
-    ["topic", "partition", "offset", "key", "value"])
+    ["topic", "partition", "offset", "key", "value",
+     "timestamp", "timestamp_type"])
 
 
 class NoOffsetForPartitionError(Errors.KafkaError):
@@ -35,8 +40,11 @@ class Fetcher(six.Iterator):
         'fetch_min_bytes': 1024,
         'fetch_max_wait_ms': 500,
         'max_partition_fetch_bytes': 1048576,
+        'max_partition_fetch_bytes_ceiling': 8 * 1048576,
         'check_crcs': True,
+        'fetch_record_batches': False,
         'iterator_refetch_records': 1, # undocumented -- interface may change
+        'api_version': (0, 9),
     }
 
     def __init__(self, client, subscriptions, **configs):
@@ -57,15 +65,27 @@ class Fetcher(six.Iterator):
             max_partition_fetch_bytes (int): The maximum amount of data
                 per-partition the server will return. The maximum total memory
                 used for a request = #partitions * max_partition_fetch_bytes.
-                This size must be at least as large as the maximum message size
-                the server allows or else it is possible for the producer to
-                send messages larger than the consumer can fetch. If that
-                happens, the consumer can get stuck trying to fetch a large
-                message on a certain partition. Default: 1048576.
+                A partition that returns a message larger than this has its
+                fetch size grown geometrically (up to
+                max_partition_fetch_bytes_ceiling) until the message fits,
+                then decayed back once it has been consumed.
+                Default: 1048576.
+            max_partition_fetch_bytes_ceiling (int): The largest fetch size a
+                partition may grow to in order to return an oversized
+                message. Messages larger than this raise RecordTooLargeError.
+                None means no limit; set it to max_partition_fetch_bytes to
+                disable growth. Default: 8388608.
             check_crcs (bool): Automatically check the CRC32 of the records
                 consumed. This ensures no on-the-wire or on-disk corruption to
                 the messages occurred. This check adds some overhead, so it may
                 be disabled in cases seeking extreme performance. Default: True
+            fetch_record_batches (bool): Decode FetchResponses in a single
+                pass straight into per-partition record batches, and build
+                records from their key / value spans without decoding a
+                Message per record. Default: False
+            api_version (tuple): the broker version, which selects the
+                FetchRequest version. (0, 10) brokers return timestamped
+                (magic 1) messages. Default: (0, 9)
         """
                  #metrics=None,
                  #metric_group_prefix='consumer',
@@ -80,6 +100,7 @@ class Fetcher(six.Iterator):
         self._unauthorized_topics = set()
         self._offset_out_of_range_partitions = dict() # {topic_partition: offset}
         self._record_too_large_partitions = dict() # {topic_partition: offset}
+        self._fetch_sizes = dict() # {topic_partition: grown fetch size}
         self._iterator = None
         self._fetch_futures = collections.deque()
 
@@ -270,6 +291,10 @@ class Fetcher(six.Iterator):
 
         copied_record_too_large_partitions = dict(self._record_too_large_partitions)
         self._record_too_large_partitions.clear()
+        fetch_size = self.config['max_partition_fetch_bytes']
+        if self.config['max_partition_fetch_bytes_ceiling'] is not None:
+            fetch_size = max(fetch_size,
+                             self.config['max_partition_fetch_bytes_ceiling'])
 
         raise RecordTooLargeError(
             "There are some messages at [Partition=Offset]: %s "
@@ -277,8 +302,7 @@ class Fetcher(six.Iterator):
             " and hence cannot be ever returned."
             " Increase the fetch size, or decrease the maximum message"
             " size the broker will allow.",
-            copied_record_too_large_partitions,
-            self.config['max_partition_fetch_bytes'])
+            copied_record_too_large_partitions, fetch_size)
 
     def fetched_records(self):
         """Returns previously fetched records and updates consumed offsets.
@@ -346,15 +370,52 @@ class Fetcher(six.Iterator):
         return dict(drained)
 
     def _unpack_message_set(self, tp, messages):
+        check_crcs = self.config['check_crcs']
+        # Check a whole decoded set in one pass over its wire bytes; only
+        # fall back to per-message checks to locate a corrupt message
+        if check_crcs and isinstance(messages, LazyMessageSet):
+            check_crcs = not messages.validate_crcs()
+        if not check_crcs and isinstance(messages, FetchPartitionBatch):
+            for offset, timestamp, timestamp_type, key, value, msg in messages.records():
+                if msg is not None:
+                    for record in self._unpack_compressed(tp, offset, msg):
+                        yield record
+                else:
+                    key, value = self._deserialize(key, value)
+                    yield ConsumerRecord(tp.topic, tp.partition, offset,
+                                         key, value, timestamp, timestamp_type)
+            return
         for offset, size, msg in messages:
-            if self.config['check_crcs'] and not msg.validate_crc():
+            if check_crcs and not msg.validate_crc():
                 raise Errors.InvalidMessageError(msg)
             elif msg.is_compressed():
-                for record in self._unpack_message_set(tp, msg.decompress()):
+                for record in self._unpack_compressed(tp, offset, msg):
                     yield record
             else:
-                key, value = self._deserialize(msg)
-                yield ConsumerRecord(tp.topic, tp.partition, offset, key, value)
+                key, value = self._deserialize(msg.key, msg.value)
+                yield ConsumerRecord(tp.topic, tp.partition, offset,
+                                     key, value, msg.timestamp,
+                                     msg.timestamp_type)
+
+    def _unpack_compressed(self, tp, offset, msg):
+        messages = msg.decompress()
+        if msg.magic == 0 or not messages.offsets:
+            for record in self._unpack_message_set(tp, messages):
+                yield record
+            return
+        # magic 1 inner messages carry offsets relative to the wrapper, whose
+        # own offset is that of the last inner message; with LogAppendTime
+        # the broker only sets the wrapper's timestamp
+        delta = offset - messages.offsets[-1]
+        log_append_time = msg.timestamp_type == 1
+        for record in self._unpack_message_set(tp, messages):
+            if log_append_time:
+                record = record._replace(offset=record.offset + delta,
+                                         timestamp=msg.timestamp,
+                                         timestamp_type=1)
+            else:
+                record = record._replace(offset=record.offset + delta)
+            yield record
 
     def _message_generator(self):
         """Iterate over fetched_records"""
@@ -424,15 +485,11 @@ class Fetcher(six.Iterator):
             self._iterator = None
             raise
 
-    def _deserialize(self, msg):
+    def _deserialize(self, key, value):
         if self.config['key_deserializer']:
-            key = self.config['key_deserializer'](msg.key) # pylint: disable-msg=not-callable
-        else:
-            key = msg.key
+            key = self.config['key_deserializer'](key) # pylint: disable-msg=not-callable
         if self.config['value_deserializer']:
-            value = self.config['value_deserializer'](msg.value) # pylint: disable-msg=not-callable
-        else:
-            value = msg.value
+            value = self.config['value_deserializer'](value) # pylint: disable-msg=not-callable
         return key, value
 
     def _send_offset_request(self, partition, timestamp):
@@ -518,6 +575,11 @@ class Fetcher(six.Iterator):
         # which can be passed to FetchRequest() via .items()
         fetchable = collections.defaultdict(lambda: collections.defaultdict(list))
 
+        # forget grown fetch sizes of partitions no longer assigned
+        for partition in list(self._fetch_sizes):
+            if not self._subscriptions.is_assigned(partition):
+                del self._fetch_sizes[partition]
+
         for partition in self._subscriptions.fetchable_partitions():
             node_id = self._client.cluster.leader_for_partition(partition)
             if node_id is None or node_id == -1:
@@ -530,92 +592,174 @@ class Fetcher(six.Iterator):
                 partition_info = (
                     partition.partition,
                     position,
-                    self.config['max_partition_fetch_bytes']
+                    self._fetch_size(partition)
                 )
                 fetchable[node_id][partition.topic].append(partition_info)
                 log.debug("Adding fetch request for partition %s at offset %d",
                           partition, position)
 
+        if self.config['fetch_record_batches']:
+            request_types = (FetchBatchRequest, FetchBatchRequest_v1,
+                             FetchBatchRequest_v2)
+        else:
+            request_types = (FetchRequest, FetchRequest_v1, FetchRequest_v2)
+        if self.config['api_version'] >= (0, 10):
+            request_type = request_types[2]
+        elif self.config['api_version'] >= (0, 9):
+            request_type = request_types[1]
+        else:
+            request_type = request_types[0]
         requests = {}
         for node_id, partition_data in six.iteritems(fetchable):
-            requests[node_id] = FetchRequest(
+            requests[node_id] = request_type(
                 -1, # replica_id
                 self.config['fetch_max_wait_ms'],
                 self.config['fetch_min_bytes'],
                 partition_data.items())
         return requests
 
+    def _fetch_size(self, partition):
+        """Return max_bytes for the next fetch of partition"""
+        return self._fetch_sizes.get(partition,
+                                     self.config['max_partition_fetch_bytes'])
+
+    def _grow_fetch_size(self, partition, fetch_size, needed=None):
+        """Double the fetch size of partition until it covers needed bytes
+        (once, if needed is unknown), up to max_partition_fetch_bytes_ceiling
+
+        Returns:
+            bool: False if the fetch size cannot grow enough
+        """
+        ceiling = self.config['max_partition_fetch_bytes_ceiling']
+        if ceiling is not None:
+            if fetch_size >= ceiling or (needed is not None and needed > ceiling):
+                return False
+        fetch_size *= 2
+        while needed is not None and fetch_size < needed:
+            fetch_size *= 2
+        if ceiling is not None:
+            fetch_size = min(fetch_size, ceiling)
+        log.debug("Growing fetch size for partition %s to %d", partition,
+                  fetch_size)
+        self._fetch_sizes[partition] = fetch_size
+        return True
+
+    def _decay_fetch_size(self, partition):
+        """Halve a grown fetch size back towards max_partition_fetch_bytes"""
+        if partition not in self._fetch_sizes:
+            return
+        fetch_size = self._fetch_sizes[partition] // 2
+        if fetch_size <= self.config['max_partition_fetch_bytes']:
+            del self._fetch_sizes[partition]
+        else:
+            self._fetch_sizes[partition] = fetch_size
+
+    def _fetched_partitions(self, response):
+        """Yield (TopicPartition, error_code, messages) from a FetchResponse
+        or FetchResponseBatches"""
+        if isinstance(response, FetchResponseBatches):
+            for batch in response.batches:
+                yield (TopicPartition(batch.topic, batch.partition),
+                       batch.error_code, batch)
+            return
+        for topic, partitions in response.topics:
+            for partition, error_code, _, messages in partitions:
+                yield TopicPartition(topic, partition), error_code, messages
+
     def _handle_fetch_response(self, request, response):
         """The callback for fetch completion"""
         #total_bytes = 0
         #total_count = 0
 
         fetch_offsets = {}
+        fetch_sizes = {}
         for topic, partitions in request.topics:
-            for partition, offset, _ in partitions:
+            for partition, offset, max_bytes in partitions:
                 fetch_offsets[TopicPartition(topic, partition)] = offset
+                fetch_sizes[TopicPartition(topic, partition)] = max_bytes
 
-        for topic, partitions in response.topics:
-            for partition, error_code, highwater, messages in partitions:
-                tp = TopicPartition(topic, partition)
-                error_type = Errors.for_code(error_code)
-                if not self._subscriptions.is_fetchable(tp):
-                    # this can happen when a rebalance happened or a partition
-                    # consumption paused while fetch is still in-flight
-                    log.debug("Ignoring fetched records for partition %s"
-                              " since it is no longer fetchable", tp)
-                elif error_type is Errors.NoError:
-                    fetch_offset = fetch_offsets[tp]
-
-                    # we are interested in this fetch only if the beginning
-                    # offset matches the current consumed position
-                    position = self._subscriptions.assignment[tp].position
-                    if position is None or position != fetch_offset:
-                        log.debug("Discarding fetch response for partition %s"
-                                  " since its offset %d does not match the"
-                                  " expected offset %d", tp, fetch_offset,
-                                  position)
-                        continue
-
-                    partial = None
-                    if messages and isinstance(messages[-1][-1], PartialMessage):
-                        partial = messages.pop()
-
-                    if messages:
-                        log.debug("Adding fetched record for partition %s with"
-                                  " offset %d to buffered record list", tp,
-                                  position)
-                        self._records.append((fetch_offset, tp, messages))
-                        #last_offset, _, _ = messages[-1]
-                        #self.sensors.records_fetch_lag.record(highwater - last_offset)
-                    elif partial:
-                        # we did not read a single message from a non-empty
-                        # buffer because that message's size is larger than
-                        # fetch size, in this case record this exception
-                        self._record_too_large_partitions[tp] = fetch_offset
-
-                    # TODO: bytes metrics
-                    #self.sensors.record_topic_fetch_metrics(tp.topic, num_bytes, parsed.size());
-                    #totalBytes += num_bytes;
-                    #totalCount += parsed.size();
-                elif error_type in (Errors.NotLeaderForPartitionError,
-                                    Errors.UnknownTopicOrPartitionError):
-                    self._client.cluster.request_update()
-                elif error_type is Errors.OffsetOutOfRangeError:
-                    fetch_offset = fetch_offsets[tp]
-                    if self._subscriptions.has_default_offset_reset_policy():
-                        self._subscriptions.need_offset_reset(tp)
-                    else:
-                        self._offset_out_of_range_partitions[tp] = fetch_offset
-                    log.info("Fetch offset %s is out of range, resetting offset",
-                             fetch_offset)
-                elif error_type is Errors.TopicAuthorizationFailedError:
-                    log.warn("Not authorized to read from topic %s.", tp.topic)
-                    self._unauthorized_topics.add(tp.topic)
-                elif error_type is Errors.UnknownError:
-                    log.warn("Unknown error fetching data for topic-partition %s", tp)
+        for tp, error_code, messages in self._fetched_partitions(response):
+            error_type = Errors.for_code(error_code)
+            if not self._subscriptions.is_fetchable(tp):
+                # this can happen when a rebalance happened or a partition
+                # consumption paused while fetch is still in-flight
+                log.debug("Ignoring fetched records for partition %s"
+                          " since it is no longer fetchable", tp)
+            elif error_type is Errors.NoError:
+                fetch_offset = fetch_offsets[tp]
+
+                # we are interested in this fetch only if the beginning
+                # offset matches the current consumed position
+                position = self._subscriptions.assignment[tp].position
+                if position is None or position != fetch_offset:
+                    log.debug("Discarding fetch response for partition %s"
+                              " since its offset %d does not match the"
+                              " expected offset %d", tp, fetch_offset,
+                              position)
+                    continue
+
+                partial = None
+                if messages and isinstance(messages[-1][-1], PartialMessage):
+                    _, _, partial = messages.pop()
+
+                # Kafka fetches by offset, so the bytes of a partial message
+                # cannot be resumed; instead, if the message is larger than
+                # this fetch, grow the partition's fetch size so the next
+                # fetch at its offset returns it whole. Once oversized
+                # messages have been consumed the fetch size decays back.
+                grown = False
+                if partial:
+                    header = partial.header()
+                    if header is not None:
+                        needed = MessageSet.HEADER_SIZE + header[1]
+                        if needed > fetch_sizes[tp]:
+                            grown = self._grow_fetch_size(tp, fetch_sizes[tp],
+                                                          needed)
+                    elif not messages:
+                        grown = self._grow_fetch_size(tp, fetch_sizes[tp])
+                if messages and not grown:
+                    self._decay_fetch_size(tp)
+
+                if messages:
+                    log.debug("Adding fetched record for partition %s with"
+                              " offset %d to buffered record list", tp,
+                              position)
+                    self._records.append((fetch_offset, tp, messages))
+                    #last_offset, _, _ = messages[-1]
+                    #self.sensors.records_fetch_lag.record(highwater - last_offset)
+                elif grown:
+                    log.debug("Message at offset %d for partition %s is"
+                              " larger than the fetch size; refetching with"
+                              " max_bytes %d", fetch_offset, tp,
+                              self._fetch_size(tp))
+                elif partial:
+                    # we did not read a single message from a non-empty
+                    # buffer because that message's size is larger than
+                    # fetch size, in this case record this exception
+                    self._record_too_large_partitions[tp] = fetch_offset
+
+                # TODO: bytes metrics
+                #self.sensors.record_topic_fetch_metrics(tp.topic, num_bytes, parsed.size());
+                #totalBytes += num_bytes;
+                #totalCount += parsed.size();
+            elif error_type in (Errors.NotLeaderForPartitionError,
+                                Errors.UnknownTopicOrPartitionError):
+                self._client.cluster.request_update()
+            elif error_type is Errors.OffsetOutOfRangeError:
+                fetch_offset = fetch_offsets[tp]
+                if self._subscriptions.has_default_offset_reset_policy():
+                    self._subscriptions.need_offset_reset(tp)
                 else:
-                    raise error_type('Unexpected error while fetching data')
+                    self._offset_out_of_range_partitions[tp] = fetch_offset
+                log.info("Fetch offset %s is out of range, resetting offset",
+                         fetch_offset)
+            elif error_type is Errors.TopicAuthorizationFailedError:
+                log.warn("Not authorized to read from topic %s.", tp.topic)
+                self._unauthorized_topics.add(tp.topic)
+            elif error_type is Errors.UnknownError:
+                log.warn("Unknown error fetching data for topic-partition %s", tp)
+            else:
+                raise error_type('Unexpected error while fetching data')
 
         """TOOD - metrics
         self.sensors.bytesFetched.record(totalBytes)
@@ -59,11 +59,15 @@ class KafkaConsumer(six.Iterator):
         max_partition_fetch_bytes (int): The maximum amount of data
             per-partition the server will return. The maximum total memory
             used for a request = #partitions * max_partition_fetch_bytes.
-            This size must be at least as large as the maximum message size
-            the server allows or else it is possible for the producer to
-            send messages larger than the consumer can fetch. If that
-            happens, the consumer can get stuck trying to fetch a large
-            message on a certain partition. Default: 1048576.
+            A partition that returns a message larger than this has its
+            fetch size grown geometrically (up to
+            max_partition_fetch_bytes_ceiling) until the message fits, then
+            decayed back once it has been consumed. Default: 1048576.
+        max_partition_fetch_bytes_ceiling (int): The largest fetch size a
+            partition may grow to in order to return an oversized message.
+            Messages larger than this raise RecordTooLargeError. None means
+            no limit; set it to max_partition_fetch_bytes to disable growth.
+            Default: 8388608.
         request_timeout_ms (int): Client request timeout in milliseconds.
             Default: 40000.
         retry_backoff_ms (int): Milliseconds to backoff when retrying on
@@ -90,10 +94,18 @@ class KafkaConsumer(six.Iterator):
             consumed. This ensures no on-the-wire or on-disk corruption to
             the messages occurred. This check adds some overhead, so it may
             be disabled in cases seeking extreme performance. Default: True
+        fetch_record_batches (bool): Decode fetch responses in a single pass
+            straight into per-partition record batches, and build records
+            from their key / value spans without decoding a Message object
+            per record. Default: False
         metadata_max_age_ms (int): The period of time in milliseconds after
             which we force a refresh of metadata even if we haven't seen any
             partition leadership changes to proactively discover any new
             brokers or partitions. Default: 300000
+        bootstrap_connect_stagger_ms (int): Connections to the
+            bootstrap_servers are attempted concurrently, each started this
+            many milliseconds after the previous one, and the first to
+            connect is used. Default: 250
         partition_assignment_strategy (list): List of objects to use to
             distribute partition ownership amongst consumer instances when
             group management is used. Default: [RoundRobinPartitionAssignor]
@@ -112,15 +124,24 @@ class KafkaConsumer(six.Iterator):
             (SO_SNDBUF) to use when sending data. Default: 131072
         receive_buffer_bytes (int): The size of the TCP receive buffer
             (SO_RCVBUF) to use when reading data. Default: 32768
+        connections_max_idle_ms (int): Close broker connections that have
+            been idle for this many milliseconds; they are reopened when
+            next needed. None disables. Default: 540000
         consumer_timeout_ms (int): number of millisecond to throw a timeout
             exception to the consumer if no message is available for
             consumption. Default: -1 (dont throw exception)
         api_version (str): specify which kafka API version to use.
+            0.10 enables message timestamps (ConsumerRecord.timestamp);
             0.9 enables full group coordination features; 0.8.2 enables
             kafka-storage offset commits; 0.8.1 enables zookeeper-storage
             offset commits; 0.8.0 is what is left. If set to 'auto', will
             attempt to infer the broker version by probing various APIs.
             Default: auto
+        api_version_cache_ttl_ms (int): How long a broker version inferred
+            with api_version='auto' is reused for the same bootstrap_servers
+            instead of probing again. Default: 86400000 (1 day)
+        api_version_cache_file (str): Path of a JSON file that persists
+            inferred broker versions across processes. Default: None
 
     Note:
         Configuration parameters are described in more detail at
@@ -135,6 +156,7 @@ class KafkaConsumer(six.Iterator):
         'fetch_max_wait_ms': 500,
         'fetch_min_bytes': 1024,
         'max_partition_fetch_bytes': 1 * 1024 * 1024,
+        'max_partition_fetch_bytes_ceiling': 8 * 1024 * 1024,
         'request_timeout_ms': 40 * 1000,
         'retry_backoff_ms': 100,
         'reconnect_backoff_ms': 50,
@@ -143,7 +165,9 @@ class KafkaConsumer(six.Iterator):
         'enable_auto_commit': True,
         'auto_commit_interval_ms': 5000,
         'check_crcs': True,
+        'fetch_record_batches': False,
         'metadata_max_age_ms': 5 * 60 * 1000,
+        'bootstrap_connect_stagger_ms': 250,
         'partition_assignment_strategy': (RoundRobinPartitionAssignor,),
         'heartbeat_interval_ms': 3000,
         'session_timeout_ms': 30000,
@@ -151,7 +175,9 @@ class KafkaConsumer(six.Iterator):
         'receive_buffer_bytes': 32 * 1024,
         'consumer_timeout_ms': -1,
         'api_version': 'auto',
-        'connections_max_idle_ms': 9 * 60 * 1000, # not implemented yet
+        'api_version_cache_ttl_ms': 24 * 60 * 60 * 1000,
+        'api_version_cache_file': None,
+        'connections_max_idle_ms': 9 * 60 * 1000,
         #'metric_reporters': None,
         #'metrics_num_samples': 2,
         #'metrics_sample_window_ms': 30000,
@@ -178,7 +204,8 @@ class KafkaConsumer(six.Iterator):
         # Check Broker Version if not set explicitly
         if self.config['api_version'] == 'auto':
             self.config['api_version'] = self._client.check_version()
-        assert self.config['api_version'] in ('0.9', '0.8.2', '0.8.1', '0.8.0')
+        assert self.config['api_version'] in (
+            '0.10', '0.9', '0.8.2', '0.8.1', '0.8.0')
 
         # Convert api_version config to tuple for easy comparisons
         self.config['api_version'] = tuple(
@@ -1,3 +1,4 @@
+import collections
 import functools
 import logging
 
@@ -11,8 +12,8 @@ class Future(object):
         self.is_done = False
         self.value = None
         self.exception = None
-        self._callbacks = []
-        self._errbacks = []
+        self._callbacks = collections.deque()
+        self._errbacks = collections.deque()
 
     def succeeded(self):
         return self.is_done and not self.exception
@@ -30,11 +31,7 @@ class Future(object):
         assert not self.is_done, 'Future is already complete'
         self.value = value
         self.is_done = True
-        for f in self._callbacks:
-            try:
-                f(value)
-            except Exception:
-                log.exception('Error processing callback')
+        self._run_all(self._callbacks, value, 'callback')
         return self
 
     def failure(self, e):
@@ -43,29 +40,45 @@ class Future(object):
         assert isinstance(self.exception, BaseException), (
             'future failed without an exception')
         self.is_done = True
-        for f in self._errbacks:
+        self._run_all(self._errbacks, self.exception, 'errback')
+        return self
+
+    # A future may be completed on one thread (e.g. the network thread of a
+    # ThreadedKafkaClient) while callbacks are added on another. Each
+    # callback is popped from its deque before it runs, and add_callback()
+    # appends before checking is_done, so whichever thread removes it from
+    # the deque runs it, exactly once.
+    @staticmethod
+    def _run_all(fs, arg, kind):
+        while fs:
             try:
-                f(self.exception)
+                f = fs.popleft()
+            except IndexError:
+                break
+            try:
+                f(arg)
             except Exception:
-                log.exception('Error processing errback')
-        return self
+                log.exception('Error processing %s', kind)
+
+    def _add(self, fs, f, done, attr):
+        fs.append(f)
+        if done():
+            try:
+                fs.remove(f)
+            except ValueError:
+                return # already run by the completing thread
+            f(getattr(self, attr))
 
     def add_callback(self, f, *args, **kwargs):
         if args or kwargs:
             f = functools.partial(f, *args, **kwargs)
-        if self.is_done and not self.exception:
-            f(self.value)
-        else:
-            self._callbacks.append(f)
+        self._add(self._callbacks, f, self.succeeded, 'value')
         return self
 
     def add_errback(self, f, *args, **kwargs):
         if args or kwargs:
             f = functools.partial(f, *args, **kwargs)
-        if self.is_done and self.exception:
-            f(self.exception)
-        else:
-            self._errbacks.append(f)
+        self._add(self._errbacks, f, self.failed, 'exception')
         return self
 
     def add_both(self, f, *args, **kwargs):
@@ -21,7 +21,8 @@ from kafka.common import (
     RETRY_ERROR_TYPES, RETRY_BACKOFF_ERROR_TYPES, RETRY_REFRESH_ERROR_TYPES
 )
 
-from kafka.protocol import CODEC_NONE, ALL_CODECS, create_message_set
+from kafka.codec import get_codec
+from kafka.protocol import CODEC_NONE, create_message_set
 
 log = logging.getLogger('kafka.producer')
 
@@ -307,8 +308,9 @@ class Producer(object):
 
         if codec is None:
             codec = CODEC_NONE
-        elif codec not in ALL_CODECS:
-            raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+        elif codec != CODEC_NONE and not get_codec(codec).available():
+            raise UnsupportedCodecError("%s codec is not available"
+                                        % get_codec(codec).name)
 
         self.codec = codec
         self.codec_compresslevel = codec_compresslevel
@@ -1,6 +1,6 @@
 from .legacy import (
     create_message, create_gzip_message,
-    create_snappy_message, create_message_set,
-    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, ALL_CODECS,
+    create_snappy_message, create_lz4_message, create_message_set,
+    CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4, ALL_CODECS,
     ATTRIBUTE_CODEC_MASK, KafkaProtocol,
 )
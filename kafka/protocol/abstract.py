@@ -3,6 +3,7 @@ import abc
 
 class AbstractType(object):
     __metaclass__ = abc.ABCMeta
+    __slots__ = ()
 
     @abc.abstractmethod
     def encode(cls, value): # pylint: disable=no-self-argument
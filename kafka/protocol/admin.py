@@ -42,3 +42,19 @@ class DescribeGroupsRequest(Struct):
     SCHEMA = Schema(
         ('groups', Array(String('utf-8')))
     )
+
+
+class ApiVersionResponse(Struct):
+    SCHEMA = Schema(
+        ('error_code', Int16),
+        ('api_versions', Array(
+            ('api_key', Int16),
+            ('min_version', Int16),
+            ('max_version', Int16))))
+
+
+class ApiVersionRequest(Struct):
+    API_KEY = 18
+    API_VERSION = 0 # added in 0.10
+    RESPONSE_TYPE = ApiVersionResponse
+    SCHEMA = Schema()
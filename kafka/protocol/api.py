@@ -1,3 +1,4 @@
+from .buffer import BufferList
 from .struct import Struct
 from .types import Int16, Int32, String, Schema
 
@@ -14,3 +15,33 @@ class RequestHeader(Struct):
         super(RequestHeader, self).__init__(
             request.API_KEY, request.API_VERSION, correlation_id, client_id
         )
+
+
+def encode_request(header, request):
+    """Encode a size-prefixed request frame into a single bytearray
+
+    The header and request are written into one growable buffer in a single
+    pass, and the size prefix is back-patched at the end, so nested
+    structures (e.g. the MessageSets of a ProduceRequest) are never joined
+    into intermediate bytes objects.
+    """
+    buf = bytearray(4)
+    header.encode_into(buf)
+    request.encode_into(buf)
+    Int32._struct.pack_into(buf, 0, len(buf) - 4)
+    return buf
+
+
+def encode_request_buffers(header, request, min_ref_size=4096):
+    """Encode a size-prefixed request frame as a list of buffers
+
+    Like encode_request, but bytes values of at least min_ref_size bytes
+    (e.g. the compressed message sets of a ProduceRequest) are referenced
+    rather than copied, for a vectored write of the returned buffers.
+    """
+    buf = BufferList(min_ref_size)
+    Int32.encode_into(buf, 0)
+    header.encode_into(buf)
+    request.encode_into(buf)
+    buf.pack_into(Int32._struct, 0, len(buf) - 4)
+    return buf.buffers()
@@ -0,0 +1,182 @@
+from __future__ import absolute_import
+
+import binascii
+import bisect
+
+try:
+    memoryview
+    HAS_MEMORYVIEW = True
+except NameError: # python 2.6 -- slices are copies, but the interface holds
+    memoryview = buffer # pylint: disable=redefined-builtin,undefined-variable
+    HAS_MEMORYVIEW = False
+
+
+class MemoryViewReader(object):
+    """Read-only file-like cursor over a memoryview of a receive buffer
+
+    Works as a drop-in for io.BytesIO in the protocol decoders, except that
+    read() returns memoryview slices of the underlying buffer instead of
+    copying into new bytes objects. Decoders that need real bytes (String,
+    Bytes, Message keys and values) materialize them; only decoded message
+    sets keep a view of the buffer.
+    """
+    def __init__(self, data):
+        self._view = memoryview(data)
+        self._pos = 0
+
+    def read(self, size=-1):
+        start = self._pos
+        if size is None or size < 0:
+            end = len(self._view)
+        else:
+            end = min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += len(self._view)
+        self._pos = max(0, min(pos, len(self._view)))
+        return self._pos
+
+    def __len__(self):
+        return len(self._view)
+
+    def getbuffer(self):
+        """Return the underlying memoryview, like io.BytesIO.getbuffer()"""
+        return self._view
+
+
+def as_memoryview(data):
+    """Return a memoryview over data (bytes, bytearray or memoryview)"""
+    return memoryview(data)
+
+
+def tobytes(data):
+    """Materialize bytes from the result of a read() call"""
+    if data is None or isinstance(data, bytes):
+        return data
+    return data.tobytes()
+
+
+def release(view):
+    """Drop a memoryview's export of its buffer now rather than when it is
+    garbage collected, so that a bytearray under it can be resized again.
+    memoryview.release() only exists on py3."""
+    if hasattr(view, 'release'):
+        view.release()
+
+
+def is_exported(buf):
+    """Return True if a memoryview (e.g. of a decoded message set) may
+    still reference the bytearray buf, so that it must not be reused.
+
+    Resizing a bytearray that has exports raises BufferError, which makes a
+    cheap probe. Python 2.6 buffer objects do not pin the bytearray, so
+    there it always answers True.
+    """
+    if not HAS_MEMORYVIEW:
+        return True
+    try:
+        buf.append(0)
+    except BufferError:
+        return True
+    buf.pop()
+    return False
+
+
+def pack_into(packer, buf, pos, *values):
+    """packer.pack_into(buf, pos, *values) for a bytearray or a BufferList"""
+    if isinstance(buf, BufferList):
+        buf.pack_into(packer, pos, *values)
+    else:
+        packer.pack_into(buf, pos, *values)
+
+
+def extend_value(buf, value):
+    """buf.extend(value) for a Bytes value; a BufferList may keep a large
+    value by reference rather than copying it"""
+    if isinstance(buf, BufferList):
+        buf.extend_ref(value)
+    else:
+        buf.extend(value)
+
+
+class BufferList(object):
+    """Append-only write buffer that keeps large values by reference
+
+    Supports the operations the protocol encode_into() methods use on a
+    bytearray -- extend(), len() and (via pack_into() above) back-patching
+    fixed-width fields. In addition, extend_ref() (used for Bytes values,
+    via extend_value() above) stores a value of at least min_ref_size bytes
+    as its own segment instead of copying it. buffers() returns the segments
+    for a vectored write (socket.sendmsg), so large message values, such as
+    a producer's compressed message sets, reach the kernel without being
+    joined.
+    """
+    def __init__(self, min_ref_size=4096):
+        self._min_ref_size = min_ref_size
+        self._segments = [bytearray()]
+        self._starts = [0] # offset of each segment
+        self._length = 0
+
+    def extend(self, data):
+        self._segments[-1].extend(data)
+        self._length += len(data)
+
+    def extend_ref(self, data):
+        """Append data, keeping a reference to it if it is large enough.
+        data must not be modified until the buffers have been written."""
+        size = len(data)
+        if size < self._min_ref_size:
+            self.extend(data)
+            return
+        self._segments.append(data)
+        self._starts.append(self._length)
+        self._segments.append(bytearray())
+        self._starts.append(self._length + size)
+        self._length += size
+
+    def __len__(self):
+        return self._length
+
+    def pack_into(self, packer, pos, *values):
+        """Overwrite packer.size bytes at pos, which must have been written
+        by a single (copied) extend()"""
+        i = bisect.bisect_right(self._starts, pos) - 1
+        if isinstance(self._segments[i], bytearray):
+            packer.pack_into(self._segments[i], pos - self._starts[i], *values)
+        else:
+            raise ValueError('Cannot pack into referenced data at %d' % pos)
+
+    def crc32(self, start=0):
+        """CRC32 of the bytes from start to the end, as the signed int used
+        by the kafka protocol"""
+        crc = 0
+        i = bisect.bisect_right(self._starts, start) - 1
+        offset = start - self._starts[i]
+        for segment in self._segments[i:]:
+            if offset:
+                view = memoryview(segment)[offset:]
+                crc = binascii.crc32(view, crc)
+                release(view)
+                offset = 0
+            else:
+                crc = binascii.crc32(segment, crc)
+        crc &= 0xffffffff
+        if crc >= 2**31:
+            crc -= 2**32
+        return crc
+
+    def buffers(self):
+        """Return the non-empty segments, in order"""
+        return [segment for segment in self._segments if len(segment)]
+
+    def getvalue(self):
+        """Join the segments into a single bytes object"""
+        return b''.join([bytes(segment) for segment in self._segments])
@@ -1,4 +1,9 @@
-from .message import MessageSet
+from __future__ import absolute_import
+
+import struct
+
+from .buffer import MemoryViewReader, tobytes
+from .message import LazyMessageSet, Message, MessageSet, PartialMessage
 from .struct import Struct
 from .types import Array, Int16, Int32, Int64, Schema, String
 
@@ -15,6 +20,23 @@ class FetchResponse(Struct):
     )
 
 
+class FetchResponse_v1(Struct):
+    SCHEMA = Schema(
+        ('throttle_time_ms', Int32),
+        ('topics', Array(
+            ('topics', String('utf-8')),
+            ('partitions', Array(
+                ('partition', Int32),
+                ('error_code', Int16),
+                ('highwater_offset', Int64),
+                ('message_set', MessageSet)))))
+    )
+
+
+class FetchResponse_v2(FetchResponse_v1):
+    pass # message sets may contain magic 1 (timestamped) messages
+
+
 class FetchRequest(Struct):
     API_KEY = 1
     API_VERSION = 0
@@ -30,3 +52,218 @@ class FetchRequest(Struct):
                 ('offset', Int64),
                 ('max_bytes', Int32)))))
     )
+
+
+class FetchRequest_v1(FetchRequest):
+    API_VERSION = 1 # response adds throttle_time_ms
+    RESPONSE_TYPE = FetchResponse_v1
+
+
+class FetchRequest_v2(FetchRequest):
+    API_VERSION = 2 # broker may return magic 1 messages
+    RESPONSE_TYPE = FetchResponse_v2
+
+
+class FetchPartitionBatch(LazyMessageSet):
+    """One partition of a FetchResponse, decoded by FetchResponseBatches
+
+    A LazyMessageSet over the receive buffer (Messages are still decoded on
+    demand) that also records each message's attributes, timestamp and
+    key / value spans, so that records() can produce keys and values without
+    building a Message per record.
+    """
+    def __init__(self, topic, partition, error_code, highwater_offset,
+                 view, offsets, positions, sizes, partial, attributes,
+                 timestamps, spans):
+        super(FetchPartitionBatch, self).__init__(
+            view, offsets, positions, sizes, partial)
+        self.topic = topic
+        self.partition = partition
+        self.error_code = error_code
+        self.highwater_offset = highwater_offset
+        self._attributes = attributes
+        self._timestamps = timestamps # None for magic 0 messages
+        self._spans = spans # flat [key_start, key_end, value_start, value_end, ...]
+
+    def records(self):
+        """Yield (offset, timestamp, timestamp_type, key, value, message)
+        for each complete message
+
+        message is None for uncompressed messages, whose key and value are
+        read straight from their spans. For compressed (wrapper) messages
+        key and value are None and message is the decoded Message.
+        timestamp and timestamp_type are None for magic 0 messages.
+        """
+        view = self._view
+        spans = self._spans
+        for i, offset in enumerate(self._offsets):
+            attributes = self._attributes[i]
+            timestamp = self._timestamps[i]
+            if timestamp is None:
+                timestamp_type = None
+            else:
+                timestamp_type = int(bool(attributes & Message.TIMESTAMP_TYPE_MASK))
+            if attributes & Message.CODEC_MASK:
+                yield offset, timestamp, timestamp_type, None, None, self._item(i)[2]
+                continue
+            key_start, key_end, value_start, value_end = spans[4 * i:4 * i + 4]
+            key = tobytes(view[key_start:key_end]) if key_start >= 0 else None
+            value = tobytes(view[value_start:value_end]) if value_start >= 0 else None
+            yield offset, timestamp, timestamp_type, key, value, None
+
+    def pop(self, index=-1):
+        if index < 0:
+            index += len(self)
+        if index < len(self._offsets):
+            del self._attributes[index]
+            del self._timestamps[index]
+            del self._spans[4 * index:4 * index + 4]
+        return super(FetchPartitionBatch, self).pop(index)
+
+    def __repr__(self):
+        return ('FetchPartitionBatch(topic=%s, partition=%s, error_code=%s,'
+                ' highwater_offset=%s, messages=%d)' % (
+                    self.topic, self.partition, self.error_code,
+                    self.highwater_offset, len(self._offsets)))
+
+
+_STRING_LENGTH = struct.Struct('>h')
+_ARRAY_LENGTH = struct.Struct('>i')
+_BYTES_LENGTH = _ARRAY_LENGTH
+_PARTITION_HEADER = struct.Struct('>ihqi') # partition, error_code, highwater, message set size
+_MESSAGE_HEADER = Message._HEADER_V0
+_MESSAGE_HEADER_V1 = Message._HEADER_V1
+
+
+class FetchResponseBatches(object):
+    """A FetchResponse decoded in one pass into FetchPartitionBatches
+
+    Used as the RESPONSE_TYPE of FetchBatchRequest. Rather than recursing
+    through the generic Schema for the nested topic / partition arrays and
+    building (partition, error_code, highwater_offset, message_set) tuples,
+    decode() walks the response with unpack_from offsets and emits one
+    FetchPartitionBatch per partition. The versioned subclasses also read
+    the leading throttle_time_ms.
+    """
+    __slots__ = ('batches', 'throttle_time_ms')
+    API_VERSION = 0
+
+    def __init__(self, batches, throttle_time_ms=0):
+        self.batches = batches
+        self.throttle_time_ms = throttle_time_ms
+
+    @classmethod
+    def decode(cls, data):
+        if isinstance(data, (bytes, bytearray)):
+            data = MemoryViewReader(data)
+        elif not isinstance(data, MemoryViewReader):
+            data = MemoryViewReader(data.read())
+        view = data.getbuffer()
+        pos = data.tell()
+        batches = []
+
+        throttle_time_ms = 0
+        if cls.API_VERSION > 0:
+            throttle_time_ms, = _ARRAY_LENGTH.unpack_from(view, pos)
+            pos += 4
+
+        num_topics, = _ARRAY_LENGTH.unpack_from(view, pos)
+        pos += 4
+        for _ in range(num_topics):
+            length, = _STRING_LENGTH.unpack_from(view, pos)
+            pos += 2
+            topic = tobytes(view[pos:pos + length]).decode('utf-8')
+            pos += length
+
+            num_partitions, = _ARRAY_LENGTH.unpack_from(view, pos)
+            pos += 4
+            for _ in range(num_partitions):
+                partition, error_code, highwater, set_size = \
+                    _PARTITION_HEADER.unpack_from(view, pos)
+                pos += _PARTITION_HEADER.size
+                batches.append(cls._decode_message_set(
+                    topic, partition, error_code, highwater,
+                    view, pos, pos + set_size))
+                pos += set_size
+
+        data.seek(pos)
+        return cls(batches, throttle_time_ms)
+
+    @staticmethod
+    def _decode_message_set(topic, partition, error_code, highwater,
+                            view, pos, end):
+        offsets = []
+        positions = []
+        sizes = []
+        attributes = []
+        timestamps = []
+        spans = []
+
+        # see MessageSet.decode: 8 + 4 + 14 bytes is the smallest message
+        while end - pos >= 26:
+            offset, message_size = MessageSet._HEADER.unpack_from(view, pos)
+            if message_size > end - pos - MessageSet.HEADER_SIZE:
+                break
+            pos += MessageSet.HEADER_SIZE
+
+            _, magic, attrs, key_length = _MESSAGE_HEADER.unpack_from(view, pos)
+            if magic == 0:
+                timestamps.append(None)
+                key_start = pos + _MESSAGE_HEADER.size
+            else:
+                _, _, _, timestamp, key_length = \
+                    _MESSAGE_HEADER_V1.unpack_from(view, pos)
+                timestamps.append(timestamp)
+                key_start = pos + _MESSAGE_HEADER_V1.size
+            if key_length < 0:
+                value_length_pos = key_start
+                spans.extend((-1, -1))
+            else:
+                value_length_pos = key_start + key_length
+                spans.extend((key_start, value_length_pos))
+            value_length, = _BYTES_LENGTH.unpack_from(view, value_length_pos)
+            if value_length < 0:
+                spans.extend((-1, -1))
+            else:
+                value_start = value_length_pos + 4
+                spans.extend((value_start, value_start + value_length))
+
+            offsets.append(offset)
+            positions.append(pos)
+            sizes.append(message_size)
+            attributes.append(attrs)
+            pos += message_size
+
+        partial = None
+        if pos < end:
+            partial = PartialMessage(tobytes(view[pos:end]))
+
+        return FetchPartitionBatch(topic, partition, error_code, highwater,
+                                   view, offsets, positions, sizes, partial,
+                                   attributes, timestamps, spans)
+
+    def __repr__(self):
+        return 'FetchResponseBatches(%r)' % (self.batches,)
+
+
+class FetchResponseBatches_v1(FetchResponseBatches):
+    __slots__ = ()
+    API_VERSION = 1
+
+
+class FetchResponseBatches_v2(FetchResponseBatches):
+    __slots__ = ()
+    API_VERSION = 2
+
+
+class FetchBatchRequest(FetchRequest):
+    """A FetchRequest whose response is decoded by FetchResponseBatches"""
+    RESPONSE_TYPE = FetchResponseBatches
+
+
+class FetchBatchRequest_v1(FetchRequest_v1):
+    RESPONSE_TYPE = FetchResponseBatches_v1
+
+
+class FetchBatchRequest_v2(FetchRequest_v2):
+    RESPONSE_TYPE = FetchResponseBatches_v2
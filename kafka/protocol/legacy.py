@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import logging
 import struct
+import time
 
 import six
 
@@ -15,12 +16,9 @@ import kafka.protocol.metadata
 import kafka.protocol.offset
 import kafka.protocol.produce
 
-from kafka.codec import (
-    gzip_encode, gzip_decode, snappy_encode, snappy_decode
-)
+from kafka.codec import get_codec, lz4_encode
 from kafka.common import (
     ProtocolError, ChecksumError,
-    UnsupportedCodecError,
     ConsumerMetadataResponse
 )
 from kafka.util import (
@@ -31,11 +29,12 @@ from kafka.util import (
 
 log = logging.getLogger(__name__)
 
-ATTRIBUTE_CODEC_MASK = 0x03
+ATTRIBUTE_CODEC_MASK = 0x07
 CODEC_NONE = 0x00
 CODEC_GZIP = 0x01
 CODEC_SNAPPY = 0x02
-ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY)
+CODEC_LZ4 = 0x03
+ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4)
 
 
 class KafkaProtocol(object):
@@ -80,11 +79,16 @@ class KafkaProtocol(object):
         MessageSet => [Offset MessageSize Message]
           Offset => int64
           MessageSize => int32
+
+        Offsets are 0, except for magic 1 messages, which are numbered from 0
+        as they are relative offsets when wrapped in a compressed message.
         """
         message_set = []
-        for message in messages:
+        for i, message in enumerate(messages):
             encoded_message = KafkaProtocol._encode_message(message)
-            message_set.append(struct.pack('>qi%ds' % len(encoded_message), 0,
+            offset = i if message.magic > 0 else 0
+            message_set.append(struct.pack('>qi%ds' % len(encoded_message),
+                                           offset,
                                            len(encoded_message),
                                            encoded_message))
         return b''.join(message_set)
@@ -95,20 +99,26 @@ class KafkaProtocol(object):
         Encode a single message.
 
         The magic number of a message is a format version number.
-        The only supported magic number right now is zero
+        Magic 0 and magic 1 (which adds a timestamp) are supported.
 
         Format
         ======
-        Message => Crc MagicByte Attributes Key Value
+        Message => Crc MagicByte Attributes [Timestamp] Key Value
           Crc => int32
           MagicByte => int8
           Attributes => int8
+          Timestamp => int64 (magic 1 only)
           Key => bytes
           Value => bytes
         """
-        if message.magic == 0:
+        if message.magic in (0, 1):
+            if message.magic == 0:
+                header = struct.pack('>BB', message.magic, message.attributes)
+            else:
+                header = struct.pack('>BBq', message.magic, message.attributes,
+                                     message.timestamp)
             msg = b''.join([
-                struct.pack('>BB', message.magic, message.attributes),
+                header,
                 write_int_string(message.key),
                 write_int_string(message.value)
             ])
@@ -136,12 +146,20 @@ class KafkaProtocol(object):
             timeout: Maximum time (in ms) the server will wait for replica acks.
                 This is _not_ a socket timeout
 
-        Returns: ProduceRequest
+        Returns: ProduceRequest, or ProduceRequest_v2 if any message is
+            magic 1 (timestamped, which requires 0.10 brokers)
         """
         if acks not in (1, 0, -1):
             raise ValueError('ProduceRequest acks (%s) must be 1, 0, -1' % acks)
 
-        return kafka.protocol.produce.ProduceRequest(
+        grouped = group_by_topic_and_partition(payloads)
+        request_type = kafka.protocol.produce.ProduceRequest
+        for topic_payloads in grouped.values():
+            for payload in topic_payloads.values():
+                if any([msg.magic > 0 for msg in payload.messages]):
+                    request_type = kafka.protocol.produce.ProduceRequest_v2
+
+        return request_type(
             required_acks=acks,
             timeout=timeout,
             topics=[(
@@ -150,10 +168,11 @@ class KafkaProtocol(object):
                     partition,
                     [(0, 0, kafka.protocol.message.Message(msg.value, key=msg.key,
                                                            magic=msg.magic,
-                                                           attributes=msg.attributes))
+                                                           attributes=msg.attributes,
+                                                           timestamp=msg.timestamp))
                     for msg in payload.messages])
                 for partition, payload in topic_payloads.items()])
-            for topic, topic_payloads in group_by_topic_and_partition(payloads).items()])
+            for topic, topic_payloads in grouped.items()])
 
     @classmethod
     def decode_produce_response(cls, response):
@@ -161,14 +180,14 @@ class KafkaProtocol(object):
         Decode ProduceResponse to ProduceResponsePayload
 
         Arguments:
-            response: ProduceResponse
+            response: ProduceResponse (any version)
 
         Return: list of ProduceResponsePayload
         """
         return [
-            kafka.common.ProduceResponsePayload(topic, partition, error, offset)
+            kafka.common.ProduceResponsePayload(topic, *partition[:3])
             for topic, partitions in response.topics
-            for partition, error, offset in partitions
+            for partition in partitions
         ]
 
     @classmethod
@@ -370,19 +389,46 @@ class KafkaProtocol(object):
         ]
 
 
-def create_message(payload, key=None):
+def create_message(payload, key=None, magic=0, timestamp=None):
     """
     Construct a Message
 
     Arguments:
         payload: bytes, the payload to send to Kafka
         key: bytes, a key used for partition routing (optional)
+        magic: int, message format version; 1 adds a timestamp (optional)
+        timestamp: int, milliseconds since epoch for magic 1 messages
+            (optional, defaults to now)
 
     """
-    return kafka.common.Message(0, 0, key, payload)
+    if magic > 0 and timestamp is None:
+        timestamp = int(time.time() * 1000)
+    return kafka.common.Message(magic, 0, key, payload, timestamp)
+
 
+def _create_compressed_message(codec, payloads, key=None, compresslevel=None,
+                               magic=0, timestamp=None):
+    if codec == CODEC_LZ4 and magic > 0:
+        # the registered lz4 codec writes the broken frame header checksum
+        # of 0.8 / 0.9 brokers; magic 1 messages use standard LZ4 frames
+        encode = lz4_encode
+    else:
+        encode = get_codec(codec).encode
+    messages = [create_message(payload, pl_key, magic, timestamp)
+                for payload, pl_key in payloads]
+    message_set = KafkaProtocol._encode_message_set(messages)
 
-def create_gzip_message(payloads, key=None, compresslevel=None):
+    encoded = encode(message_set, compresslevel=compresslevel)
+    codec = ATTRIBUTE_CODEC_MASK & codec
+
+    if magic > 0 and timestamp is None:
+        timestamp = max([msg.timestamp for msg in messages] or
+                        [int(time.time() * 1000)])
+    return kafka.common.Message(magic, 0x00 | codec, key, encoded, timestamp)
+
+
+def create_gzip_message(payloads, key=None, compresslevel=None, magic=0,
+                        timestamp=None):
     """
     Construct a Gzipped Message containing multiple Messages
 
@@ -392,18 +438,14 @@ def create_gzip_message(payloads, key=None, compresslevel=None):
     Arguments:
         payloads: list(bytes), a list of payload to send be sent to Kafka
         key: bytes, a key used for partition routing (optional)
+        magic, timestamp: see create_message (optional)
 
     """
-    message_set = KafkaProtocol._encode_message_set(
-        [create_message(payload, pl_key) for payload, pl_key in payloads])
-
-    gzipped = gzip_encode(message_set, compresslevel=compresslevel)
-    codec = ATTRIBUTE_CODEC_MASK & CODEC_GZIP
-
-    return kafka.common.Message(0, 0x00 | codec, key, gzipped)
+    return _create_compressed_message(CODEC_GZIP, payloads, key, compresslevel,
+                                      magic, timestamp)
 
 
-def create_snappy_message(payloads, key=None):
+def create_snappy_message(payloads, key=None, magic=0, timestamp=None):
     """
     Construct a Snappy Message containing multiple Messages
 
@@ -413,28 +455,50 @@ def create_snappy_message(payloads, key=None):
     Arguments:
         payloads: list(bytes), a list of payload to send be sent to Kafka
         key: bytes, a key used for partition routing (optional)
+        magic, timestamp: see create_message (optional)
 
     """
-    message_set = KafkaProtocol._encode_message_set(
-        [create_message(payload, pl_key) for payload, pl_key in payloads])
+    return _create_compressed_message(CODEC_SNAPPY, payloads, key,
+                                      magic=magic, timestamp=timestamp)
 
-    snapped = snappy_encode(message_set)
-    codec = ATTRIBUTE_CODEC_MASK & CODEC_SNAPPY
 
-    return kafka.common.Message(0, 0x00 | codec, key, snapped)
+def create_lz4_message(payloads, key=None, compresslevel=None, magic=0,
+                       timestamp=None):
+    """
+    Construct an LZ4 Message containing multiple Messages
+
+    The given payloads will be encoded, compressed, and sent as a single atomic
+    message to Kafka.
+
+    Arguments:
+        payloads: list(bytes), a list of payload to send be sent to Kafka
+        key: bytes, a key used for partition routing (optional)
+        magic, timestamp: see create_message (optional)
+
+    """
+    return _create_compressed_message(CODEC_LZ4, payloads, key, compresslevel,
+                                      magic, timestamp)
 
 
-def create_message_set(messages, codec=CODEC_NONE, key=None, compresslevel=None):
+def create_message_set(messages, codec=CODEC_NONE, key=None, compresslevel=None,
+                       magic=0, timestamp=None):
     """Create a message set using the given codec.
 
     If codec is CODEC_NONE, return a list of raw Kafka messages. Otherwise,
-    return a list containing a single codec-encoded message.
+    return a list containing a single codec-encoded message. Codecs other
+    than gzip, snappy and lz4 are looked up in the kafka.codec registry.
+    magic=1 creates timestamped messages, which require 0.10 brokers.
     """
     if codec == CODEC_NONE:
-        return [create_message(m, k) for m, k in messages]
+        return [create_message(m, k, magic, timestamp) for m, k in messages]
     elif codec == CODEC_GZIP:
-        return [create_gzip_message(messages, key, compresslevel)]
+        return [create_gzip_message(messages, key, compresslevel, magic,
+                                    timestamp)]
     elif codec == CODEC_SNAPPY:
-        return [create_snappy_message(messages, key)]
+        return [create_snappy_message(messages, key, magic, timestamp)]
+    elif codec == CODEC_LZ4:
+        return [create_lz4_message(messages, key, compresslevel, magic,
+                                   timestamp)]
     else:
-        raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+        return [_create_compressed_message(codec, messages, key, compresslevel,
+                                           magic, timestamp)]
@@ -1,7 +1,15 @@
-import io
+from __future__ import absolute_import
 
-from ..codec import gzip_decode, snappy_decode
+import binascii
+import functools
+import struct
+import time
+
+from ..codec import get_codec, lz4_decode
 from . import pickle
+from .buffer import (
+    BufferList, MemoryViewReader, as_memoryview, tobytes
+)
 from .struct import Struct
 from .types import (
     Int8, Int32, Int64, Bytes, Schema, AbstractType
@@ -17,62 +25,212 @@ class Message(Struct):
         ('key', Bytes),
         ('value', Bytes)
     )
-    CODEC_MASK = 0x03
+    SCHEMA_V1 = Schema(
+        ('crc', Int32),
+        ('magic', Int8),
+        ('attributes', Int8),
+        ('timestamp', Int64),
+        ('key', Bytes),
+        ('value', Bytes)
+    )
+    CODEC_MASK = 0x07
     CODEC_GZIP = 0x01
     CODEC_SNAPPY = 0x02
+    CODEC_LZ4 = 0x03
+    TIMESTAMP_TYPE_MASK = 0x08 # magic 1 only
+    _HEADER = struct.Struct('>ibb') # crc, magic, attributes
+    _HEADER_V0 = struct.Struct('>ibbi') # crc, magic, attributes, key length
+    _HEADER_V1 = struct.Struct('>ibbqi') # ... attributes, timestamp, key length
+    # timestamp is only on the wire for magic 1 (between attributes and key)
+    __slots__ = ('crc', 'magic', 'attributes', 'timestamp', 'key', 'value')
 
-    def __init__(self, value, key=None, magic=0, attributes=0, crc=0):
+    def __init__(self, value, key=None, magic=0, attributes=0, crc=0,
+                 timestamp=None):
         assert value is None or isinstance(value, bytes), 'value must be bytes'
         assert key is None or isinstance(key, bytes), 'key must be bytes'
+        assert magic > 0 or timestamp is None, 'timestamp requires magic 1'
         self.crc = crc
         self.magic = magic
         self.attributes = attributes
+        if magic > 0 and timestamp is None:
+            timestamp = int(time.time() * 1000)
+        self.timestamp = timestamp
         self.key = key
         self.value = value
-        self.encode = self._encode_self
+
+    @property
+    def timestamp_type(self):
+        """0 for CreateTime, 1 for LogAppendTime, None for magic 0"""
+        if self.magic == 0:
+            return None
+        return 1 if self.attributes & self.TIMESTAMP_TYPE_MASK else 0
 
     def _encode_self(self, recalc_crc=True):
-        message = Message.SCHEMA.encode(
-          (self.crc, self.magic, self.attributes, self.key, self.value)
-        )
+        if self.magic == 0:
+            message = Message.SCHEMA.encode(
+              (self.crc, self.magic, self.attributes, self.key, self.value)
+            )
+        else:
+            message = Message.SCHEMA_V1.encode(
+              (self.crc, self.magic, self.attributes, self.timestamp,
+               self.key, self.value)
+            )
         if not recalc_crc:
             return message
         self.crc = crc32(message[4:])
         return self.SCHEMA.fields[0].encode(self.crc) + message[4:]
 
+    def _encode_self_into(self, buf, recalc_crc=True):
+        if not isinstance(buf, BufferList):
+            return self._encode_self_into_bytearray(buf, recalc_crc)
+        start = len(buf)
+        buf.extend(self._HEADER.pack(self.crc, self.magic, self.attributes))
+        if self.magic > 0:
+            Int64.encode_into(buf, self.timestamp)
+        Bytes.encode_into(buf, self.key)
+        Bytes.encode_into(buf, self.value)
+        if recalc_crc:
+            self.crc = buf.crc32(start + 4)
+            buf.pack_into(Int32._struct, start, self.crc)
+
+    def _encode_self_into_bytearray(self, buf, recalc_crc=True):
+        """_encode_self_into for a bytearray, which is most requests: the
+        crc is chained over the pieces as they are appended, rather than
+        computed over a view of the buffer afterwards"""
+        start = len(buf)
+        key = self.key
+        value = self.value
+        key_length = -1 if key is None else len(key)
+        if self.magic > 0:
+            header = self._HEADER_V1.pack(self.crc, self.magic, self.attributes,
+                                          self.timestamp, key_length)
+        else:
+            header = self._HEADER_V0.pack(self.crc, self.magic, self.attributes,
+                                          key_length)
+        value_length = Int32._struct.pack(-1 if value is None else len(value))
+        buf += header
+        if key is not None:
+            buf += key
+        buf += value_length
+        if value is not None:
+            buf += value
+        if recalc_crc:
+            crc = binascii.crc32(header[4:])
+            if key is not None:
+                crc = binascii.crc32(key, crc)
+            crc = binascii.crc32(value_length, crc)
+            if value is not None:
+                crc = binascii.crc32(value, crc)
+            crc &= 0xffffffff # signed on py2
+            if crc >= 2**31:
+                crc -= 2**32
+            self.crc = crc
+            Int32._struct.pack_into(buf, start, crc)
+
+    # Decoded messages copy their key and value out of the data they are
+    # decoded from, and keep no view of it: messages handed to user code
+    # must not pin the connection's receive buffer. Whole message sets are
+    # crc checked over their wire bytes instead (LazyMessageSet.validate_crcs)
     @classmethod
     def decode(cls, data):
-        if isinstance(data, bytes):
-            data = io.BytesIO(data)
-        fields = [field.decode(data) for field in cls.SCHEMA.fields]
-        return cls(fields[4], key=fields[3],
-                   magic=fields[1], attributes=fields[2], crc=fields[0])
+        if isinstance(data, (bytes, bytearray)):
+            data = MemoryViewReader(data)
+        (crc, magic, attributes) = cls._HEADER.unpack(data.read(cls._HEADER.size))
+        timestamp = Int64.decode(data) if magic > 0 else None
+        key = cls._decode_bytes(data)
+        value = cls._decode_bytes(data)
+        return cls(value, key=key, magic=magic, attributes=attributes,
+                   crc=crc, timestamp=timestamp)
+
+    @classmethod
+    def _decode_view(cls, view, start):
+        """Decode the message at view[start:] with unpack_from at fixed
+        offsets, rather than through a MemoryViewReader"""
+        crc, magic, attributes, length = cls._HEADER_V0.unpack_from(view, start)
+        if magic == 0:
+            timestamp = None
+            pos = start + cls._HEADER_V0.size
+        else:
+            crc, magic, attributes, timestamp, length = \
+                cls._HEADER_V1.unpack_from(view, start)
+            pos = start + cls._HEADER_V1.size
+        if length < 0:
+            key = None
+        else:
+            key = tobytes(view[pos:pos + length])
+            pos += length
+        length, = Int32._struct.unpack_from(view, pos)
+        pos += 4
+        if length < 0:
+            value = None
+        else:
+            value = tobytes(view[pos:pos + length])
+        msg = cls.__new__(cls)
+        msg.crc = crc
+        msg.magic = magic
+        msg.attributes = attributes
+        msg.timestamp = timestamp
+        msg.key = key
+        msg.value = value
+        return msg
+
+    @staticmethod
+    def _decode_bytes(data):
+        """Like Bytes.decode, but also copies out of memoryview reads"""
+        length = Int32.decode(data)
+        if length < 0:
+            return None
+        return tobytes(data.read(length))
 
     def validate_crc(self):
-        raw_msg = self._encode_self(recalc_crc=False)
-        crc = crc32(raw_msg[4:])
-        if crc == self.crc:
-            return True
-        return False
+        raw_msg = self._encode_self(recalc_crc=False)[4:]
+        return crc32(raw_msg) == self.crc
 
     def is_compressed(self):
         return self.attributes & self.CODEC_MASK != 0
 
     def decompress(self):
         codec = self.attributes & self.CODEC_MASK
-        assert codec in (self.CODEC_GZIP, self.CODEC_SNAPPY)
-        if codec == self.CODEC_GZIP:
-            raw_bytes = gzip_decode(self.value)
+        if codec == self.CODEC_LZ4 and self.magic > 0:
+            # magic 1 LZ4 frames have a correct header checksum, unlike
+            # those of 0.8 / 0.9 brokers (see lz4_decode_old_kafka)
+            raw_bytes = lz4_decode(self.value)
         else:
-            raw_bytes = snappy_decode(self.value)
+            raw_bytes = get_codec(codec).decode(self.value)
 
         return MessageSet.decode(raw_bytes, bytes_to_read=len(raw_bytes))
 
     def __hash__(self):
         return hash(self._encode_self(recalc_crc=False))
 
+    def __eq__(self, other):
+        return (super(Message, self).__eq__(other) and
+                self.timestamp == other.timestamp)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        state = super(Message, self).__getstate__()
+        state['timestamp'] = self.timestamp
+        return state
+
+    def __repr__(self):
+        if self.magic == 0:
+            return super(Message, self).__repr__()
+        return '%s, timestamp=%s)' % (
+            super(Message, self).__repr__()[:-1], self.timestamp)
+
 
 class PartialMessage(bytes):
+    """Leading bytes of a message that was cut off at the end of a fetch"""
+    def header(self):
+        """Return (offset, message_size) from the message set framing, or
+        None if too few bytes were received to read it"""
+        if len(self) < MessageSet.HEADER_SIZE:
+            return None
+        return MessageSet._HEADER.unpack_from(self)
+
     def __repr__(self):
         return 'PartialMessage(%s)' % self
 
@@ -83,6 +241,8 @@ class MessageSet(AbstractType):
         ('message_size', Int32),
         ('message', Message.SCHEMA)
     )
+    HEADER_SIZE = 12 # offset + message_size
+    _HEADER = struct.Struct('>qi')
 
     @classmethod
     def encode(cls, items, size=True, recalc_message_size=True):
@@ -94,51 +254,180 @@ class MessageSet(AbstractType):
                 encoded_message = cls.ITEM.fields[2].encode(message)
             if recalc_message_size:
                 message_size = len(encoded_message)
-            encoded_values.append(cls.ITEM.fields[0].encode(offset))
-            encoded_values.append(cls.ITEM.fields[1].encode(message_size))
+            encoded_values.append(cls._HEADER.pack(offset, message_size))
             encoded_values.append(encoded_message)
         encoded = b''.join(encoded_values)
         if not size:
             return encoded
         return Int32.encode(len(encoded)) + encoded
 
+    @classmethod
+    def encode_into(cls, buf, items, size=True, recalc_message_size=True):
+        """Append the encoded set to buf (a bytearray or BufferList),
+        back-patching the set size and each message_size once the messages
+        are written"""
+        if isinstance(buf, BufferList):
+            patch = functools.partial(buf.pack_into, Int32._struct)
+        else:
+            patch = functools.partial(Int32._struct.pack_into, buf)
+        pack_header = cls._HEADER.pack
+        if size:
+            size_pos = len(buf)
+            buf.extend(Int32._struct.pack(0))
+        start = len(buf)
+        for (offset, message_size, message) in items:
+            if recalc_message_size:
+                message_size = 0 # back-patched below
+            header_pos = len(buf)
+            buf.extend(pack_header(offset, message_size))
+            message_start = len(buf)
+            if isinstance(message, Message):
+                message._encode_self_into(buf)
+            else:
+                cls.ITEM.fields[2].encode_into(buf, message)
+            if recalc_message_size:
+                patch(header_pos + 8, len(buf) - message_start)
+        if size:
+            patch(size_pos, len(buf) - start)
+
     @classmethod
     def decode(cls, data, bytes_to_read=None):
         """Compressed messages should pass in bytes_to_read (via message size)
         otherwise, we decode from data as Int32
+
+        Only the offset / message_size framing is scanned here; the returned
+        LazyMessageSet decodes each Message when it is first accessed.
         """
-        if isinstance(data, bytes):
-            data = io.BytesIO(data)
+        if isinstance(data, (bytes, bytearray)):
+            data = MemoryViewReader(data)
         if bytes_to_read is None:
             bytes_to_read = Int32.decode(data)
-        items = []
+        view = as_memoryview(data.read(bytes_to_read))
+        offsets = []
+        positions = []
+        sizes = []
+        pos = 0
 
         # We need at least 8 + 4 + 14 bytes to read offset + message size + message
         # (14 bytes is a message w/ null key and null value)
-        while bytes_to_read >= 26:
-            offset = Int64.decode(data)
-            bytes_to_read -= 8
-
-            message_size = Int32.decode(data)
-            bytes_to_read -= 4
+        while bytes_to_read - pos >= 26:
+            offset, message_size = cls._HEADER.unpack_from(view, pos)
 
             # if FetchRequest max_bytes is smaller than the available message set
             # the server returns partial data for the final message
-            if message_size > bytes_to_read:
+            if message_size > bytes_to_read - pos - cls.HEADER_SIZE:
                 break
+            pos += cls.HEADER_SIZE
 
-            message = Message.decode(data)
-            bytes_to_read -= message_size
-
-            items.append((offset, message_size, message))
+            offsets.append(offset)
+            positions.append(pos)
+            sizes.append(message_size)
+            pos += message_size
 
-        # If any bytes are left over, clear them from the buffer
-        # and append a PartialMessage to signal that max_bytes may be too small
-        if bytes_to_read:
-            items.append((None, None, PartialMessage(data.read(bytes_to_read))))
+        # If any bytes are left over, keep them as a PartialMessage
+        # to signal that max_bytes may be too small
+        partial = None
+        if pos < bytes_to_read:
+            partial = PartialMessage(tobytes(view[pos:]))
 
-        return items
+        return LazyMessageSet(view, offsets, positions, sizes, partial)
 
     @classmethod
     def repr(cls, messages):
         return '[' + ', '.join([cls.ITEM.repr(m) for m in messages]) + ']'
+
+
+class LazyMessageSet(object):
+    """A decoded MessageSet that materializes Messages on demand
+
+    Behaves like the list of (offset, message_size, message) tuples that
+    MessageSet.decode used to return -- including a trailing
+    (None, None, PartialMessage) item when the set was truncated -- but
+    each Message is only decoded (and then cached) when its item is
+    accessed. Sets that are discarded or only partially iterated never pay
+    for the messages they skip.
+    """
+    def __init__(self, view, offsets, positions, sizes, partial=None):
+        self._view = view
+        self._offsets = offsets
+        self._positions = positions
+        self._sizes = sizes
+        self._messages = [None] * len(offsets)
+        self._partial = partial
+
+    @property
+    def offsets(self):
+        """Offsets of the complete messages, without decoding them"""
+        return list(self._offsets)
+
+    @property
+    def partial(self):
+        """Trailing PartialMessage, or None"""
+        return self._partial
+
+    def _item(self, i):
+        message = self._messages[i]
+        if message is None:
+            message = Message._decode_view(self._view, self._positions[i])
+            self._messages[i] = message
+        return (self._offsets[i], self._sizes[i], message)
+
+    def validate_crcs(self):
+        """Check the CRC of every complete message in one pass
+
+        Runs directly over the raw framing, so messages are not decoded.
+        Returns False if any message is corrupt; decode and validate_crc()
+        the messages individually to find which.
+        """
+        view = self._view
+        unpack_crc = Int32._struct.unpack_from
+        for start, size in zip(self._positions, self._sizes):
+            if size < 4:
+                return False
+            if crc32(view[start + 4:start + size]) != unpack_crc(view, start)[0]:
+                return False
+        return True
+
+    def __len__(self):
+        return len(self._offsets) + (self._partial is not None)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('LazyMessageSet index out of range')
+        if index == len(self._offsets):
+            return (None, None, self._partial)
+        return self._item(index)
+
+    def __iter__(self):
+        item = self._item
+        for i in range(len(self._offsets)):
+            yield item(i)
+        if self._partial is not None:
+            yield (None, None, self._partial)
+
+    def pop(self, index=-1):
+        item = self[index]
+        if index < 0:
+            index += len(self)
+        if index == len(self._offsets):
+            self._partial = None
+        else:
+            for items in (self._offsets, self._positions, self._sizes, self._messages):
+                del items[index]
+        return item
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyMessageSet(%s)' % MessageSet.repr(self)
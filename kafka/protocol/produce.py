@@ -27,3 +27,38 @@ class ProduceRequest(Struct):
                 ('partition', Int32),
                 ('messages', MessageSet)))))
     )
+
+
+class ProduceResponse_v1(Struct):
+    SCHEMA = Schema(
+        ('topics', Array(
+            ('topic', String('utf-8')),
+            ('partitions', Array(
+                ('partition', Int32),
+                ('error_code', Int16),
+                ('offset', Int64))))),
+        ('throttle_time_ms', Int32)
+    )
+
+
+class ProduceResponse_v2(Struct):
+    SCHEMA = Schema(
+        ('topics', Array(
+            ('topic', String('utf-8')),
+            ('partitions', Array(
+                ('partition', Int32),
+                ('error_code', Int16),
+                ('offset', Int64),
+                ('timestamp', Int64))))),
+        ('throttle_time_ms', Int32)
+    )
+
+
+class ProduceRequest_v1(ProduceRequest):
+    API_VERSION = 1 # response adds throttle_time_ms
+    RESPONSE_TYPE = ProduceResponse_v1
+
+
+class ProduceRequest_v2(ProduceRequest):
+    API_VERSION = 2 # accepts magic 1 messages; response adds timestamp
+    RESPONSE_TYPE = ProduceResponse_v2
@@ -1,47 +1,97 @@
-#from collections import namedtuple
 from io import BytesIO
 
+import six
+
 from .abstract import AbstractType
 from .types import Schema
 
 
+class MetaStruct(type(AbstractType)):
+    """Generates __slots__ for a Struct subclass from the names of its SCHEMA
+
+    Structs are held in large numbers (every fetched Message is one), so
+    instances keep their fields in slots rather than a per-object __dict__.
+    Classes that define __slots__ themselves are left alone. The base is
+    type(AbstractType): ABCMeta on py2, where AbstractType's __metaclass__
+    applies, and plain type on py3.
+    """
+    def __new__(mcs, name, bases, dct):
+        if '__slots__' not in dct:
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(getattr(klass, '__slots__', ()))
+            schema = dct.get('SCHEMA')
+            names = schema.names if schema is not None else ()
+            dct['__slots__'] = tuple([n for n in names if n not in inherited])
+        return super(MetaStruct, mcs).__new__(mcs, name, bases, dct)
+
+
+class _StructEncode(object):
+    """encode() / encode_into() are classmethods when looked up on a Struct
+    class (encoding a tuple of field values) and resolve to _encode_self() /
+    _encode_self_into() when looked up on an instance"""
+    def __init__(self, encode_item, instance_method):
+        self._encode_item = encode_item
+        self._instance_method = instance_method
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self._encode_item.__get__(cls, type(cls))
+        return getattr(obj, self._instance_method)
+
+
+@six.add_metaclass(MetaStruct)
 class Struct(AbstractType):
     SCHEMA = Schema()
 
     def __init__(self, *args, **kwargs):
         if len(args) == len(self.SCHEMA.fields):
-            for i, name in enumerate(self.SCHEMA.names):
-                self.__dict__[name] = args[i]
+            for name, arg in zip(self.SCHEMA.names, args):
+                setattr(self, name, arg)
         elif len(args) > 0:
             raise ValueError('Args must be empty or mirror schema')
         else:
-            self.__dict__.update(kwargs)
+            for name, value in six.iteritems(kwargs):
+                setattr(self, name, value)
 
-        # overloading encode() to support both class and instance
-        self.encode = self._encode_self
+    def _encode_item(cls, item): # pylint: disable=no-self-argument
+        return cls.SCHEMA.encode(item)
+    encode = _StructEncode(_encode_item, '_encode_self')
 
-    @classmethod
-    def encode(cls, item): # pylint: disable=E0202
-        bits = []
-        for i, field in enumerate(cls.SCHEMA.fields):
-            bits.append(field.encode(item[i]))
-        return b''.join(bits)
+    def _encode_item_into(cls, buf, item): # pylint: disable=no-self-argument
+        cls.SCHEMA.encode_into(buf, item)
+    encode_into = _StructEncode(_encode_item_into, '_encode_self_into')
 
     def _encode_self(self):
         return self.SCHEMA.encode(
-            [self.__dict__[name] for name in self.SCHEMA.names]
+            [getattr(self, name) for name in self.SCHEMA.names]
+        )
+
+    def _encode_self_into(self, buf):
+        self.SCHEMA.encode_into(
+            buf, [getattr(self, name) for name in self.SCHEMA.names]
         )
 
     @classmethod
     def decode(cls, data):
         if isinstance(data, bytes):
             data = BytesIO(data)
-        return cls(*[field.decode(data) for field in cls.SCHEMA.fields])
+        return cls(*cls.SCHEMA.decode(data))
+
+    # slots have no __dict__ for pickle / copy to fall back on
+    def __getstate__(self):
+        return dict([(name, getattr(self, name))
+                     for name in self.SCHEMA.names if hasattr(self, name)])
+
+    def __setstate__(self, state):
+        for name, value in six.iteritems(state):
+            setattr(self, name, value)
 
     def __repr__(self):
         key_vals = []
         for name, field in zip(self.SCHEMA.names, self.SCHEMA.fields):
-            key_vals.append('%s=%s' % (name, field.repr(self.__dict__[name])))
+            key_vals.append('%s=%s' % (name, field.repr(getattr(self, name))))
         return self.__class__.__name__ + '(' + ', '.join(key_vals) + ')'
 
     def __hash__(self):
@@ -51,14 +101,6 @@ class Struct(AbstractType):
         if self.SCHEMA != other.SCHEMA:
             return False
         for attr in self.SCHEMA.names:
-            if self.__dict__[attr] != other.__dict__[attr]:
+            if getattr(self, attr) != getattr(other, attr):
                 return False
         return True
-
-"""
-class MetaStruct(type):
-    def __new__(cls, clsname, bases, dct):
-        nt = namedtuple(clsname, [name for (name, _) in dct['SCHEMA']])
-        bases = tuple([Struct, nt] + list(bases))
-        return super(MetaStruct, cls).__new__(cls, clsname, bases, dct)
-"""
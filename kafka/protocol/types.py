@@ -1,51 +1,81 @@
 from __future__ import absolute_import
 
-from struct import pack, unpack
+import itertools
+import struct
 
 from .abstract import AbstractType
+from .buffer import extend_value, tobytes
 
 
 class Int8(AbstractType):
+    fmt = 'b'
+    _struct = struct.Struct('>' + fmt)
+
     @classmethod
     def encode(cls, value):
-        return pack('>b', value)
+        return cls._struct.pack(value)
+
+    @classmethod
+    def encode_into(cls, buf, value):
+        buf.extend(cls._struct.pack(value))
 
     @classmethod
     def decode(cls, data):
-        (value,) = unpack('>b', data.read(1))
+        (value,) = cls._struct.unpack(data.read(1))
         return value
 
 
 class Int16(AbstractType):
+    fmt = 'h'
+    _struct = struct.Struct('>' + fmt)
+
     @classmethod
     def encode(cls, value):
-        return pack('>h', value)
+        return cls._struct.pack(value)
+
+    @classmethod
+    def encode_into(cls, buf, value):
+        buf.extend(cls._struct.pack(value))
 
     @classmethod
     def decode(cls, data):
-        (value,) = unpack('>h', data.read(2))
+        (value,) = cls._struct.unpack(data.read(2))
         return value
 
 
 class Int32(AbstractType):
+    fmt = 'i'
+    _struct = struct.Struct('>' + fmt)
+
     @classmethod
     def encode(cls, value):
-        return pack('>i', value)
+        return cls._struct.pack(value)
+
+    @classmethod
+    def encode_into(cls, buf, value):
+        buf.extend(cls._struct.pack(value))
 
     @classmethod
     def decode(cls, data):
-        (value,) = unpack('>i', data.read(4))
+        (value,) = cls._struct.unpack(data.read(4))
         return value
 
 
 class Int64(AbstractType):
+    fmt = 'q'
+    _struct = struct.Struct('>' + fmt)
+
     @classmethod
     def encode(cls, value):
-        return pack('>q', value)
+        return cls._struct.pack(value)
+
+    @classmethod
+    def encode_into(cls, buf, value):
+        buf.extend(cls._struct.pack(value))
 
     @classmethod
     def decode(cls, data):
-        (value,) = unpack('>q', data.read(8))
+        (value,) = cls._struct.unpack(data.read(8))
         return value
 
 
@@ -59,11 +89,19 @@ class String(AbstractType):
         value = str(value).encode(self.encoding)
         return Int16.encode(len(value)) + value
 
+    def encode_into(self, buf, value):
+        if value is None:
+            Int16.encode_into(buf, -1)
+            return
+        value = str(value).encode(self.encoding)
+        Int16.encode_into(buf, len(value))
+        buf.extend(value)
+
     def decode(self, data):
         length = Int16.decode(data)
         if length < 0:
             return None
-        return data.read(length).decode(self.encoding)
+        return tobytes(data.read(length)).decode(self.encoding)
 
 
 class Bytes(AbstractType):
@@ -74,12 +112,20 @@ class Bytes(AbstractType):
         else:
             return Int32.encode(len(value)) + value
 
+    @classmethod
+    def encode_into(cls, buf, value):
+        if value is None:
+            Int32.encode_into(buf, -1)
+        else:
+            Int32.encode_into(buf, len(value))
+            extend_value(buf, value)
+
     @classmethod
     def decode(cls, data):
         length = Int32.decode(data)
         if length < 0:
             return None
-        return data.read(length)
+        return tobytes(data.read(length))
 
 
 class Schema(AbstractType):
@@ -88,17 +134,66 @@ class Schema(AbstractType):
             self.names, self.fields = zip(*fields)
         else:
             self.names, self.fields = (), ()
+        self._steps = self._compile(self.fields)
+
+        # A schema made up only of fixed-width fields can itself be fused
+        # into a single struct format (see Array)
+        if self.fields and all([_fmt(field) for field in self.fields]):
+            self.fmt = ''.join([field.fmt for field in self.fields])
+        else:
+            self.fmt = None
+
+    @staticmethod
+    def _compile(fields):
+        """Group runs of adjacent fixed-width fields into struct.Struct objects
+
+        Returns a list of (packer, start, stop) steps. packer is a compiled
+        struct.Struct covering fields[start:stop], or None for a single
+        variable-width field at fields[start].
+        """
+        steps = []
+        i = 0
+        while i < len(fields):
+            if not _fmt(fields[i]):
+                steps.append((None, i, i + 1))
+                i += 1
+                continue
+            start = i
+            while i < len(fields) and _fmt(fields[i]):
+                i += 1
+            fmt = '>' + ''.join([field.fmt for field in fields[start:i]])
+            steps.append((struct.Struct(fmt), start, i))
+        return steps
 
     def encode(self, item):
         if len(item) != len(self.fields):
             raise ValueError('Item field count does not match Schema')
-        return b''.join([
-            field.encode(item[i])
-            for i, field in enumerate(self.fields)
-        ])
+        bits = []
+        for packer, start, stop in self._steps:
+            if packer is None:
+                bits.append(self.fields[start].encode(item[start]))
+            else:
+                bits.append(packer.pack(*item[start:stop]))
+        return b''.join(bits)
+
+    def encode_into(self, buf, item):
+        """Append the encoding of item to the bytearray buf"""
+        if len(item) != len(self.fields):
+            raise ValueError('Item field count does not match Schema')
+        for packer, start, stop in self._steps:
+            if packer is None:
+                self.fields[start].encode_into(buf, item[start])
+            else:
+                buf.extend(packer.pack(*item[start:stop]))
 
     def decode(self, data):
-        return tuple([field.decode(data) for field in self.fields])
+        values = []
+        for packer, start, _ in self._steps:
+            if packer is None:
+                values.append(self.fields[start].decode(data))
+            else:
+                values.extend(packer.unpack(data.read(packer.size)))
+        return tuple(values)
 
     def __len__(self):
         return len(self.fields)
@@ -128,14 +223,43 @@ class Array(AbstractType):
             raise ValueError('Array instantiated with no array_of type')
 
     def encode(self, items):
+        fmt = _fmt(self.array_of)
+        if fmt:
+            # fixed-width items are packed in a single call
+            length = len(items)
+            if len(fmt) > 1:
+                items = itertools.chain.from_iterable(items)
+            return struct.pack('>i' + fmt * length, length, *items)
         return b''.join(
             [Int32.encode(len(items))] +
             [self.array_of.encode(item) for item in items]
         )
 
+    def encode_into(self, buf, items):
+        fmt = _fmt(self.array_of)
+        if fmt:
+            buf.extend(self.encode(items))
+            return
+        Int32.encode_into(buf, len(items))
+        for item in items:
+            self.array_of.encode_into(buf, item)
+
     def decode(self, data):
         length = Int32.decode(data)
+        fmt = _fmt(self.array_of)
+        if fmt and length > 0:
+            # fixed-width items are read and unpacked in a single call
+            packer = struct.Struct('>' + fmt * length)
+            values = packer.unpack(data.read(packer.size))
+            if len(fmt) == 1:
+                return list(values)
+            return list(zip(*[iter(values)] * len(fmt)))
         return [self.array_of.decode(data) for _ in range(length)]
 
     def repr(self, list_of_items):
         return '[' + ', '.join([self.array_of.repr(item) for item in list_of_items]) + ']'
+
+
+def _fmt(field):
+    """Return the struct format of a fixed-width field, or None"""
+    return getattr(field, 'fmt', None)
@@ -0,0 +1,214 @@
+"""Minimal stand-in for the python 3.4+ selectors module on python 2
+
+KafkaClient imports the standard library selectors module, then the
+selectors34 backport, and only falls back to this module when neither is
+available. It covers just the subset the client uses: DefaultSelector with
+register / modify / unregister / get_key / select / close, and the
+EVENT_READ / EVENT_WRITE masks. DefaultSelector uses epoll or poll where the
+platform has them (neither is capped at FD_SETSIZE), else select.
+"""
+from __future__ import absolute_import
+
+import collections
+import errno
+import select
+import time
+
+
+EVENT_READ = (1 << 0)
+EVENT_WRITE = (1 << 1)
+
+SelectorKey = collections.namedtuple('SelectorKey',
+    ['fileobj', 'fd', 'events', 'data'])
+
+
+def _fileobj_to_fd(fileobj):
+    if isinstance(fileobj, int):
+        fd = fileobj
+    else:
+        fd = int(fileobj.fileno())
+    if fd < 0:
+        raise ValueError('Invalid file descriptor: %s' % fd)
+    return fd
+
+
+def _is_eintr(error):
+    return getattr(error, 'errno', None) == errno.EINTR or (
+        error.args and error.args[0] == errno.EINTR)
+
+
+class _BaseSelector(object):
+    def __init__(self):
+        self._fd_to_key = {}
+
+    def register(self, fileobj, events, data=None):
+        if not events or events & ~(EVENT_READ | EVENT_WRITE):
+            raise ValueError('Invalid events: %r' % events)
+        key = SelectorKey(fileobj, _fileobj_to_fd(fileobj), events, data)
+        if key.fd in self._fd_to_key:
+            raise KeyError('%r (FD %d) is already registered' % (fileobj, key.fd))
+        self._fd_to_key[key.fd] = key
+        return key
+
+    def unregister(self, fileobj):
+        return self._fd_to_key.pop(self._key_fd(fileobj))
+
+    def modify(self, fileobj, events, data=None):
+        key = self.get_key(fileobj)
+        if events != key.events:
+            self.unregister(fileobj)
+            return self.register(fileobj, events, data)
+        key = key._replace(data=data)
+        self._fd_to_key[key.fd] = key
+        return key
+
+    def get_key(self, fileobj):
+        return self._fd_to_key[self._key_fd(fileobj)]
+
+    def get_map(self):
+        return dict([(key.fileobj, key) for key in self._fd_to_key.values()])
+
+    def select(self, timeout=None):
+        raise NotImplementedError
+
+    def close(self):
+        self._fd_to_key.clear()
+
+    def _key_fd(self, fileobj):
+        try:
+            return _fileobj_to_fd(fileobj)
+        except ValueError:
+            # a closed socket no longer has its fd: search the registrations
+            for key in self._fd_to_key.values():
+                if key.fileobj is fileobj:
+                    return key.fd
+            raise KeyError('%r is not registered' % (fileobj,))
+
+    def _ready(self, fd, events):
+        key = self._fd_to_key.get(fd)
+        if key is None:
+            return None
+        return (key, events & key.events)
+
+
+class SelectSelector(_BaseSelector):
+    def select(self, timeout=None):
+        if timeout is not None:
+            timeout = max(timeout, 0)
+        readers = [key.fd for key in self._fd_to_key.values()
+                   if key.events & EVENT_READ]
+        writers = [key.fd for key in self._fd_to_key.values()
+                   if key.events & EVENT_WRITE]
+        if not readers and not writers:
+            # select() with three empty lists fails on windows
+            if timeout:
+                time.sleep(timeout)
+            return []
+        try:
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+        except (select.error, IOError, OSError) as e:
+            if _is_eintr(e):
+                return []
+            raise
+        readable = set(readable)
+        writable = set(writable)
+        ready = []
+        for fd in readable | writable:
+            events = ((fd in readable and EVENT_READ) |
+                      (fd in writable and EVENT_WRITE))
+            item = self._ready(fd, events)
+            if item is not None:
+                ready.append(item)
+        return ready
+
+
+class _PollLikeSelector(_BaseSelector):
+    _READ = _WRITE = 0
+
+    def __init__(self):
+        super(_PollLikeSelector, self).__init__()
+        self._poller = self._new_poller()
+
+    def _new_poller(self):
+        raise NotImplementedError
+
+    def _mask(self, events):
+        return ((events & EVENT_READ and self._READ) |
+                (events & EVENT_WRITE and self._WRITE))
+
+    def register(self, fileobj, events, data=None):
+        key = super(_PollLikeSelector, self).register(fileobj, events, data)
+        self._poller.register(key.fd, self._mask(events))
+        return key
+
+    def unregister(self, fileobj):
+        key = super(_PollLikeSelector, self).unregister(fileobj)
+        try:
+            self._poller.unregister(key.fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass # the fd was already closed
+        return key
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+    def select(self, timeout=None):
+        try:
+            fd_events = self._poll(timeout)
+        except (select.error, IOError, OSError) as e:
+            if _is_eintr(e):
+                return []
+            raise
+        ready = []
+        for fd, mask in fd_events:
+            events = 0
+            if mask & ~self._WRITE:
+                events |= EVENT_READ # includes hangups and errors
+            if mask & ~self._READ:
+                events |= EVENT_WRITE
+            item = self._ready(fd, events)
+            if item is not None:
+                ready.append(item)
+        return ready
+
+
+if hasattr(select, 'poll'):
+    class PollSelector(_PollLikeSelector):
+        _READ = select.POLLIN
+        _WRITE = select.POLLOUT
+
+        def _new_poller(self):
+            return select.poll()
+
+        def _poll(self, timeout):
+            if timeout is not None:
+                timeout = max(0, int(timeout * 1000 + 0.5)) # milliseconds
+            return self._poller.poll(timeout)
+
+
+if hasattr(select, 'epoll'):
+    class EpollSelector(_PollLikeSelector):
+        _READ = select.EPOLLIN
+        _WRITE = select.EPOLLOUT
+
+        def _new_poller(self):
+            return select.epoll()
+
+        def _poll(self, timeout):
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout = max(timeout, 0)
+            return self._poller.poll(timeout, max(len(self._fd_to_key), 1))
+
+        def close(self):
+            self._poller.close()
+            super(EpollSelector, self).close()
+
+
+if 'EpollSelector' in globals():
+    DefaultSelector = EpollSelector
+elif 'PollSelector' in globals():
+    DefaultSelector = PollSelector
+else:
+    DefaultSelector = SelectSelector
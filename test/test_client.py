@@ -390,17 +390,21 @@ class TestSimpleClient(unittest.TestCase):
             client.send_produce_request(requests)
 
     def test_timeout(self):
+        sock = MagicMock()
         def _timeout(*args, **kwargs):
-            timeout = args[1]
+            timeout = sock.settimeout.call_args[0][0]
             sleep(timeout)
             raise socket.timeout
+        sock.connect.side_effect = _timeout
 
-        with patch.object(socket, "create_connection", side_effect=_timeout):
+        resolved = [(socket.AF_INET, ('10.0.0.1', 1234))]
+        with patch('kafka.conn.dns_cache.resolve', return_value=resolved):
+            with patch.object(socket, "socket", return_value=sock):
 
-            with Timer() as t:
-                with self.assertRaises(ConnectionError):
-                    KafkaConnection("nowhere", 1234, 1.0)
-            self.assertGreaterEqual(t.interval, 1.0)
+                with Timer() as t:
+                    with self.assertRaises(ConnectionError):
+                        KafkaConnection("nowhere", 1234, 1.0)
+                self.assertGreaterEqual(t.interval, 1.0)
 
     def test_correlation_rollover(self):
         with patch.object(SimpleClient, 'load_metadata_for_topics'):
@@ -1,12 +1,24 @@
+import json
+import os
+import socket
+import select
+import struct
+import threading
 import time
 
 import pytest
 
-from kafka.client_async import KafkaClient
+from kafka.client_async import (
+    ApiVersionCache, KafkaClient, ThreadedKafkaClient, selectors
+)
+from kafka.cluster import ClusterMetadata
 from kafka.common import BrokerMetadata
 import kafka.common as Errors
-from kafka.conn import ConnectionStates
+from kafka.conn import ConnectionStates, HAS_SENDMSG, _has_large_values
 from kafka.future import Future
+from kafka.protocol.api import RequestHeader, encode_request
+from kafka.protocol.fetch import FetchRequest, FetchResponse
+from kafka.protocol.message import Message
 from kafka.protocol.metadata import MetadataResponse, MetadataRequest
 from kafka.protocol.produce import ProduceRequest
 
@@ -40,6 +52,7 @@ def conn(mocker):
             [(0, 'foo', 12), (1, 'bar', 34)],  # brokers
             []))  # topics
     conn.blacked_out.return_value = False
+    conn.has_pending_sends.return_value = False
     conn.connect.return_value = conn.state
     return conn
 
@@ -64,6 +77,38 @@ def test_bootstrap_failure(conn):
     assert cli.cluster.brokers() == set()
 
 
+def test_bootstrap_parallel(mocker):
+    # the first host never completes its connect: its socket is the read
+    # end of a pipe, which never selects writable
+    blackholed_fd, write_fd = os.pipe()
+    blackholed = mocker.MagicMock(state=ConnectionStates.CONNECTING)
+    blackholed._sock = blackholed_fd
+    blackholed.connect.return_value = ConnectionStates.CONNECTING
+    def close():
+        blackholed.state = ConnectionStates.DISCONNECTED
+    blackholed.close.side_effect = close
+
+    good = mocker.MagicMock(state=ConnectionStates.CONNECTED)
+    good.send.return_value = Future().success(
+        MetadataResponse([(0, 'foo', 12)], []))
+
+    conns = mocker.patch('kafka.client_async.BrokerConnection',
+                         side_effect=[blackholed, good])
+    try:
+        start = time.time()
+        cli = KafkaClient(bootstrap_servers=['slow:1', 'fast:2'],
+                          bootstrap_connect_stagger_ms=10)
+        assert time.time() - start < 5
+    finally:
+        os.close(blackholed_fd)
+        os.close(write_fd)
+    assert conns.call_count == 2
+    good.send.assert_called_once_with(MetadataRequest([]))
+    blackholed.close.assert_called_with()
+    assert cli._bootstrap_fails == 0
+    assert cli.cluster.brokers() == set([BrokerMetadata(0, 'foo', 12)])
+
+
 def test_can_connect(conn):
     cli = KafkaClient()
 
@@ -187,7 +232,7 @@ def test_ready(conn):
     assert cli._conns[0].connect.called_with()
 
 
-def test_close(conn):
+def test_close(mocker, conn):
     cli = KafkaClient()
 
     # Unknown node - silent
@@ -201,8 +246,10 @@ def test_close(conn):
 
     # All node close
     cli._initiate_connect(1)
+    close = mocker.spy(cli._selector, 'close')
     cli.close()
     assert conn.close.call_count == 3
+    assert close.call_count == 1
 
 
 def test_is_disconnected(conn):
@@ -272,8 +319,307 @@ def test_poll(mocker):
     _poll.assert_called_with(cli.config['request_timeout_ms'] / 1000.0)
 
 
-def test__poll():
-    pass
+@pytest.fixture
+def server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    yield server
+    server.close()
+
+
+def _connect(mocker, cli, server):
+    mocker.patch.object(cli.cluster, 'broker_metadata', return_value=
+                        BrokerMetadata(0, '127.0.0.1', server.getsockname()[1]))
+    # connecting sockets are polled for writability, then readability
+    cli._initiate_connect(0)
+    conn = cli._conns[0]
+    for _ in range(50):
+        if conn.connected():
+            break
+        cli._poll(0.1)
+    assert conn.connected()
+    assert cli._selector.get_key(conn._sock).events == selectors.EVENT_READ
+    peer, _ = server.accept()
+    return conn, peer
+
+
+def _respond(peer, *responses):
+    frames = []
+    for response in responses:
+        size, = struct.unpack('>i', peer.recv(4))
+        request = peer.recv(size, socket.MSG_WAITALL)
+        correlation_id = request[4:8] # after api key and version
+        response = correlation_id + response.encode()
+        frames.append(struct.pack('>i', len(response)) + response)
+    peer.sendall(b''.join(frames))
+
+
+def test_poll_and_reconnect_after_close(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient()
+    mocker.patch.object(cli, '_maybe_refresh_metadata', return_value=9999999)
+    try:
+        conn, peer = _connect(mocker, cli, server)
+        selector = cli._selector
+        cli.close()
+        peer.close()
+        assert cli._selector is None
+
+        # polling creates a new selector
+        assert cli.poll(timeout_ms=0) == []
+        assert cli._selector is not None and cli._selector is not selector
+
+        # and a reconnected node is registered with it
+        conn, peer = _connect(mocker, cli, server)
+        future = conn.send(MetadataRequest([]))
+        _respond(peer, MetadataResponse([], []))
+        cli.poll(future=future)
+        assert future.succeeded()
+        peer.close()
+    finally:
+        cli.close()
+
+
+def test__poll(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient()
+    try:
+        conn, peer = _connect(mocker, cli, server)
+
+        future = conn.send(MetadataRequest([]))
+        _respond(peer, MetadataResponse([], []))
+        assert cli._poll(1.0) == [MetadataResponse([], [])]
+        assert future.succeeded()
+
+        # a readable socket without in-flight requests is closed
+        peer.close()
+        cli._poll(1.0)
+        assert conn.state is ConnectionStates.DISCONNECTED
+        assert not cli._selector.get_map()
+    finally:
+        cli.close()
+
+
+def test_send_buffers_without_blocking(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient(send_buffer_bytes=4096)
+    try:
+        conn, peer = _connect(mocker, cli, server)
+        mocker.patch.object(cli, 'is_ready', return_value=True)
+        value = b'x' * 4 * 1024 * 1024
+        request = ProduceRequest(0, 0, [('foo', [(0, [
+            (0, None, Message(value))])])])
+        future = cli.send(0, request)
+        # acks=0 still completes only once the request has been written
+        assert not future.is_done
+        assert conn.has_pending_sends()
+        if HAS_SENDMSG:
+            # the message value is referenced by the send buffer, not copied
+            # (a partial write leaves a memoryview of what remains)
+            assert any([getattr(buf, 'obj', buf) is value
+                        for buf in conn._send_buffer])
+        key = cli._selector.get_key(conn._sock)
+        assert key.events == selectors.EVENT_READ | selectors.EVENT_WRITE
+
+        peer.setblocking(False)
+        received = []
+        for _ in range(10000):
+            try:
+                received.append(peer.recv(1024 * 1024))
+            except socket.error:
+                pass
+            cli._poll(0.01)
+            if not conn.has_pending_sends():
+                break
+        assert future.succeeded()
+        peer.setblocking(True)
+        expected = encode_request(RequestHeader(
+            request, correlation_id=1, client_id=cli.config['client_id']),
+            request)
+        while sum(map(len, received)) < len(expected):
+            received.append(peer.recv(1024 * 1024))
+        assert b''.join(received) == expected
+        assert cli._selector.get_key(conn._sock).events == selectors.EVENT_READ
+    finally:
+        cli.close()
+
+
+@pytest.mark.parametrize("req, expected", [
+    (MetadataRequest([]), False),
+    (ProduceRequest(0, 0, [('foo', [(0, [
+        (0, None, Message(b'x' * 100))])])]), False),
+    (ProduceRequest(0, 0, [('foo', [(0, [
+        (0, None, Message(b'x' * 100)),
+        (1, None, Message(b'x' * 4096))])])]), True),
+    (ProduceRequest(0, 0, [('foo', [(0, [
+        (0, None, Message(b'x', key=b'k' * 4096))])])]), True),
+    (ProduceRequest(0, 0, [('foo', [(0, [
+        (0, None, (0, 0, 0, None, b'x' * 4096))])])]), True),
+])
+def test_has_large_values(req, expected):
+    # only these are worth encoding as referencing buffers
+    assert _has_large_values(req, 4096) is expected
+
+
+def test_reap_idle_connections(mocker, conn):
+    cli = KafkaClient(connections_max_idle_ms=1000)
+    assert cli._idle_reap_at is None
+    cli._initiate_connect(0)
+    assert cli._idle_reap_at is not None
+    assert cli._delayed_tasks.next_at() > 0
+
+    now = time.time()
+    def mock_conn(last_activity, in_flight=0):
+        c = mocker.MagicMock()
+        c.state = ConnectionStates.CONNECTED
+        c.last_activity = last_activity
+        c.in_flight_requests = [None] * in_flight
+        c.has_pending_sends.return_value = False
+        return c
+    idle, busy, recent = mock_conn(now - 5), mock_conn(now - 5, 1), mock_conn(now)
+    cli._conns = {0: idle, 1: busy, 2: recent}
+    cli._reap_idle_connections()
+    idle.close.assert_called_once_with()
+    assert not busy.close.called
+    assert not recent.close.called
+    assert set(cli._conns) == set([1, 2])
+    # rescheduled for when the recently used connection expires
+    assert cli._idle_reap_at == now + 1
+
+    # reaped nodes are reconnected on demand
+    assert cli._can_connect(0)
+
+
+def test_api_version_cache(tmpdir):
+    path = str(tmpdir.join('versions.json'))
+    key = ApiVersionCache.key('foo:1234,bar')
+    assert key == ApiVersionCache.key(['bar:9092', 'foo:1234'])
+
+    cache = ApiVersionCache()
+    assert cache.get(key, 60, path) is None
+    cache.put(key, '0.9', path)
+    assert cache.get(key, 60) == '0.9'
+    assert cache.get(key, -1) is None
+
+    # a new process reads the file
+    assert ApiVersionCache().get(key, 60, path) == '0.9'
+    assert ApiVersionCache().get(key, 60) is None
+    cache.remove(key, path)
+    assert ApiVersionCache().get(key, 60, path) is None
+
+    tmpdir.join('versions.json').write('garbage')
+    assert ApiVersionCache().get(key, 60, path) is None
+    tmpdir.join('versions.json').write('[]')
+    assert ApiVersionCache().get(key, 60, path) is None
+
+    # unknown versions and malformed entries are cache misses
+    tmpdir.join('versions.json').write(json.dumps({
+        key: ['0.99', time.time()], 'other:9092': 'garbage'}))
+    assert ApiVersionCache().get(key, 60, path) is None
+    assert ApiVersionCache().get('other:9092', 60, path) is None
+
+
+def test_check_version_cached(mocker, conn, tmpdir):
+    path = str(tmpdir.join('versions.json'))
+    ApiVersionCache().put(ApiVersionCache.key('localhost'), '0.9', path)
+    cli = KafkaClient(api_version_cache_file=path)
+    conn.send.reset_mock()
+    assert cli.check_version() == '0.9'
+    assert not conn.send.called
+
+    # revalidated by the next poll with the 0.9 probe request, sent on a
+    # dedicated connection rather than a shared one
+    probe = conn.send.return_value = Future()
+    cli.poll(timeout_ms=0)
+    (request,), _ = conn.send.call_args
+    assert request.__class__.__name__ == 'ListGroupsRequest'
+    assert not cli._conns
+    # still waiting for the response
+    assert len(cli._delayed_tasks._tasks) == 1
+    probe.failure(Errors.ConnectionError())
+    assert conn.close.called
+    assert ApiVersionCache().get(ApiVersionCache.key('localhost'), 60, path) is None
+
+
+def test_check_version_broker_closes_connection(mocker, server):
+    # a 0.9 broker: it accepts the ListGroupsRequest probe, then hangs up on
+    # the (unknown) ApiVersionRequest probe
+    from kafka.protocol.admin import ListGroupsResponse
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    mocker.patch.object(ClusterMetadata, 'broker_metadata', return_value=
+                        BrokerMetadata(0, '127.0.0.1', server.getsockname()[1]))
+    mocker.patch.object(ClusterMetadata, 'ttl', return_value=9999999)
+
+    def broker():
+        peer, _ = server.accept()
+        _respond(peer, ListGroupsResponse(0, []))
+        for _ in range(2): # the trailing MetadataRequest, ApiVersionRequest
+            size, = struct.unpack('>i', peer.recv(4))
+            peer.recv(size, socket.MSG_WAITALL)
+        peer.close()
+    thread = threading.Thread(target=broker)
+    thread.daemon = True
+    thread.start()
+
+    cli = KafkaClient()
+    try:
+        assert cli.check_version(node_id=0) == '0.9'
+    finally:
+        cli.close()
+    thread.join(5)
+
+
+def test_check_version_old_broker_skips_api_versions(mocker, conn):
+    # a 0.8.0 broker hangs up on everything but MetadataRequest
+    cli = KafkaClient()
+    mocker.patch.object(cli, 'ready', return_value=True)
+    mocker.patch.object(cli, 'poll')
+    mocker.patch('time.sleep')
+    sent = []
+    def send(node_id, request):
+        sent.append(request.__class__.__name__)
+        future = Future()
+        if isinstance(request, MetadataRequest):
+            future.success(None)
+        else:
+            future.failure(Errors.ConnectionError())
+        return future
+    mocker.patch.object(cli, 'send', side_effect=send)
+    assert cli.check_version(node_id=0) == '0.8.0'
+    assert 'ApiVersionRequest' not in sent
+    assert sent[0] == 'ListGroupsRequest'
+
+
+def test_send_without_response_waits_for_write(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient(send_buffer_bytes=4096)
+    try:
+        conn, peer = _connect(mocker, cli, server)
+        request = ProduceRequest(0, 0, [('foo', [(0, [
+            (0, None, Message(b'x' * 4 * 1024 * 1024))])])])
+        future = conn.send(request, expect_response=False)
+        assert not future.is_done
+        assert conn.has_pending_sends()
+
+        # recv() writes the rest even though no response is in flight
+        size = len(encode_request(RequestHeader(
+            request, correlation_id=1, client_id=cli.config['client_id']),
+            request))
+        received = 0
+        for _ in range(10000):
+            if select.select([peer], [], [], 0.01)[0]:
+                received += len(peer.recv(1024 * 1024))
+            conn.recv()
+            if future.is_done:
+                break
+        assert future.succeeded()
+        assert not conn.has_pending_sends()
+        while received < size:
+            received += len(peer.recv(1024 * 1024))
+        assert received == size
+    finally:
+        cli.close()
 
 
 def test_in_flight_request_count():
@@ -298,3 +644,131 @@ def test_schedule():
 
 def test_unschedule():
     pass
+
+
+def test_recv_buffer_reuse(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient()
+    try:
+        conn, peer = _connect(mocker, cli, server)
+        metadata = MetadataResponse([(0, 'foo', 12)], [])
+        responses = []
+        for _ in range(2):
+            conn.send(MetadataRequest([]))
+            _respond(peer, metadata)
+            responses.extend(cli._poll(1.0))
+            buf = conn._rbuffer
+        assert responses == [metadata, metadata]
+        assert conn._rbuffer is buf
+
+        # fetched message sets keep views of the buffer, so it is not reused
+        fetch = FetchResponse([('foo', [(0, 0, 1, [(0, 0, Message(b'v'))])])])
+        conn.send(FetchRequest(-1, 0, 0, []))
+        _respond(peer, fetch)
+        [response] = cli._poll(1.0)
+        buf = conn._rbuffer
+        conn.send(MetadataRequest([]))
+        _respond(peer, metadata)
+        assert cli._poll(1.0) == [metadata]
+        assert conn._rbuffer is not buf
+        [(_, [(_, _, _, [(_, _, msg)])])] = response.topics
+        assert msg.value == b'v'
+
+        # but the messages taken from them do not
+        del response
+        buf = conn._rbuffer
+        conn.send(MetadataRequest([]))
+        _respond(peer, metadata)
+        assert cli._poll(1.0) == [metadata]
+        assert conn._rbuffer is buf
+        assert msg.value == b'v'
+    finally:
+        cli.close()
+
+
+def test_recv_drains_pipelined_responses(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = KafkaClient(receive_buffer_bytes=1024)
+    try:
+        conn, peer = _connect(mocker, cli, server)
+        # larger than receive_buffer_bytes, so it is received in place
+        big = MetadataResponse([(i, 'broker-%d' % i, 9092) for i in range(500)], [])
+        small = MetadataResponse([], [])
+        futures = [conn.send(MetadataRequest([])) for _ in range(3)]
+        _respond(peer, small, big, small)
+        responses = []
+        for _ in range(10):
+            responses.extend(cli._poll(1.0))
+            if len(responses) == 3:
+                break
+        assert responses == [small, big, small]
+        assert all([f.succeeded() for f in futures])
+    finally:
+        cli.close()
+
+
+def test_threaded_client(mocker, server):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    # patched before the network thread starts polling
+    mocker.patch.object(ClusterMetadata, 'broker_metadata', return_value=
+                        BrokerMetadata(0, '127.0.0.1', server.getsockname()[1]))
+    mocker.patch.object(ClusterMetadata, 'ttl', return_value=9999999)
+    cli = ThreadedKafkaClient()
+    try:
+        # sends from several threads share one connection, which the
+        # network thread opens on demand
+        futures = []
+        def send():
+            futures.append(cli.send(0, MetadataRequest([])))
+        threads = [threading.Thread(target=send) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        peer, _ = server.accept()
+        metadata = MetadataResponse([(0, 'foo', 12)], [])
+        _respond(peer, metadata, metadata, metadata)
+        for future in futures:
+            assert cli.poll(future=future) == []
+            assert future.succeeded()
+            assert future.value == metadata
+        assert list(cli._conns) == [0]
+
+        # completion callbacks run on the network thread
+        callback_threads = []
+        future = cli.send(0, MetadataRequest([]))
+        future.add_callback(
+            lambda _: callback_threads.append(threading.current_thread()))
+        _respond(peer, metadata)
+        cli.poll(future=future)
+        for _ in range(100):
+            if callback_threads:
+                break
+            time.sleep(0.01)
+        assert callback_threads == [cli._io_thread]
+    finally:
+        cli.close()
+    assert not cli._io_thread.is_alive()
+    assert cli.send(0, MetadataRequest([])).failed()
+
+
+def test_threaded_client_poll_timeout(mocker):
+    mocker.patch.object(KafkaClient, '_bootstrap')
+    cli = ThreadedKafkaClient()
+    stop = threading.Event()
+    def wake():
+        # each wakeup makes the network thread finish a round of i/o
+        while not stop.is_set():
+            cli.wakeup()
+            time.sleep(0.01)
+    waker = threading.Thread(target=wake)
+    waker.daemon = True
+    waker.start()
+    try:
+        start = time.time()
+        assert cli.poll(timeout_ms=200, future=Future()) == []
+        assert 0.2 <= time.time() - start < 2
+    finally:
+        stop.set()
+        waker.join()
+        cli.close()
@@ -1,12 +1,20 @@
+import gzip
+import io
 import struct
+import sys
 
 from six.moves import xrange
 from . import unittest
 
 from kafka.codec import (
-    has_snappy, gzip_encode, gzip_decode,
-    snappy_encode, snappy_decode
+    has_snappy, has_lz4, gzip_encode, gzip_decode,
+    snappy_encode, snappy_decode, lz4_encode, lz4_decode,
+    lz4_encode_old_kafka, lz4_decode_old_kafka,
+    get_codec, has_codec, register_codec
 )
+from kafka.common import UnsupportedCodecError
+from kafka.protocol import CODEC_GZIP, CODEC_SNAPPY, create_message_set
+from kafka.protocol.message import Message, MessageSet
 
 from test.testutil import random_string
 
@@ -17,6 +25,29 @@ class TestCodec(unittest.TestCase):
             b2 = gzip_decode(gzip_encode(b1))
             self.assertEqual(b1, b2)
 
+    def test_gzip_compat(self):
+        b1 = random_string(1000).encode('utf-8')
+
+        buf = io.BytesIO()
+        gzipper = gzip.GzipFile(fileobj=buf, mode='w')
+        gzipper.write(b1)
+        gzipper.close()
+        self.assertEqual(gzip_decode(buf.getvalue()), b1)
+
+        gzipper = gzip.GzipFile(fileobj=io.BytesIO(gzip_encode(b1)), mode='r')
+        self.assertEqual(gzipper.read(), b1)
+
+    def test_gzip_decode_multiple_members(self):
+        b1 = random_string(100).encode('utf-8')
+        b2 = random_string(100).encode('utf-8')
+        payload = gzip_encode(b1) + gzip_encode(b2) + b'\x00' * 8
+        self.assertEqual(gzip_decode(payload), b1 + b2)
+
+    @unittest.skipIf(sys.version_info < (3, 3), "Requires decompressobj.eof")
+    def test_gzip_decode_truncated(self):
+        payload = gzip_encode(random_string(1000).encode('utf-8'))
+        self.assertRaises(IOError, gzip_decode, payload[:-10])
+
     @unittest.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy(self):
         for i in xrange(1000):
@@ -55,6 +86,24 @@ class TestCodec(unittest.TestCase):
 
         self.assertEqual(snappy_decode(to_test), (b'SNAPPY' * 50) + (b'XERIAL' * 50))
 
+    @unittest.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_decode_xerial_many_blocks(self):
+        b1 = random_string(100 * 1024).encode('utf-8')
+        encoded = snappy_encode(b1, xerial_compatible=True,
+                                xerial_blocksize=1000)
+        self.assertEqual(snappy_decode(encoded), b1)
+        self.assertEqual(snappy_decode(memoryview(encoded)), b1)
+        self.assertIsInstance(snappy_decode(encoded), bytes)
+
+        message_set = MessageSet.encode(
+            [(0, 0, Message(b1[:5000])), (1, 0, Message(b1[5000:]))],
+            size=False)
+        encoded = snappy_encode(message_set, xerial_compatible=True,
+                                xerial_blocksize=1000)
+        wire = Message(encoded, attributes=CODEC_SNAPPY)
+        self.assertEqual(b''.join([msg.value for _, _, msg in wire.decompress()]),
+                         b1)
+
     @unittest.skipUnless(has_snappy(), "Snappy not available")
     def test_snappy_encode_xerial(self):
         to_ensure = (
@@ -70,3 +119,76 @@ class TestCodec(unittest.TestCase):
         compressed = snappy_encode(to_test, xerial_compatible=True, xerial_blocksize=300)
         self.assertEqual(compressed, to_ensure)
 
+    @unittest.skipUnless(has_snappy(), "Snappy not available")
+    def test_snappy_encode_xerial_registered_buffer_size(self):
+        original = get_codec(CODEC_SNAPPY)
+        self.assertEqual(original.buffer_size, 32 * 1024)
+        to_test = (b'SNAPPY' * 50) + (b'XERIAL' * 50)
+        register_codec(*original._replace(buffer_size=300))
+        try:
+            compressed = snappy_encode(to_test, xerial_compatible=True)
+        finally:
+            register_codec(*original)
+        self.assertEqual(
+            compressed,
+            snappy_encode(to_test, xerial_compatible=True, xerial_blocksize=300))
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4(self):
+        for i in xrange(1000):
+            b1 = random_string(100).encode('utf-8')
+            b2 = lz4_decode(lz4_encode(b1))
+            self.assertEqual(len(b1), len(b2))
+            self.assertEqual(b1, b2)
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4_old_kafka(self):
+        import xxhash
+        for i in xrange(100):
+            b1 = random_string(100).encode('utf-8')
+            encoded = lz4_encode_old_kafka(b1)
+            # 0.8 / 0.9 header checksum covers magic + frame descriptor
+            self.assertEqual(encoded[6:7],
+                             xxhash.xxh32(encoded[0:6]).digest()[2:3])
+            self.assertEqual(lz4_decode_old_kafka(encoded), b1)
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_lz4_large_payload(self):
+        b1 = random_string(300 * 1024).encode('utf-8')
+        self.assertEqual(lz4_decode_old_kafka(lz4_encode_old_kafka(b1)), b1)
+
+    def test_codec_registry(self):
+        self.assertEqual(get_codec(CODEC_GZIP).name, 'gzip')
+        self.assertTrue(has_codec(CODEC_GZIP))
+        self.assertEqual(has_codec(0x03), has_lz4())
+        self.assertFalse(has_codec(0x07))
+        with self.assertRaises(UnsupportedCodecError):
+            get_codec(0x07)
+
+    def test_register_codec(self):
+        reverse = lambda payload, compresslevel=None: payload[::-1]
+        register_codec(0x07, 'reverse', reverse, reverse)
+        try:
+            [msg] = create_message_set([(b'v1', b'k1')], 0x07)
+            self.assertEqual(msg.attributes, 0x07)
+            wire = Message(msg.value, attributes=msg.attributes)
+            [(offset, _, inner)] = wire.decompress()
+            self.assertEqual((inner.key, inner.value), (b'k1', b'v1'))
+        finally:
+            from kafka import codec
+            del codec._CODECS[0x07]
+
+    def test_register_codec_replaces_builtin(self):
+        original = get_codec(CODEC_GZIP)
+        calls = []
+        def encode(payload, compresslevel=None):
+            calls.append(compresslevel)
+            return original.encode(payload, compresslevel=compresslevel)
+        register_codec(CODEC_GZIP, 'gzip', encode, original.decode,
+                       original.available, original.buffer_size)
+        try:
+            [msg] = create_message_set([(b'v1', None)], CODEC_GZIP,
+                                       compresslevel=9)
+            self.assertEqual(calls, [9])
+        finally:
+            register_codec(*original)
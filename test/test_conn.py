@@ -6,7 +6,9 @@ import mock
 from . import unittest
 
 from kafka.common import ConnectionError
-from kafka.conn import KafkaConnection, collect_hosts, DEFAULT_SOCKET_TIMEOUT_SECONDS
+from kafka.conn import (
+    DnsCache, KafkaConnection, collect_hosts, DEFAULT_SOCKET_TIMEOUT_SECONDS
+)
 
 class ConnTest(unittest.TestCase):
     def setUp(self):
@@ -19,20 +21,25 @@ class ConnTest(unittest.TestCase):
             'payload2': b'another packet'
         }
 
-        # Mocking socket.create_connection will cause _sock to always be a
-        # MagicMock()
-        patcher = mock.patch('socket.create_connection', spec=True)
-        self.MockCreateConn = patcher.start()
+        # Resolve every host name to the loopback address
+        patcher = mock.patch('kafka.conn.dns_cache.resolve', return_value=[
+            (socket.AF_INET, ('127.0.0.1', self.config['port']))])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Mocking socket.socket will cause _sock to always be a MagicMock()
+        patcher = mock.patch('socket.socket')
+        self.MockSocket = patcher.start()
         self.addCleanup(patcher.stop)
 
         # Also mock socket.sendall() to appear successful
-        self.MockCreateConn().sendall.return_value = None
+        self.MockSocket().sendall.return_value = None
 
         # And mock socket.recv() to return two payloads, then '', then raise
         # Note that this currently ignores the num_bytes parameter to sock.recv()
         payload_size = len(self.config['payload'])
         payload2_size = len(self.config['payload2'])
-        self.MockCreateConn().recv.side_effect = [
+        self.MockSocket().recv.side_effect = [
             struct.pack('>i', payload_size),
             struct.pack('>%ds' % payload_size, self.config['payload']),
             struct.pack('>i', payload2_size),
@@ -44,7 +51,7 @@ class ConnTest(unittest.TestCase):
         self.conn = KafkaConnection(self.config['host'], self.config['port'])
 
         # Reset any mock counts caused by __init__
-        self.MockCreateConn.reset_mock()
+        self.MockSocket.reset_mock()
 
     def test_collect_hosts__happy_path(self):
         hosts = "localhost:1234,localhost"
@@ -77,21 +84,49 @@ class ConnTest(unittest.TestCase):
             ('localhost', 9092),
         ]))
 
+    def test_collect_hosts__ipv6(self):
+        hosts = "[::1]:1234,[fe80::1],::1"
+        results = collect_hosts(hosts, randomize=False)
+
+        self.assertEqual(results, [
+            ('::1', 1234),
+            ('fe80::1', 9092),
+            ('::1', 9092),
+        ])
+
     def test_send(self):
         self.conn.send(self.config['request_id'], self.config['payload'])
         self.conn._sock.sendall.assert_called_with(self.config['payload'])
 
     def test_init_creates_socket_connection(self):
         KafkaConnection(self.config['host'], self.config['port'])
-        self.MockCreateConn.assert_called_with((self.config['host'], self.config['port']), DEFAULT_SOCKET_TIMEOUT_SECONDS)
+        self.MockSocket.assert_called_with(socket.AF_INET, socket.SOCK_STREAM)
+        self.MockSocket().settimeout.assert_called_with(DEFAULT_SOCKET_TIMEOUT_SECONDS)
+        self.MockSocket().connect.assert_called_with(('127.0.0.1', self.config['port']))
+
+    def test_init_connects_to_full_ipv6_sockaddr(self):
+        sockaddr = ('fe80::1', self.config['port'], 0, 2) # with a scope id
+        with mock.patch('kafka.conn.dns_cache.resolve',
+                        return_value=[(socket.AF_INET6, sockaddr)]):
+            KafkaConnection(self.config['host'], self.config['port'])
+        self.MockSocket.assert_called_with(socket.AF_INET6, socket.SOCK_STREAM)
+        self.MockSocket().connect.assert_called_with(sockaddr)
+
+    def test_init_tries_next_address(self):
+        self.MockSocket().connect.side_effect = [socket.error, None]
+        with mock.patch('kafka.conn.dns_cache.resolve', return_value=[
+                (socket.AF_INET6, ('::1', self.config['port'], 0, 0)),
+                (socket.AF_INET, ('127.0.0.1', self.config['port']))]):
+            KafkaConnection(self.config['host'], self.config['port'])
+        self.assertEqual(self.MockSocket().close.call_count, 1)
+        self.MockSocket().connect.assert_called_with(('127.0.0.1', self.config['port']))
 
     def test_init_failure_raises_connection_error(self):
 
         def raise_error(*args):
             raise socket.error
 
-        assert socket.create_connection is self.MockCreateConn
-        socket.create_connection.side_effect=raise_error
+        self.MockSocket().connect.side_effect=raise_error
         with self.assertRaises(ConnectionError):
             KafkaConnection(self.config['host'], self.config['port'])
 
@@ -104,9 +139,9 @@ class ConnTest(unittest.TestCase):
             pass
 
         # Now test that sending attempts to reconnect
-        self.assertEqual(self.MockCreateConn.call_count, 0)
+        self.assertEqual(self.MockSocket().connect.call_count, 0)
         self.conn.send(self.config['request_id'], self.config['payload'])
-        self.assertEqual(self.MockCreateConn.call_count, 1)
+        self.assertEqual(self.MockSocket().connect.call_count, 1)
 
     def test_send__failure_sets_dirty_connection(self):
 
@@ -133,9 +168,9 @@ class ConnTest(unittest.TestCase):
             pass
 
         # Now test that recv'ing attempts to reconnect
-        self.assertEqual(self.MockCreateConn.call_count, 0)
+        self.assertEqual(self.MockSocket().connect.call_count, 0)
         self.conn.recv(self.config['request_id'])
-        self.assertEqual(self.MockCreateConn.call_count, 1)
+        self.assertEqual(self.MockSocket().connect.call_count, 1)
 
     def test_recv__failure_sets_dirty_connection(self):
 
@@ -159,7 +194,7 @@ class ConnTest(unittest.TestCase):
     def test_get_connected_socket(self):
         s = self.conn.get_connected_socket()
 
-        self.assertEqual(s, self.MockCreateConn())
+        self.assertEqual(s, self.MockSocket())
 
     def test_get_connected_socket_on_dirty_conn(self):
         # Dirty the connection
@@ -169,9 +204,9 @@ class ConnTest(unittest.TestCase):
             pass
 
         # Test that get_connected_socket tries to connect
-        self.assertEqual(self.MockCreateConn.call_count, 0)
+        self.assertEqual(self.MockSocket().connect.call_count, 0)
         self.conn.get_connected_socket()
-        self.assertEqual(self.MockCreateConn.call_count, 1)
+        self.assertEqual(self.MockSocket().connect.call_count, 1)
 
     def test_close__object_is_reusable(self):
 
@@ -179,13 +214,15 @@ class ConnTest(unittest.TestCase):
         # will re-connect and send data to the socket
         self.conn.close()
         self.conn.send(self.config['request_id'], self.config['payload'])
-        self.assertEqual(self.MockCreateConn.call_count, 1)
+        self.assertEqual(self.MockSocket().connect.call_count, 1)
         self.conn._sock.sendall.assert_called_with(self.config['payload'])
 
 
 class TestKafkaConnection(unittest.TestCase):
-    @mock.patch('socket.create_connection')
-    def test_copy(self, socket):
+    @mock.patch('kafka.conn.dns_cache.resolve',
+                return_value=[(socket.AF_INET, ('10.0.0.1', 9092))])
+    @mock.patch('socket.socket')
+    def test_copy(self, socket, _):
         """KafkaConnection copies work as expected"""
 
         conn = KafkaConnection('kafka', 9092)
@@ -201,8 +238,10 @@ class TestKafkaConnection(unittest.TestCase):
         self.assertEqual(socket.call_count, 2)
         self.assertNotEqual(copy._sock, None)
 
-    @mock.patch('socket.create_connection')
-    def test_copy_thread(self, socket):
+    @mock.patch('kafka.conn.dns_cache.resolve',
+                return_value=[(socket.AF_INET, ('10.0.0.1', 9092))])
+    @mock.patch('socket.socket')
+    def test_copy_thread(self, socket, _):
         """KafkaConnection copies work in other threads"""
 
         err = []
@@ -223,3 +262,33 @@ class TestKafkaConnection(unittest.TestCase):
 
         self.assertEqual(err, [None])
         self.assertEqual(socket.call_count, 2)
+
+
+class TestDnsCache(unittest.TestCase):
+    @mock.patch('socket.getaddrinfo')
+    def test_resolve_caches_addresses(self, getaddrinfo):
+        getaddrinfo.return_value = [
+            (socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 9092, 0, 0)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', 9092)),
+        ]
+        cache = DnsCache(ttl=60)
+        expected = [(socket.AF_INET6, ('::1', 9092, 0, 0)),
+                    (socket.AF_INET, ('127.0.0.1', 9092))]
+        self.assertEqual(cache.resolve('kafka', 9092), expected)
+        self.assertEqual(cache.resolve('kafka', 9092), expected)
+        self.assertEqual(getaddrinfo.call_count, 1)
+
+        cache.ttl = 0
+        cache.clear()
+        cache.resolve('kafka', 9092)
+        cache.resolve('kafka', 9092)
+        self.assertEqual(getaddrinfo.call_count, 3)
+
+    @mock.patch('socket.getaddrinfo')
+    def test_resolve_caches_failures(self, getaddrinfo):
+        getaddrinfo.side_effect = socket.gaierror(socket.EAI_NONAME, 'unknown')
+        cache = DnsCache(negative_ttl=60)
+        for _ in range(2):
+            with self.assertRaises(socket.gaierror):
+                cache.resolve('nowhere', 9092)
+        self.assertEqual(getaddrinfo.call_count, 1)
@@ -0,0 +1,152 @@
+# pylint: skip-file
+from __future__ import absolute_import
+
+import struct
+
+import pytest
+
+from kafka.common import TopicPartition
+from kafka.consumer.fetcher import Fetcher, RecordTooLargeError
+from kafka.consumer.subscription_state import SubscriptionState
+from kafka.codec import gzip_encode
+from kafka.protocol.fetch import (
+    FetchBatchRequest_v2, FetchRequest, FetchRequest_v1, FetchRequest_v2,
+    FetchResponse, FetchResponse_v2
+)
+from kafka.protocol.message import Message, MessageSet
+
+
+@pytest.fixture
+def tp():
+    return TopicPartition('foo', 0)
+
+
+@pytest.fixture
+def fetcher(mocker, tp):
+    client = mocker.Mock()
+    client.cluster.leader_for_partition.return_value = 0
+    client.in_flight_request_count.return_value = 0
+    subscriptions = SubscriptionState()
+    subscriptions.assign_from_user([tp])
+    subscriptions.seek(tp, 0)
+    return Fetcher(client, subscriptions, max_partition_fetch_bytes=100)
+
+
+def _fetch(fetcher, tp, message_set):
+    [request] = fetcher._create_fetch_requests().values()
+    encoded = FetchResponse([(tp.topic, [(tp.partition, 0, 100, [])])]).encode()
+    # replace the empty message set (size 0) with the raw, possibly cut off, set
+    encoded = encoded[:-4] + struct.pack('>i', len(message_set)) + message_set
+    fetcher._handle_fetch_response(request, FetchResponse.decode(encoded))
+    return request
+
+
+def _fetch_size(request):
+    [(_, [(_, _, max_bytes)])] = request.topics
+    return max_bytes
+
+
+def _truncated(messages, offset, size):
+    return MessageSet.encode(
+        [(offset + i, 0, msg) for i, msg in enumerate(messages)],
+        size=False)[:size]
+
+
+def test_fetch_size_grows_for_oversized_message(fetcher, tp):
+    big = Message(b'x' * 200) # 226 bytes with framing
+    request = _fetch(fetcher, tp, _truncated([Message(b'a'), big], 0, 100))
+    assert _fetch_size(request) == 100
+    assert [r.value for r in fetcher.fetched_records()[tp]] == [b'a']
+
+    # grown geometrically until the cut off message fits
+    messages = [big, Message(b'b'), Message(b'c')]
+    request = _fetch(fetcher, tp, _truncated(messages, 1, 400))
+    assert _fetch_size(request) == 400
+    assert [r.value for r in fetcher.fetched_records()[tp]] == [
+        big.value, b'b', b'c']
+
+    # and decays back once it has passed
+    request = _fetch(fetcher, tp, _truncated([Message(b'd')], 4, 100))
+    assert _fetch_size(request) == 200
+    assert [r.value for r in fetcher.fetched_records()[tp]] == [b'd']
+    [request] = fetcher._create_fetch_requests().values()
+    assert _fetch_size(request) == 100
+
+
+def test_fetch_size_grows_without_complete_messages(fetcher, tp):
+    big = Message(b'x' * 200)
+    _fetch(fetcher, tp, _truncated([big], 0, 100))
+    assert fetcher.fetched_records() == {}
+    assert fetcher._fetch_size(tp) == 400
+
+    # without the size header the fetch size is just doubled
+    _fetch(fetcher, tp, _truncated([big], 0, 11))
+    assert fetcher.fetched_records() == {}
+    assert fetcher._fetch_size(tp) == 800
+
+
+def test_fetch_size_forgotten_when_unassigned(fetcher, tp):
+    _fetch(fetcher, tp, _truncated([Message(b'x' * 200)], 0, 100))
+    assert fetcher._fetch_size(tp) == 400
+
+    other = TopicPartition('foo', 1)
+    fetcher._subscriptions.assign_from_user([other])
+    fetcher._subscriptions.seek(other, 0)
+    fetcher._create_fetch_requests()
+    assert tp not in fetcher._fetch_sizes
+
+
+def test_fetch_size_ceiling(fetcher, tp):
+    fetcher.config['max_partition_fetch_bytes_ceiling'] = 200
+    _fetch(fetcher, tp, _truncated([Message(b'x' * 200)], 0, 100))
+    with pytest.raises(RecordTooLargeError):
+        fetcher.fetched_records()
+    assert fetcher._fetch_size(tp) == 100
+
+
+@pytest.mark.parametrize('api_version, batches, request_type', [
+    ((0, 8, 2), False, FetchRequest),
+    ((0, 9), False, FetchRequest_v1),
+    ((0, 10), False, FetchRequest_v2),
+    ((0, 10), True, FetchBatchRequest_v2),
+])
+def test_fetch_request_version(fetcher, api_version, batches, request_type):
+    fetcher.config['api_version'] = api_version
+    fetcher.config['fetch_record_batches'] = batches
+    [request] = fetcher._create_fetch_requests().values()
+    assert type(request) is request_type
+
+
+@pytest.mark.parametrize('check_crcs, batches', [
+    (True, False), (False, False), (False, True)])
+def test_fetched_records_v1(fetcher, tp, check_crcs, batches):
+    fetcher.config['max_partition_fetch_bytes'] = 1000
+    fetcher.config['check_crcs'] = check_crcs
+    fetcher.config['fetch_record_batches'] = batches
+    fetcher.config['api_version'] = (0, 10)
+    # inner offsets of a magic 1 wrapper are relative to its last message
+    inner = MessageSet.encode(
+        [(i, 0, Message(v, magic=1, timestamp=t))
+         for i, (v, t) in enumerate([(b'b', 10), (b'c', 11)])], size=False)
+    wrappers = [
+        Message(gzip_encode(inner), magic=1, timestamp=11,
+                attributes=Message.CODEC_GZIP),
+        Message(gzip_encode(inner), magic=1, timestamp=99,
+                attributes=Message.CODEC_GZIP | Message.TIMESTAMP_TYPE_MASK)]
+    message_set = MessageSet.encode(
+        [(0, 0, Message(b'a', magic=1, timestamp=5)),
+         (2, 0, wrappers[0]), (4, 0, wrappers[1])], size=False)
+    [request] = fetcher._create_fetch_requests().values()
+    encoded = FetchResponse_v2(
+        0, [(tp.topic, [(tp.partition, 0, 100, [])])]).encode()
+    encoded = encoded[:-4] + struct.pack('>i', len(message_set)) + message_set
+    fetcher._handle_fetch_response(request, request.RESPONSE_TYPE.decode(encoded))
+    records = fetcher.fetched_records()[tp]
+    assert [(r.offset, r.timestamp, r.timestamp_type, r.value)
+            for r in records] == [
+        (0, 5, 0, b'a'), (1, 10, 0, b'b'), (2, 11, 0, b'c'),
+        (3, 99, 1, b'b'), (4, 99, 1, b'c')]
+    # timestamp fields come after value, so 0.9-style unpacking still works
+    topic, partition, offset, key, value = records[0][:5]
+    assert (topic, partition, offset, key, value) == (
+        tp.topic, tp.partition, 0, None, b'a')
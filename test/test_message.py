@@ -0,0 +1,242 @@
+from __future__ import absolute_import
+
+import io
+import struct
+
+from kafka.protocol.buffer import MemoryViewReader, is_exported
+from kafka.protocol.fetch import (
+    FetchPartitionBatch, FetchResponse, FetchResponseBatches
+)
+from kafka.codec import gzip_encode
+from kafka.protocol.message import Message, MessageSet, PartialMessage
+from kafka.protocol.types import Int32, String
+
+
+def _message_set(messages, offset=0):
+    return MessageSet.encode(
+        [(offset + i, 0, msg) for i, msg in enumerate(messages)],
+        size=False)
+
+
+def test_memoryview_reader():
+    reader = MemoryViewReader(b'\x00\x00\x00\x03\x00\x03foo')
+    assert Int32.decode(reader) == 3
+    assert String('utf-8').decode(reader) == 'foo'
+    assert reader.tell() == len(reader) == 9
+    assert reader.read(4).tobytes() == b''
+    reader.seek(-3, 2)
+    assert reader.read().tobytes() == b'foo'
+
+
+def test_decode_message_views():
+    encoded = bytearray(Message(b'value', key=b'key').encode())
+    msg = Message.decode(MemoryViewReader(encoded))
+    assert isinstance(msg.key, bytes)
+    assert isinstance(msg.value, bytes)
+    assert msg.key == b'key'
+    assert msg.value == b'value'
+    assert msg.validate_crc()
+    # the message keeps no view of the buffer it was decoded from
+    assert not is_exported(encoded)
+
+    msg = Message.decode(MemoryViewReader(Message(None).encode()))
+    assert msg.key is None
+    assert msg.value is None
+
+
+def test_decode_message_set_views():
+    msgs = [Message(b'v1', key=b'k1'), Message(b'v2')]
+    encoded = _message_set(msgs)
+    buf = bytearray(encoded)
+    decoded = MessageSet.decode(buf, bytes_to_read=len(buf))
+    assert [(offset, msg.key, msg.value) for offset, _, msg in decoded] == [
+        (0, b'k1', b'v1'), (1, None, b'v2')]
+    # only the set references the buffer, not the messages taken from it
+    messages = list(decoded)
+    assert is_exported(buf)
+    del decoded
+    assert not is_exported(buf)
+    assert messages[0][2].value == b'v1'
+
+    # trailing partial message is copied out as bytes
+    decoded = MessageSet.decode(encoded[:-3], bytes_to_read=len(encoded) - 3)
+    assert len(decoded) == 2
+    assert isinstance(decoded[-1][-1], PartialMessage)
+
+
+def test_decode_fetch_response_views():
+    messages = [(10, 0, Message(b'foo')), (11, 0, Message(b'bar'))]
+    encoded = FetchResponse([('topic', [(0, 0, 12, messages)])]).encode()
+
+    from_view = FetchResponse.decode(MemoryViewReader(encoded))
+    from_bytes = FetchResponse.decode(io.BytesIO(encoded))
+    assert from_view == from_bytes
+    [(topic, [(partition, error, highwater, messages)])] = from_view.topics
+    assert [(offset, msg.value) for offset, _, msg in messages] == [
+        (10, b'foo'), (11, b'bar')]
+
+
+def test_lazy_message_set(mocker):
+    msgs = [Message(b'v1'), Message(b'v2'), Message(b'v3')]
+    encoded = _message_set(msgs, offset=5)
+    decode = mocker.spy(Message, '_decode_view')
+    message_set = MessageSet.decode(encoded[:-1], bytes_to_read=len(encoded) - 1)
+    assert decode.call_count == 0
+    assert len(message_set) == 3
+    assert message_set.offsets == [5, 6]
+    assert isinstance(message_set.partial, PartialMessage)
+    assert message_set.partial.header() == (7, len(msgs[2].encode()))
+    assert PartialMessage(b'\x00' * 11).header() is None
+
+    offset, size, msg = message_set[1]
+    assert (offset, size, msg.value) == (6, len(msgs[1].encode()), b'v2')
+    assert decode.call_count == 1
+    assert message_set[1][2] is msg
+    assert decode.call_count == 1
+
+    offset, size, partial = message_set.pop()
+    assert (offset, size) == (None, None)
+    assert isinstance(partial, PartialMessage)
+    assert message_set.partial is None
+    assert [m.value for _, _, m in message_set] == [b'v1', b'v2']
+    assert decode.call_count == 2
+    size = len(msgs[0].encode())
+    assert message_set == [(5, size, msgs[0]), (6, size, msgs[1])]
+
+
+def test_lazy_message_set_early_stop(mocker):
+    encoded = _message_set([Message(('v%d' % i).encode()) for i in range(100)])
+    decode = mocker.spy(Message, '_decode_view')
+    message_set = MessageSet.decode(encoded, bytes_to_read=len(encoded))
+    for offset, _, msg in message_set:
+        if offset == 1:
+            break
+    assert decode.call_count == 2
+
+
+def test_validate_crc():
+    encoded = Message(b'value', key=b'key').encode()
+    msg = Message.decode(MemoryViewReader(encoded))
+    assert msg.validate_crc()
+
+    corrupt = bytearray(encoded)
+    corrupt[-1] ^= 0xff
+    assert not Message.decode(MemoryViewReader(bytes(corrupt))).validate_crc()
+
+    msg.value = b'other'
+    assert not msg.validate_crc()
+
+
+def test_lazy_message_set_validate_crcs(mocker):
+    encoded = _message_set([Message(b'v1'), Message(b'v2', key=b'k2')])
+    decode = mocker.spy(Message, '_decode_view')
+    message_set = MessageSet.decode(encoded, bytes_to_read=len(encoded))
+    assert message_set.validate_crcs()
+    assert decode.call_count == 0
+
+    corrupt = bytearray(encoded)
+    corrupt[-1] ^= 0xff
+    message_set = MessageSet.decode(bytes(corrupt), bytes_to_read=len(corrupt))
+    assert not message_set.validate_crcs()
+    assert [msg.validate_crc() for _, _, msg in message_set] == [True, False]
+
+
+def test_decode_fetch_response_batches():
+    compressed = Message(gzip_encode(_message_set([Message(b'z')], offset=3)),
+                         attributes=Message.CODEC_GZIP)
+    foo = [(10, 0, Message(b'foo', key=b'k')), (11, 0, Message(None)),
+           (12, 0, compressed)]
+    bar = [(0, 0, Message(b'bar'))]
+    encoded = FetchResponse([
+        ('topic', [(0, 0, 20, foo), (1, 1, -1, [])]),
+        ('other', [(2, 0, 5, bar)])]).encode()
+    truncated = _message_set([m for _, _, m in foo], offset=10)[:-3]
+    trailing = b''.join([struct.pack('>ih5si', 1, 5, b'topic', 1),
+                         struct.pack('>ihqi', 0, 0, 20, len(truncated)),
+                         truncated])
+
+    response = FetchResponseBatches.decode(MemoryViewReader(encoded))
+    expected = FetchResponse.decode(MemoryViewReader(encoded))
+    batches = response.batches
+    assert [(b.topic, b.partition, b.error_code, b.highwater_offset)
+            for b in batches] == [
+        ('topic', 0, 0, 20), ('topic', 1, 1, -1), ('other', 2, 0, 5)]
+    assert [list(b) for b in batches] == [
+        list(messages) for _, partitions in expected.topics
+        for _, _, _, messages in partitions]
+    assert all([b.validate_crcs() for b in batches])
+
+    records = list(batches[0].records())
+    assert records[:2] == [(10, None, None, b'k', b'foo', None),
+                           (11, None, None, None, None, None)]
+    offset, _, _, _, _, wrapper = records[2]
+    assert offset == 12
+    assert [(o, m.value) for o, _, m in wrapper.decompress()] == [(3, b'z')]
+
+    batch = FetchResponseBatches.decode(MemoryViewReader(trailing)).batches[0]
+    assert isinstance(batch, FetchPartitionBatch)
+    assert isinstance(batch.pop()[-1], PartialMessage)
+    batch.pop(0)
+    assert [r[0] for r in batch.records()] == [11]
+
+
+def test_message_v1_encode_decode():
+    msg = Message(b'value', key=b'key', magic=1, timestamp=1234567890123)
+    encoded = msg.encode()
+    assert encoded[:6] == struct.pack('>ibb', msg.crc, 1, 0)
+    assert encoded[6:14] == struct.pack('>q', 1234567890123)
+    buf = bytearray()
+    msg.encode_into(buf)
+    assert buf == encoded
+
+    decoded = Message.decode(MemoryViewReader(encoded))
+    assert decoded == msg
+    assert (decoded.timestamp, decoded.timestamp_type) == (1234567890123, 0)
+    assert (decoded.key, decoded.value) == (b'key', b'value')
+    assert decoded.validate_crc()
+    assert Message(b'v').timestamp_type is None
+    assert Message(b'v', magic=1, attributes=8, timestamp=1).timestamp_type == 1
+    assert Message(b'v', magic=1, timestamp=1) != Message(b'v', magic=1, timestamp=2)
+
+
+def test_encode_into_bytearray_matches_encode():
+    msgs = [Message(b'v', key=b'k'), Message(None), Message(b'', key=b''),
+            Message(b'v1', key=b'k1', magic=1, timestamp=100),
+            Message(None, magic=1, attributes=8, timestamp=200)]
+    msgs += [Message(('value-%d' % i).encode()) for i in range(20)]
+    # both signs of the crc, which the protocol encodes as a signed int
+    assert set([msg.encode() and msg.crc < 0 for msg in msgs]) == set([True, False])
+    for msg in msgs:
+        buf = bytearray(b'prefix')
+        msg.crc = 0
+        msg.encode_into(buf)
+        assert buf[6:] == msg.encode()
+        assert Message.decode(bytes(buf[6:])).validate_crc()
+
+
+def test_message_set_items_match_message_decode():
+    msgs = [Message(b'v', key=b'k'), Message(None), Message(b'', key=b''),
+            Message(b'v1', key=b'k1', magic=1, timestamp=100),
+            Message(None, magic=1, attributes=8, timestamp=200)]
+    encoded = _message_set(msgs)
+    decoded = MessageSet.decode(encoded, bytes_to_read=len(encoded))
+    for (_, size, msg), expected in zip(decoded, msgs):
+        assert size == len(expected.encode())
+        assert msg == expected
+        assert (msg.key, msg.value) == (expected.key, expected.value)
+        assert msg.timestamp == expected.timestamp
+        assert msg.validate_crc()
+
+
+def test_decode_fetch_response_batches_v1_messages():
+    messages = [(5, 0, Message(b'foo', key=b'k', magic=1, timestamp=100)),
+                (6, 0, Message(b'bar', magic=1, attributes=8, timestamp=200)),
+                (7, 0, Message(b'old'))]
+    encoded = FetchResponse([('topic', [(0, 0, 8, messages)])]).encode()
+    [batch] = FetchResponseBatches.decode(MemoryViewReader(encoded)).batches
+    assert list(batch.records()) == [
+        (5, 100, 0, b'k', b'foo', None),
+        (6, 200, 1, None, b'bar', None),
+        (7, None, None, None, b'old', None)]
+    assert batch.validate_crcs()
+    assert [(o, m) for o, _, m in batch] == [(o, m) for o, _, m in messages]
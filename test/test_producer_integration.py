@@ -7,9 +7,10 @@ from six.moves import range
 from kafka import (
     SimpleProducer, KeyedProducer,
     create_message, create_gzip_message, create_snappy_message,
+    create_lz4_message,
     RoundRobinPartitioner, HashedPartitioner
 )
-from kafka.codec import has_snappy
+from kafka.codec import has_snappy, has_lz4
 from kafka.common import (
     FetchRequestPayload, ProduceRequestPayload,
     UnknownTopicOrPartitionError, LeaderNotAvailableError
@@ -79,6 +80,23 @@ class TestKafkaProducerIntegration(KafkaIntegrationTestCase):
             200,
         )
 
+    @kafka_versions('>=0.8.2')
+    def test_produce_many_lz4(self):
+        if not has_lz4():
+            self.skipTest("LZ4 not available")
+        start_offset = self.current_offset(self.topic, 0)
+
+        self.assert_produce_request(
+            [
+                create_lz4_message([
+                    (("LZ4 1 %d" % i).encode('utf-8'), None) for i in range(100)]),
+                create_lz4_message([
+                    (("LZ4 2 %d" % i).encode('utf-8'), None) for i in range(100)]),
+            ],
+            start_offset,
+            200,
+        )
+
     def test_produce_many_snappy(self):
         self.skipTest("All snappy integration tests fail with nosnappyjava")
         start_offset = self.current_offset(self.topic, 0)
@@ -6,7 +6,10 @@ import six
 from mock import patch, sentinel
 from . import unittest
 
-from kafka.codec import has_snappy, gzip_decode, snappy_decode
+from kafka.codec import (
+    has_snappy, has_lz4, gzip_decode, snappy_decode, lz4_decode,
+    lz4_decode_old_kafka
+)
 from kafka.common import (
     OffsetRequestPayload, OffsetCommitRequestPayload, OffsetFetchRequestPayload,
     OffsetResponsePayload, OffsetCommitResponsePayload, OffsetFetchResponsePayload,
@@ -17,10 +20,11 @@ from kafka.common import (
     ProtocolError, ConsumerMetadataResponse
 )
 from kafka.protocol import (
-    ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, KafkaProtocol,
-    create_message, create_gzip_message, create_snappy_message,
-    create_message_set
+    ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, CODEC_LZ4,
+    KafkaProtocol, create_message, create_gzip_message, create_snappy_message,
+    create_lz4_message, create_message_set
 )
+from kafka.protocol.message import Message as ProtocolMessage
 
 class TestProtocol(unittest.TestCase):
     def test_create_message(self):
@@ -148,6 +152,39 @@ class TestProtocol(unittest.TestCase):
 
         self.assertEqual(decoded, expect)
 
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_create_lz4(self):
+        payloads = [(b"v1", b"k1"), (b"v2", b"k2")]
+        msg = create_lz4_message(payloads)
+        self.assertEqual(msg.magic, 0)
+        self.assertEqual(msg.attributes, ATTRIBUTE_CODEC_MASK & CODEC_LZ4)
+        self.assertEqual(msg.key, None)
+        decoded = lz4_decode_old_kafka(msg.value)
+        self.assertEqual(decoded, KafkaProtocol._encode_message_set(
+            [create_message(b"v1", b"k1"), create_message(b"v2", b"k2")]))
+
+        wrapper = ProtocolMessage(msg.value, attributes=msg.attributes)
+        self.assertTrue(wrapper.is_compressed())
+        self.assertEqual([(m.key, m.value) for _, _, m in wrapper.decompress()],
+                         [(b"k1", b"v1"), (b"k2", b"v2")])
+
+    @unittest.skipUnless(has_lz4(), "LZ4 not available")
+    def test_create_lz4_magic_1(self):
+        payloads = [(b"v1", b"k1"), (b"v2", b"k2")]
+        msg = create_lz4_message(payloads, magic=1, timestamp=1234)
+        self.assertEqual(msg.magic, 1)
+        self.assertEqual(msg.attributes, ATTRIBUTE_CODEC_MASK & CODEC_LZ4)
+        # standard LZ4 framing, not that of 0.8 / 0.9 brokers
+        decoded = lz4_decode(msg.value)
+        self.assertEqual(decoded, KafkaProtocol._encode_message_set(
+            [create_message(b"v1", b"k1", magic=1, timestamp=1234),
+             create_message(b"v2", b"k2", magic=1, timestamp=1234)]))
+
+        wrapper = ProtocolMessage(msg.value, attributes=msg.attributes,
+                                  magic=1, timestamp=1234)
+        self.assertEqual([(m.key, m.value) for _, _, m in wrapper.decompress()],
+                         [(b"k1", b"v1"), (b"k2", b"v2")])
+
     def test_encode_message_header(self):
         expect = b"".join([
             struct.pack(">h", 10),             # API Key
@@ -191,9 +228,27 @@ class TestProtocol(unittest.TestCase):
         self.assertEqual(returned_offset, offset)
         self.assertEqual(decoded_message, create_message(b"test", b"key"))
 
+    def test_encode_message_v1(self):
+        message = create_message(b"test", b"key", magic=1, timestamp=1000)
+        encoded = KafkaProtocol._encode_message(message)
+        self.assertEqual(encoded[4:14], struct.pack(">bbq", 1, 0, 1000))
+        decoded = ProtocolMessage.decode(encoded)
+        self.assertEqual((decoded.timestamp, decoded.key, decoded.value),
+                         (1000, b"key", b"test"))
+        self.assertTrue(decoded.validate_crc())
+
+    def test_create_gzip_v1(self):
+        msg = create_gzip_message([(b"v1", None), (b"v2", None)],
+                                  magic=1, timestamp=1000)
+        self.assertEqual((msg.magic, msg.timestamp), (1, 1000))
+        inner = ProtocolMessage(msg.value, magic=1, timestamp=1000,
+                                attributes=msg.attributes).decompress()
+        self.assertEqual([(offset, m.timestamp, m.value) for offset, _, m in inner],
+                         [(0, 1000, b"v1"), (1, 1000, b"v2")])
+
     def test_encode_message_failure(self):
         with self.assertRaises(ProtocolError):
-            KafkaProtocol._encode_message(Message(1, 0, "key", "test"))
+            KafkaProtocol._encode_message(Message(2, 0, "key", "test"))
 
     @unittest.skip('needs updating for new protocol classes')
     def test_encode_message_set(self):
@@ -811,7 +866,9 @@ class TestProtocol(unittest.TestCase):
                                    return_value=sentinel.gzip_message):
                 with patch.object(kafka.protocol.legacy, "create_snappy_message",
                                        return_value=sentinel.snappy_message):
-                    yield
+                    with patch.object(kafka.protocol.legacy, "create_lz4_message",
+                                      return_value=sentinel.lz4_message):
+                        yield
 
     def test_create_message_set(self):
         messages = [(1, "k1"), (2, "k2"), (3, "k3")]
@@ -840,6 +897,12 @@ class TestProtocol(unittest.TestCase):
             message_set = create_message_set(messages, CODEC_SNAPPY)
         self.assertEqual(message_set, expect)
 
+        # CODEC_LZ4: Expect list of one lz4-encoded message.
+        expect = [sentinel.lz4_message]
+        with self.mock_create_message_fns():
+            message_set = create_message_set(messages, CODEC_LZ4)
+        self.assertEqual(message_set, expect)
+
         # Unknown codec should raise UnsupportedCodecError.
         with self.assertRaises(UnsupportedCodecError):
             create_message_set(messages, -1)
@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+
+import io
+import pickle
+import struct
+
+import pytest
+
+from kafka.protocol.api import (
+    RequestHeader, encode_request, encode_request_buffers
+)
+from kafka.protocol.commit import OffsetCommitRequest_v2
+from kafka.protocol.fetch import FetchRequest
+from kafka.protocol.group import JoinGroupRequest
+from kafka.protocol.message import Message, MessageSet
+from kafka.protocol.metadata import MetadataRequest, MetadataResponse
+from kafka.protocol.produce import ProduceRequest, ProduceResponse
+from kafka.protocol.types import (
+    Array, Bytes, Int8, Int16, Int32, Int64, Schema, String
+)
+
+
+def test_schema_fuses_fixed_width_runs():
+    schema = Schema(
+        ('a', Int32),
+        ('b', Int16),
+        ('c', String('utf-8')),
+        ('d', Int64),
+        ('e', Int8))
+    assert [(packer and packer.size, start, stop)
+            for packer, start, stop in schema._steps] == [
+        (6, 0, 2),
+        (None, 2, 3),
+        (9, 3, 5)]
+    assert schema.fmt is None
+    assert Schema(('a', Int32), ('b', Int64)).fmt == 'iq'
+
+
+def test_schema_encode_decode():
+    schema = Schema(
+        ('a', Int32),
+        ('b', Int16),
+        ('c', String('utf-8')),
+        ('d', Bytes),
+        ('e', Int64))
+    item = (1, -2, 'foo', b'bar', 2**40)
+    encoded = schema.encode(item)
+    assert encoded == b''.join([
+        struct.pack('>ih', 1, -2),
+        struct.pack('>h3s', 3, b'foo'),
+        struct.pack('>i3s', 3, b'bar'),
+        struct.pack('>q', 2**40)])
+    assert schema.decode(io.BytesIO(encoded)) == item
+
+
+def test_schema_encode_field_count_mismatch():
+    with pytest.raises(ValueError):
+        Schema(('a', Int32), ('b', Int32)).encode((1,))
+
+
+@pytest.mark.parametrize('array, items, encoded', [
+    (Array(Int32), [1, 2, 3], struct.pack('>iiii', 3, 1, 2, 3)),
+    (Array(Int64), [], struct.pack('>i', 0)),
+    (Array(('a', Int32), ('b', Int16)), [(1, 2), (3, 4)],
+     struct.pack('>iihih', 2, 1, 2, 3, 4)),
+    (Array(String('utf-8')), ['a', 'bc'],
+     struct.pack('>ih1sh2s', 2, 1, b'a', 2, b'bc')),
+])
+def test_array_encode_decode(array, items, encoded):
+    assert array.encode(items) == encoded
+    assert array.decode(io.BytesIO(encoded)) == items
+
+
+def test_decode_response_with_many_partitions():
+    partitions = [(i, 0, i * 10) for i in range(5000)]
+    response = ProduceResponse([('foo', partitions)])
+    decoded = ProduceResponse.decode(io.BytesIO(response.encode()))
+    assert decoded.topics == [('foo', partitions)]
+
+
+def test_decode_metadata_response():
+    response = MetadataResponse(
+        [(0, 'foo', 9092), (1, 'bar', 9093)],
+        [(0, 'topic', [(0, 1, 0, [0, 1], [0]),
+                       (0, 2, 1, [1, 0], [1, 0])])])
+    decoded = MetadataResponse.decode(io.BytesIO(response.encode()))
+    assert decoded == response
+
+
+@pytest.mark.parametrize('obj', [
+    MetadataRequest(['foo']),
+    RequestHeader(MetadataRequest([]), correlation_id=1),
+    Message(b'value', key=b'key'),
+    Message.decode(Message(b'value').encode()),
+])
+def test_struct_slots(obj):
+    assert not hasattr(obj, '__dict__')
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        assert pickle.loads(pickle.dumps(obj, protocol)) == obj
+
+
+def test_struct_encode_class_and_instance():
+    request = MetadataRequest(['foo'])
+    assert MetadataRequest.encode((['foo'],)) == request.encode()
+    with pytest.raises(AttributeError):
+        request.unknown = 1
+
+
+@pytest.mark.parametrize('request_', [
+    MetadataRequest([]),
+    MetadataRequest(['foo', 'bar']),
+    FetchRequest(-1, 100, 1, [('foo', [(0, 10, 1024), (1, 20, 1024)])]),
+    JoinGroupRequest('group', 30000, '', 'consumer', [('range', b'meta')]),
+    OffsetCommitRequest_v2('group', 1, 'member', -1,
+                           [('foo', [(0, 100, None), (1, 200, 'meta')])]),
+    ProduceRequest(1, 1000, [('foo', [
+        (0, [(0, None, Message(b'v1', key=b'k1')), (0, None, Message(None))]),
+        (1, [(0, 0, (0, 0, 0, None, b'raw'))])])]),
+])
+def test_encode_request(request_):
+    header = RequestHeader(request_, correlation_id=3, client_id='client')
+    message = header.encode() + request_.encode()
+    encoded = encode_request(header, request_)
+    assert isinstance(encoded, bytearray)
+    assert encoded == struct.pack('>i', len(message)) + message
+
+
+@pytest.mark.parametrize('min_ref_size', [1, 4, 4096])
+def test_encode_request_buffers(min_ref_size):
+    value = b'v' * 5000
+    request = ProduceRequest(1, 1000, [('foo', [
+        (0, [(0, None, Message(value, key=b'key')),
+             (0, None, Message(b'v2'))])])])
+    header = RequestHeader(request, correlation_id=3, client_id='client')
+    buffers = encode_request_buffers(header, request, min_ref_size)
+    assert b''.join([bytes(buf) for buf in buffers]) == encode_request(header, request)
+    assert any([buf is value for buf in buffers])
+
+
+def test_message_set_encode_into():
+    items = [(0, None, Message(b'v1', key=b'k1')), (5, None, Message(b'v2'))]
+    for size in (True, False):
+        buf = bytearray(b'prefix')
+        MessageSet.encode_into(buf, items, size=size)
+        assert buf == b'prefix' + MessageSet.encode(items, size=size)
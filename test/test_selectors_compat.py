@@ -0,0 +1,78 @@
+import socket
+
+import pytest
+
+from kafka import selectors_compat
+from kafka.selectors_compat import EVENT_READ, EVENT_WRITE
+
+
+SELECTORS = [getattr(selectors_compat, name)
+             for name in ('SelectSelector', 'PollSelector', 'EpollSelector')
+             if hasattr(selectors_compat, name)]
+
+
+@pytest.fixture
+def socketpair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize("selector_class", SELECTORS)
+def test_register_select_unregister(selector_class, socketpair):
+    a, b = socketpair
+    selector = selector_class()
+    try:
+        key = selector.register(a, EVENT_READ, 'data')
+        assert key.fd == a.fileno()
+        assert selector.get_key(a) == key
+        assert selector.get_map() == {a: key}
+        with pytest.raises(KeyError):
+            selector.register(a, EVENT_READ)
+        with pytest.raises(ValueError):
+            selector.register(b, 0)
+
+        # nothing to read yet
+        assert selector.select(0) == []
+
+        b.send(b'x')
+        ready = selector.select(1)
+        assert ready == [(key, EVENT_READ)]
+
+        # writable interest only reports writability
+        key = selector.modify(a, EVENT_WRITE, 'other')
+        assert key.data == 'other'
+        assert selector.select(1) == [(key, EVENT_WRITE)]
+
+        assert selector.unregister(a) == key
+        assert selector.get_map() == {}
+        with pytest.raises(KeyError):
+            selector.get_key(a)
+        assert selector.select(0) == []
+    finally:
+        selector.close()
+
+
+@pytest.mark.parametrize("selector_class", SELECTORS)
+def test_unregister_closed_socket(selector_class):
+    a, b = socket.socketpair()
+    selector = selector_class()
+    try:
+        key = selector.register(a, EVENT_READ)
+        a.close()
+        # a closed socket no longer has an fd, but can still be unregistered
+        assert selector.unregister(a) == key
+        assert selector.get_map() == {}
+    finally:
+        b.close()
+        selector.close()
+
+
+@pytest.mark.parametrize("selector_class", SELECTORS)
+def test_close(selector_class, socketpair):
+    a, _ = socketpair
+    selector = selector_class()
+    selector.register(a, EVENT_READ)
+    selector.close()
+    assert selector.get_map() == {}